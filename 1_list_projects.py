@@ -3,11 +3,11 @@
 """
 Template script to list all accessible projects on an XNAT server.
 This script demonstrates basic XNAT connection and project listing.
+All projects are fetched in one listing request instead of one request per project.
 """
 
 import xnat
 import sys
-from pathlib import Path
 
 # XNAT server configuration
 XNAT_SERVER = "https://xnat.abudhabi.nyu.edu"
@@ -20,17 +20,18 @@ def list_projects():
         # Create XNAT connection
         with xnat.connect(XNAT_SERVER, user=TOKEN_USER, password=TOKEN_SECRET) as session:
             
-            # Get all projects
-            projects = session.projects
+            # Get all projects with the columns we print in a single request
+            result = session.get_json('/data/projects', query={'columns': 'ID,name,description'})
+            projects = result['ResultSet']['Result']
             
             print("\nAccessible XNAT Projects:")
             print("-" * 50)
             
             # Print project information
-            for project_id, project in projects.items():
-                print(f"Project ID: {project_id}")
-                print(f"Project Name: {project.name}")
-                print(f"Description: {project.description}")
+            for project in projects:
+                print(f"Project ID: {project['ID']}")
+                print(f"Project Name: {project.get('name')}")
+                print(f"Description: {project.get('description')}")
                 print("-" * 50)
                 
     except xnat.exceptions.XNATError as e:
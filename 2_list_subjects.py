@@ -11,50 +11,96 @@ This script demonstrates how to access:
 import xnat
 import sys
 import argparse
-from datetime import datetime
 
 # XNAT server configuration
 XNAT_SERVER = "https://xnat.abudhabi.nyu.edu"
 TOKEN_USER = "<paste your token alias here>"
 TOKEN_SECRET = "<paste your token secret here>"
 PROJECT_ID = "rokerslab_ari-clean"  # Replace with your project ID
+PAGE_SIZE = 1000  # Rows fetched per listing request
+
+# Columns requested from the experiment listing, per session, per scan and per session resource
+SESSION_COLUMNS = ['ID', 'label', 'insert_date']
+SCAN_COLUMNS = {
+    'id': 'xnat:imagescandata/id',
+    'type': 'xnat:imagescandata/type',
+    'series_description': 'xnat:imagescandata/series_description',
+    'start_date': 'xnat:imagescandata/start_date',
+    'start_time': 'xnat:imagescandata/starttime',
+    'scanner': 'xnat:imagescandata/scanner',
+    'field_strength': 'xnat:mrscandata/fieldstrength',
+    'body_part_examined': 'xnat:imagescandata/bodypartexamined',
+}
+RESOURCE_COLUMN = 'xnat:experimentdata/resources/resource/label'
+
+def fetch_rows(session, path, columns):
+    """Fetch all rows of an XNAT listing with the given columns, one page at a time."""
+    rows = []
+    while True:
+        query = {'columns': ','.join(columns), 'offset': len(rows), 'limit': PAGE_SIZE}
+        page = session.get_json(path, query=query)['ResultSet']['Result']
+        
+        # A repeated first row means the server ignores paging and already sent everything
+        if rows and page and page[0] == rows[0]:
+            return rows
+        rows.extend(page)
+        
+        # A short page is the last one; a longer one also means paging is ignored
+        if len(page) != PAGE_SIZE:
+            return rows
+
+def fetch_subject_inventory(session, subject_id):
+    """Fetch all sessions of a subject with all their scans and resources in bulk.
+    Returns the session rows, a dict of scan rows per session ID and a dict of resource labels per session ID."""
+    path = f"/data/projects/{PROJECT_ID}/subjects/{subject_id}/experiments"
+    sessions = fetch_rows(session, path, SESSION_COLUMNS)
+    
+    # Asking for scan columns returns one row per scan
+    scans = {}
+    for row in fetch_rows(session, path, ['ID'] + list(SCAN_COLUMNS.values())):
+        if row.get(SCAN_COLUMNS['id']):
+            scans.setdefault(row['ID'], []).append({name: row.get(column) for name, column in SCAN_COLUMNS.items()})
+    
+    # Likewise, the resource column returns one row per session resource
+    resources = {}
+    for row in fetch_rows(session, path, ['ID', RESOURCE_COLUMN]):
+        if row.get(RESOURCE_COLUMN):
+            resources.setdefault(row['ID'], []).append(row[RESOURCE_COLUMN])
+    return sessions, scans, resources
 
 def print_scan_info(scan):
     """Print relevant information about a scan."""
-    print(f"    Scan {scan.id}: {scan.type}")
-    print(f"      Description: {scan.series_description}")
-    # print(f"      Quality: {scan.quality}")
-    print(f"      Acquisition Date: {scan.start_date} {scan.start_time}")
-    print(f"      Scanner: {scan.scanner} ({scan.field_strength}T)")
-    print(f"      Body Part: {scan.body_part_examined}")
+    print(f"    Scan {scan['id']}: {scan['type']}")
+    print(f"      Description: {scan['series_description']}")
+    # print(f"      Quality: {scan['quality']}")
+    print(f"      Acquisition Date: {scan['start_date']} {scan['start_time']}")
+    print(f"      Scanner: {scan['scanner']} ({scan['field_strength']}T)")
+    print(f"      Body Part: {scan['body_part_examined']}")
 
-def print_session_info(session):
+def print_session_info(experiment, scans, resources):
     """Print relevant information about a session."""
-    print(f"\n  Session: {session.label}")
-    print(f"  Date: {session.insert_date.strftime('%Y-%m-%d')}")
+    print(f"\n  Session: {experiment.get('label')}")
+    print(f"  Date: {(experiment.get('insert_date') or 'unknown')[:10]}")
     
     print("\n  Scans:")
-    try:
-        for scan in session.scans.values():
-            try:
-                print_scan_info(scan)
-            except AttributeError as e:
-                print(f"    Scan {scan.id}: Unable to get scan details - {e}")
-    except AttributeError as e:
-        print("    Unable to access scans")
+    if not scans:
+        print("    No scans found")
+    for scan in scans:
+        print_scan_info(scan)
     
     print("\n  Available Resources:")
-    for resource in session.resources.values():
-        print(f"    - {resource.label}")
+    for resource in resources:
+        print(f"    - {resource}")
 
-def print_subject_info(subject):
+def print_subject_info(session, subject):
     """Print relevant information about a subject."""
-    print(f"\nSubject ID: {subject.id}")
-    print(f"Label: {subject.label}")
+    print(f"\nSubject ID: {subject['ID']}")
+    print(f"Label: {subject.get('label')}")
     
+    experiments, scans, resources = fetch_subject_inventory(session, subject['ID'])
     print("\nSessions:")
-    for session in subject.experiments.values():
-        print_session_info(session)
+    for experiment in experiments:
+        print_session_info(experiment, scans.get(experiment['ID'], []), resources.get(experiment['ID'], []))
     print("-" * 70)
 
 def list_subject(subject_id=None):
@@ -63,27 +109,31 @@ def list_subject(subject_id=None):
         # Create XNAT connection
         with xnat.connect(XNAT_SERVER, user=TOKEN_USER, password=TOKEN_SECRET) as session:
             # Get the project
-            project = session.projects[PROJECT_ID]
+            try:
+                project = session.projects[PROJECT_ID]
+            except KeyError:
+                print(f"Error: Project '{PROJECT_ID}' not found.")
+                sys.exit(1)
             print(f"\nProject: {project.name} ({project.id})")
             print("=" * 70)
             
             # Get subjects
-            subjects = project.subjects
+            subjects = fetch_rows(session, f"/data/projects/{PROJECT_ID}/subjects", ['ID', 'label'])
             if not subjects:
                 print("No subjects found in this project.")
                 return
             
             # If no subject_id provided, use the first subject
             if subject_id is None:
-                subject = next(iter(subjects.values()))
+                subject = subjects[0]
             else:
-                subject = subjects[subject_id]
+                subject = next((row for row in subjects if subject_id in (row.get('ID'), row.get('label'))), None)
+                if subject is None:
+                    print(f"Error: Subject '{subject_id}' not found in project '{PROJECT_ID}'.")
+                    sys.exit(1)
                 
-            print_subject_info(subject)
+            print_subject_info(session, subject)
                 
-    except KeyError:
-        print(f"Error: Project '{PROJECT_ID}' or subject not found.")
-        sys.exit(1)
     except xnat.exceptions.XNATError as e:
         print(f"XNAT Error: {e}")
         sys.exit(1)
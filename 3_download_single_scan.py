@@ -12,6 +12,8 @@ import argparse
 import tempfile
 from pathlib import Path
 import shutil
+import struct
+import zlib
 
 # Default XNAT configuration
 DEFAULT_SERVER = "https://xnat.abudhabi.nyu.edu"
@@ -19,6 +21,12 @@ DEFAULT_TOKEN = "<paste your token alias here>"
 DEFAULT_SECRET = "<paste your token secret here>"
 PROJECT_ID = "rokerslab_ari-clean"  # Default project ID required
 
+# Zip record signatures read by stream_zip_members
+ZIP_LOCAL_FILE_HEADER = b'PK\x03\x04'
+ZIP_CENTRAL_DIRECTORY = b'PK\x01\x02'
+ZIP_END_OF_CENTRAL_DIRECTORY = b'PK\x05\x06'
+ZIP_DATA_DESCRIPTOR = b'PK\x07\x08'
+
 def setup_connection(server, username, password):
     """Create and return an XNAT connection."""
     try:
@@ -27,8 +35,115 @@ def setup_connection(server, username, password):
         print(f"Failed to connect to XNAT: {e}")
         sys.exit(1)
 
-def download_scan(project_id=PROJECT_ID, subject_id=None, session_id=None, scan_id=None, output_dir=None):
-    """Download a specific scan from XNAT. If no subject/session/scan IDs provided, downloads first scan of first subject."""
+def stream_zip_members(stream, chunk_size=1024 * 1024):
+    """Yield (name, data chunks) for each member of a zip read front to back from a stream.
+    The chunks of a member must be consumed before asking for the next member.
+    A member whose CRC-32 does not match, or a record that is not part of a zip, raises ValueError."""
+    buffer = b''
+
+    def read_exact(size):
+        nonlocal buffer
+        while len(buffer) < size:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                raise EOFError("Zip stream ended unexpectedly")
+            buffer += chunk
+        data, buffer = buffer[:size], buffer[size:]
+        return data
+
+    def peek(size):
+        nonlocal buffer
+        data = read_exact(size)
+        buffer = data + buffer
+        return data
+
+    def zip64_compressed_size(extra):
+        # The zip64 extra field of a local header holds the uncompressed size, then the compressed size
+        offset = 0
+        while offset + 4 <= len(extra):
+            header_id, size = struct.unpack_from('<HH', extra, offset)
+            if header_id == 0x0001 and size >= 16:
+                return struct.unpack_from('<Q', extra, offset + 12)[0]
+            offset += 4 + size
+        raise ValueError("Zip64 member without a zip64 extra field")
+
+    def member_data(flags, method, crc, size, zip64):
+        nonlocal buffer
+        actual_crc = 0
+        if method == 0:  # Stored
+            if flags & 0x08 and size == 0:
+                raise ValueError("Stored zip members without a known size cannot be streamed")
+            while size:
+                data = read_exact(min(chunk_size, size))
+                size -= len(data)
+                actual_crc = zlib.crc32(data, actual_crc)
+                yield data
+        elif method == 8:  # Deflated: the compressed data marks its own end
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            while not decompressor.eof:
+                chunk, buffer = buffer or stream.read(chunk_size), b''
+                if not chunk:
+                    raise EOFError("Zip stream ended unexpectedly")
+                data = decompressor.decompress(chunk)
+                actual_crc = zlib.crc32(data, actual_crc)
+                yield data
+            buffer = decompressor.unused_data
+        else:
+            raise ValueError(f"Unsupported zip compression method {method}")
+        # The CRC and sizes may follow the data in a data descriptor, optionally preceded by a signature
+        if flags & 0x08:
+            field = read_exact(4)
+            crc = struct.unpack('<I', read_exact(4) if field == ZIP_DATA_DESCRIPTOR else field)[0]
+            read_exact(8)
+            # Zip64 descriptors carry 8-byte sizes; tell them apart by the record that follows
+            if zip64 or peek(4) not in (ZIP_LOCAL_FILE_HEADER, ZIP_CENTRAL_DIRECTORY, ZIP_END_OF_CENTRAL_DIRECTORY):
+                read_exact(8)
+        if actual_crc != crc:
+            raise ValueError("CRC mismatch in zip stream")
+
+    while True:
+        signature = read_exact(4)
+        if signature in (ZIP_CENTRAL_DIRECTORY, ZIP_END_OF_CENTRAL_DIRECTORY):
+            return
+        if signature != ZIP_LOCAL_FILE_HEADER:
+            raise ValueError(f"Unexpected zip record signature {signature!r}")
+        flags, method, crc, size, name_length, extra_length = struct.unpack('<2xHH4xII4xHH', read_exact(26))
+        name = read_exact(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = read_exact(extra_length)
+        zip64 = size == 0xFFFFFFFF
+        if zip64 and method == 0:
+            size = zip64_compressed_size(extra)
+        yield name, member_data(flags, method, crc, size, zip64)
+
+def stream_dicoms_to_dir(session, resource, scan_dir):
+    """Stream a resource zip from XNAT and write its DICOM files straight into scan_dir."""
+    url = f"{DEFAULT_SERVER}{resource.uri}/files"
+    written = 0
+    with session.interface.get(url, params={'format': 'zip'}, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        for name, chunks in stream_zip_members(response.raw):
+            if not name.endswith('.dcm'):
+                for _ in chunks:
+                    pass
+                continue
+            # Write via a .part file, so a member that fails its CRC check is never left behind as a DICOM file
+            destination = scan_dir / Path(name).name
+            partial = destination.with_name(destination.name + '.part')
+            try:
+                with open(partial, 'wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+            except BaseException:
+                partial.unlink(missing_ok=True)
+                raise
+            partial.replace(destination)
+            written += 1
+    return written
+
+def download_scan(project_id=PROJECT_ID, subject_id=None, session_id=None, scan_id=None, output_dir=None, stream=False):
+    """Download a specific scan from XNAT. If no subject/session/scan IDs provided, downloads first scan of first subject.
+    With stream=True the files are extracted while downloading instead of via a temporary directory."""
     
     # Create output directory if it doesn't exist
     output_path = Path(output_dir or "downloaded_data")
@@ -72,6 +187,19 @@ def download_scan(project_id=PROJECT_ID, subject_id=None, session_id=None, scan_
                 print("Error: No DICOM resource found for this scan")
                 sys.exit(1)
             
+            # Create scan-specific directory
+            scan_dir = output_path / f"scan-{scan_id}_{scan.type}"
+            
+            if stream:
+                print("\nStreaming DICOM files...")
+                scan_dir.mkdir(exist_ok=True)
+                num_files = stream_dicoms_to_dir(session, scan.resources['DICOM'], scan_dir)
+                if not num_files:
+                    print("No DICOM files found in the scan")
+                    sys.exit(1)
+                print(f"\nDownload complete! {num_files} files saved to: {scan_dir}")
+                return
+            
             # Create a temporary directory for download
             with tempfile.TemporaryDirectory() as temp_dir:
                 print("\nDownloading DICOM files...")
@@ -87,8 +215,6 @@ def download_scan(project_id=PROJECT_ID, subject_id=None, session_id=None, scan_
                     print("No DICOM files found in the scan")
                     sys.exit(1)
                 
-                # Create scan-specific directory
-                scan_dir = output_path / f"scan-{scan_id}_{scan.type}"
                 scan_dir.mkdir(exist_ok=True)
                 
                 print(f"Moving {len(dicom_files)} files to {scan_dir}...")
@@ -111,6 +237,7 @@ def main():
     parser.add_argument('--session', help='Session/Experiment ID (defaults to first session)')
     parser.add_argument('--scan', help='Scan ID (defaults to first scan)')
     parser.add_argument('--output', help='Output directory for downloaded files')
+    parser.add_argument('--stream', action='store_true', help='Extract files while downloading instead of via a temporary directory')
     
     args = parser.parse_args()
     
@@ -119,7 +246,8 @@ def main():
         args.subject,
         args.session,
         args.scan,
-        args.output
+        args.output,
+        args.stream
     )
 
 if __name__ == "__main__":
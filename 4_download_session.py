@@ -11,6 +11,10 @@ import argparse
 import tempfile
 from pathlib import Path
 import shutil
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
 
 # Default XNAT configuration
 DEFAULT_SERVER = "https://xnat.abudhabi.nyu.edu"
@@ -18,6 +22,12 @@ DEFAULT_TOKEN = "<paste your token alias here>"
 DEFAULT_SECRET = "<paste your token secret here>"
 PROJECT_ID = "rokerslab_ari-clean"  # Add default project ID like in script 3
 
+# Zip record signatures read by stream_zip_members
+ZIP_LOCAL_FILE_HEADER = b'PK\x03\x04'
+ZIP_CENTRAL_DIRECTORY = b'PK\x01\x02'
+ZIP_END_OF_CENTRAL_DIRECTORY = b'PK\x05\x06'
+ZIP_DATA_DESCRIPTOR = b'PK\x07\x08'
+
 def setup_connection(server, username, password):
     """Create and return an XNAT connection."""
     try:
@@ -26,20 +36,136 @@ def setup_connection(server, username, password):
         print(f"Failed to connect to XNAT: {e}")
         sys.exit(1)
 
-def download_scan(session, scan, output_path):
-    """Download a single scan from XNAT and save to output directory."""
+def stream_zip_members(stream, chunk_size=1024 * 1024):
+    """Yield (name, data chunks) for each member of a zip read front to back from a stream.
+    The chunks of a member must be consumed before asking for the next member.
+    A member whose CRC-32 does not match, or a record that is not part of a zip, raises ValueError."""
+    buffer = b''
+
+    def read_exact(size):
+        nonlocal buffer
+        while len(buffer) < size:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                raise EOFError("Zip stream ended unexpectedly")
+            buffer += chunk
+        data, buffer = buffer[:size], buffer[size:]
+        return data
+
+    def peek(size):
+        nonlocal buffer
+        data = read_exact(size)
+        buffer = data + buffer
+        return data
+
+    def zip64_compressed_size(extra):
+        # The zip64 extra field of a local header holds the uncompressed size, then the compressed size
+        offset = 0
+        while offset + 4 <= len(extra):
+            header_id, size = struct.unpack_from('<HH', extra, offset)
+            if header_id == 0x0001 and size >= 16:
+                return struct.unpack_from('<Q', extra, offset + 12)[0]
+            offset += 4 + size
+        raise ValueError("Zip64 member without a zip64 extra field")
+
+    def member_data(flags, method, crc, size, zip64):
+        nonlocal buffer
+        actual_crc = 0
+        if method == 0:  # Stored
+            if flags & 0x08 and size == 0:
+                raise ValueError("Stored zip members without a known size cannot be streamed")
+            while size:
+                data = read_exact(min(chunk_size, size))
+                size -= len(data)
+                actual_crc = zlib.crc32(data, actual_crc)
+                yield data
+        elif method == 8:  # Deflated: the compressed data marks its own end
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            while not decompressor.eof:
+                chunk, buffer = buffer or stream.read(chunk_size), b''
+                if not chunk:
+                    raise EOFError("Zip stream ended unexpectedly")
+                data = decompressor.decompress(chunk)
+                actual_crc = zlib.crc32(data, actual_crc)
+                yield data
+            buffer = decompressor.unused_data
+        else:
+            raise ValueError(f"Unsupported zip compression method {method}")
+        # The CRC and sizes may follow the data in a data descriptor, optionally preceded by a signature
+        if flags & 0x08:
+            field = read_exact(4)
+            crc = struct.unpack('<I', read_exact(4) if field == ZIP_DATA_DESCRIPTOR else field)[0]
+            read_exact(8)
+            # Zip64 descriptors carry 8-byte sizes; tell them apart by the record that follows
+            if zip64 or peek(4) not in (ZIP_LOCAL_FILE_HEADER, ZIP_CENTRAL_DIRECTORY, ZIP_END_OF_CENTRAL_DIRECTORY):
+                read_exact(8)
+        if actual_crc != crc:
+            raise ValueError("CRC mismatch in zip stream")
+
+    while True:
+        signature = read_exact(4)
+        if signature in (ZIP_CENTRAL_DIRECTORY, ZIP_END_OF_CENTRAL_DIRECTORY):
+            return
+        if signature != ZIP_LOCAL_FILE_HEADER:
+            raise ValueError(f"Unexpected zip record signature {signature!r}")
+        flags, method, crc, size, name_length, extra_length = struct.unpack('<2xHH4xII4xHH', read_exact(26))
+        name = read_exact(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = read_exact(extra_length)
+        zip64 = size == 0xFFFFFFFF
+        if zip64 and method == 0:
+            size = zip64_compressed_size(extra)
+        yield name, member_data(flags, method, crc, size, zip64)
+
+def stream_dicoms_to_dir(session, resource, scan_dir):
+    """Stream a resource zip from XNAT and write its DICOM files straight into scan_dir."""
+    url = f"{DEFAULT_SERVER}{resource.uri}/files"
+    written = 0
+    with session.interface.get(url, params={'format': 'zip'}, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        for name, chunks in stream_zip_members(response.raw):
+            if not name.endswith('.dcm'):
+                for _ in chunks:
+                    pass
+                continue
+            # Write via a .part file, so a member that fails its CRC check is never left behind as a DICOM file
+            destination = scan_dir / Path(name).name
+            partial = destination.with_name(destination.name + '.part')
+            try:
+                with open(partial, 'wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+            except BaseException:
+                partial.unlink(missing_ok=True)
+                raise
+            partial.replace(destination)
+            written += 1
+    return written
+
+def download_scan(session, scan, output_path, stream=False):
+    """Download a single scan from XNAT and save to output directory.
+    With stream=True the files are extracted while downloading instead of via a temporary directory."""
     # Check if scan has DICOM resource
     if 'DICOM' not in scan.resources:
         print(f"Warning: No DICOM resource found for scan {scan.id}")
-        return
+        return False
 
     # Create scan-specific directory
     scan_dir = output_path / f"scan-{scan.id}_{scan.type}"
     scan_dir.mkdir(exist_ok=True)
 
+    if stream:
+        print(f"Streaming DICOM files for scan {scan.id}...")
+        num_files = stream_dicoms_to_dir(session, scan.resources['DICOM'], scan_dir)
+        if not num_files:
+            print(f"No DICOM files found in scan {scan.id}")
+            return False
+        print(f"Scan {scan.id} download complete! {num_files} files saved")
+        return True
+
     # Use temporary directory for download
     with tempfile.TemporaryDirectory() as temp_dir:
-        print("Downloading DICOM files...")
+        print(f"Downloading DICOM files for scan {scan.id}...")
         
         # Download the DICOM files
         scan.resources['DICOM'].download_dir(temp_dir)
@@ -49,17 +175,19 @@ def download_scan(session, scan, output_path):
         dicom_files = list(temp_path.rglob('*.dcm'))
         
         if not dicom_files:
-            print("No DICOM files found in this scan")
-            return
+            print(f"No DICOM files found in scan {scan.id}")
+            return False
         
         print(f"Moving {len(dicom_files)} files to {scan_dir}...")
         for file in dicom_files:
             shutil.move(str(file), str(scan_dir / file.name))
         
-        print("Scan download complete!")
+        print(f"Scan {scan.id} download complete!")
+        return True
 
-def download_session(project_id=PROJECT_ID, subject_id=None, session_id=None, output_dir=None, scan_types=None):
-    """Download all scans from a session that match the specified scan types."""
+def download_session(project_id=PROJECT_ID, subject_id=None, session_id=None, output_dir=None, scan_types=None, jobs=1, stream=False):
+    """Download all scans from a session that match the specified scan types.
+    Up to `jobs` scans are downloaded in parallel, optionally extracting files while streaming."""
     
     # Create output directory if it doesn't exist
     output_path = Path(output_dir or "downloaded_data")
@@ -67,6 +195,12 @@ def download_session(project_id=PROJECT_ID, subject_id=None, session_id=None, ou
     
     with setup_connection(DEFAULT_SERVER, DEFAULT_TOKEN, DEFAULT_SECRET) as session:
         try:
+            # Allow one pooled connection per parallel download
+            if jobs > 1:
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=jobs)
+                session.interface.mount('https://', adapter)
+                session.interface.mount('http://', adapter)
+            
             # Get project
             project = session.projects[project_id]
             
@@ -101,16 +235,38 @@ def download_session(project_id=PROJECT_ID, subject_id=None, session_id=None, ou
             
             print(f"\nFound {len(scans)} scans in session")
             
-            # Download each scan that matches the filter
+            # Select the scans that match the filter
+            selected_scans = []
             for scan_id, scan in scans.items():
                 if scan_types and scan.type not in scan_types:
                     print(f"\nSkipping scan {scan_id} (type: {scan.type}) - not in requested types")
                     continue
+                selected_scans.append(scan)
+            
+            # Download the selected scans, at most `jobs` at a time
+            downloaded_scans = 0
+            failed_scans = []
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = {}
+                for scan in selected_scans:
+                    print(f"\nProcessing scan {scan.id} (type: {scan.type})")
+                    futures[pool.submit(download_scan, session, scan, session_dir, stream)] = scan
                 
-                print(f"\nProcessing scan {scan_id} (type: {scan.type})")
-                download_scan(session, scan, session_dir)
+                for future in as_completed(futures):
+                    scan = futures[future]
+                    try:
+                        if future.result():
+                            downloaded_scans += 1
+                    except Exception as e:
+                        failed_scans.append(scan.id)
+                        print(f"Error downloading scan {scan.id}: {e}")
             
-            print(f"\nSession download complete! Files saved to: {session_dir}")
+            print(f"\nSession download complete! {downloaded_scans} downloaded, "
+                  f"{len(scans) - len(selected_scans)} skipped, {len(failed_scans)} failed "
+                  f"out of {len(scans)} scans. Files saved to: {session_dir}")
+            if failed_scans:
+                print(f"Failed scans: {failed_scans}")
+                sys.exit(1)
                 
         except KeyError as e:
             print(f"Error: Resource not found - {e}")
@@ -126,15 +282,21 @@ def main():
     parser.add_argument('--session', help='Session/Experiment ID (defaults to first session)')
     parser.add_argument('--output', help='Output directory for downloaded files')
     parser.add_argument('--scan-types', nargs='+', help='Optional: List of scan types to download (e.g., T1 T2)')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of scans to download in parallel (default: 1)')
+    parser.add_argument('--stream', action='store_true', help='Extract files while downloading instead of via a temporary directory')
     
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
     
     download_session(
         args.project,
         args.subject,
         args.session,
         args.output,
-        args.scan_types
+        args.scan_types,
+        args.jobs,
+        args.stream
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,612 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for an XNAT server, used to benchmark the download scripts.
+
+It serves a synthetic project with a configurable number of subjects,
+sessions, scans and files through the REST endpoints the scripts and the
+xnat package use: login, the data model schema, project/subject/experiment/
+scan/resource listings and objects, file catalogs, single files (with HTTP
+Range support) and whole resources as zip (`resources/DICOM/files?format=zip`).
+It also accepts uploads: new resources, single files and zips extracted into
+a resource (`PUT .../files/batch.zip?extract=true`), kept in memory.
+A failure rate can be set to cut off some file and zip downloads halfway, to
+exercise the retry and resume paths.
+
+File contents are generated on the fly from a fixed random pool, so large
+projects need no disk space on the server side. Every request is counted per
+kind so benchmarks can report how many round trips a download needed.
+
+Run on its own for manual testing:
+    python mock_xnat_server.py --port 8080 --subjects 2 --scans 4 --files 100
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+import zipfile
+import zlib
+from collections import Counter
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlsplit
+
+SCHEMA_PATH = Path(__file__).with_name('xnat-subset.xsd')
+XNAT_VERSION = '1.8.10'
+SCAN_TYPES = ['T1w', 'T2w', 'bold', 'dwi', 'fmap', 'localizer']
+# Column of the experiment listing that returns one row per session resource
+RESOURCE_LABEL_COLUMN = 'xnat:experimentdata/resources/resource/label'
+
+# Path patterns of the REST endpoints, from most to least specific
+EXPERIMENT = r'/data(?:/archive)?(?:/projects/(?P<project>[^/]+)(?:/subjects/(?P<subject>[^/]+))?)?/experiments/(?P<experiment>[^/]+)'
+RESOURCE_OWNER = EXPERIMENT + r'(?:/scans/(?P<scan>[^/]+))?'
+ROUTES = [
+    ('file', RESOURCE_OWNER + r'/resources/(?P<resource>[^/]+)/files/(?P<path>.+)'),
+    ('files', RESOURCE_OWNER + r'/resources/(?P<resource>[^/]+)/files'),
+    ('resource', RESOURCE_OWNER + r'/resources/(?P<resource>[^/]+)'),
+    ('resources', RESOURCE_OWNER + r'/resources'),
+    ('scan_files', EXPERIMENT + r'/scans/(?P<scan>[^/]+)/files'),
+    ('scan', EXPERIMENT + r'/scans/(?P<scan>[^/]+)'),
+    ('scans', EXPERIMENT + r'/scans'),
+    ('experiment', EXPERIMENT),
+    ('experiments', r'/data(?:/archive)?(?:/projects/(?P<project>[^/]+)(?:/subjects/(?P<subject>[^/]+))?)?/experiments'),
+    ('subject', r'/data(?:/archive)?/projects/(?P<project>[^/]+)/subjects/(?P<subject>[^/]+)'),
+    ('subjects', r'/data(?:/archive)?/projects/(?P<project>[^/]+)/subjects'),
+    ('project', r'/data(?:/archive)?/projects/(?P<project>[^/]+)'),
+    ('projects', r'/data(?:/archive)?/projects'),
+]
+
+class SyntheticProject:
+    """In-memory description of a synthetic XNAT project."""
+
+    def __init__(self, project_id='BENCH', subjects=2, sessions=1, scans=4, files=100,
+                 file_size=256 * 1024, resource_name='rawdata', resource_files=20, seed=0):
+        self.project_id = project_id
+        self.file_size = file_size
+        self.resource_name = resource_name
+        self.pool = random.Random(seed).randbytes(8 * 1024 * 1024)
+        self.subjects = {}
+        self.experiments = {}
+        self.uploads = {}  # Contents of uploaded files by file key
+        self._lock = threading.Lock()
+        resource_id = 1000
+
+        for s in range(1, subjects + 1):
+            subject_label = f"sub-{s:04d}"
+            subject_id = f"{project_id}_S{s:05d}"
+            self.subjects[subject_id] = {'ID': subject_id, 'label': subject_label, 'project': project_id}
+
+            for e in range(1, sessions + 1):
+                session_label = f"ses-{e:02d}"
+                experiment_id = f"{project_id}_E{s:05d}{e:02d}"
+                experiment = {
+                    'ID': experiment_id, 'label': f"{subject_label}_{session_label}", 'project': project_id,
+                    'subject_ID': subject_id, 'date': f"2024-01-{e:02d}", 'insert_date': f"2024-01-{e:02d} 12:00:00.0",
+                    'last_modified': f"2024-01-{e:02d} 12:30:00.0",
+                    'xsiType': 'xnat:mrSessionData', 'scans': {}, 'resources': {},
+                }
+                self.experiments[experiment_id] = experiment
+
+                for n in range(1, scans + 1):
+                    scan_type = SCAN_TYPES[(n - 1) % len(SCAN_TYPES)]
+                    resource_id += 1
+                    names = [f"1.3.12.2.{s}.{e}.{n}.{i:05d}.dcm" for i in range(1, files + 1)]
+                    experiment['scans'][str(n)] = {
+                        'ID': str(n), 'type': scan_type, 'series_description': f"{scan_type}_run-{n}",
+                        'resources': {'DICOM': self._resource(resource_id, 'DICOM', names)},
+                    }
+
+                resource_id += 1
+                prefix = f"{subject_label}/{session_label}"
+                names = ['README', 'dataset_description.json', 'CHANGES'] + [
+                    f"{prefix}/anat/{subject_label}_{session_label}_run-{i}_T1w.nii.gz" for i in range(1, resource_files + 1)]
+                experiment['resources'][resource_name] = self._resource(resource_id, resource_name, names)
+        self.next_resource_id = resource_id + 1
+
+    def _resource(self, resource_id, label, names):
+        return {'id': str(resource_id), 'label': label, 'files': names}
+
+    def add_resource(self, owner, label):
+        """Create an empty resource on an experiment or scan, or return the existing one."""
+        with self._lock:
+            if label not in owner['resources']:
+                owner['resources'][label] = self._resource(self.next_resource_id, label, [])
+                self.next_resource_id += 1
+            return owner['resources'][label]
+
+    def store_file(self, resource, key, path, content):
+        """Add or replace an uploaded file of a resource."""
+        with self._lock:
+            self.uploads[key] = content
+            if path not in resource['files']:
+                resource['files'].append(path)
+
+    def content(self, key):
+        """Return the uploaded or the deterministic content of a file."""
+        if key in self.uploads:
+            return self.uploads[key]
+        offset = zlib.crc32(key.encode()) % (len(self.pool) - self.file_size) if self.file_size < len(self.pool) else 0
+        data = self.pool[offset:offset + self.file_size]
+        while len(data) < self.file_size:
+            data += self.pool[:self.file_size - len(data)]
+        return data
+
+    def size(self, key):
+        return len(self.uploads[key]) if key in self.uploads else self.file_size
+
+    def digest(self, key):
+        if key in self.uploads:
+            return hashlib.md5(self.uploads[key]).hexdigest()
+        return self.generated_digest(key)
+
+    @lru_cache(maxsize=None)
+    def generated_digest(self, key):
+        return hashlib.md5(self.content(key)).hexdigest()
+
+    def find_experiment(self, experiment):
+        """Look up an experiment by ID or label."""
+        if experiment in self.experiments:
+            return self.experiments[experiment]
+        return next((x for x in self.experiments.values() if x['label'] == experiment), None)
+
+    def find_subject(self, subject):
+        """Look up a subject by ID or label."""
+        if subject in self.subjects:
+            return self.subjects[subject]
+        return next((x for x in self.subjects.values() if x['label'] == subject), None)
+
+class MockXnatHandler(BaseHTTPRequestHandler):
+    """Request handler that answers the XNAT REST calls for the server's SyntheticProject."""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'MockXNAT/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    # --- Response helpers ---
+
+    def send_body(self, body, content_type='application/json', status=200, headers=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_json(self, data):
+        self.send_body(json.dumps(data))
+
+    def send_rows(self, rows):
+        self.send_json({'ResultSet': {'Result': rows, 'totalRecords': str(len(rows))}})
+
+    def send_object(self, xsi_type, data_fields, children=None):
+        self.send_json({'items': [{
+            'meta': {'xsi:type': xsi_type, 'isHistory': False, 'start_date': 'Mon Jan 01 12:00:00 UTC 2024'},
+            'data_fields': data_fields,
+            'children': children or [],
+        }]})
+
+    def send_not_found(self):
+        self.send_body('Not found', content_type='text/plain', status=404)
+
+    # --- Request dispatch ---
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_HEAD(self):
+        self.dispatch()
+
+    def do_PUT(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def do_DELETE(self):
+        self.dispatch()
+
+    def dispatch(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        url = urlsplit(self.path)
+        path = unquote(url.path).rstrip('/') or '/'
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        # Read any request body so the connection can be reused
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+
+        if self.handle_service(path):
+            return
+
+        for kind, pattern in ROUTES:
+            match = re.fullmatch(pattern, path)
+            if match:
+                self.server.count(kind)
+                handler = getattr(self, f"put_{kind}", None) if self.command == 'PUT' else None
+                (handler or getattr(self, f"get_{kind}"))(query, **match.groupdict())
+                return
+
+        self.server.count('other')
+        self.send_not_found()
+
+    def handle_service(self, path):
+        """Answer login, version and schema requests. Returns True if handled."""
+        if path == '/' or path == '/data/services/auth' or path == '/data/JSESSION':
+            self.server.count('auth')
+            if self.command == 'DELETE':
+                self.send_body('', content_type='text/plain')
+            else:
+                self.send_body('mock-jsession', content_type='text/plain',
+                               headers={'Set-Cookie': 'JSESSIONID=mock-jsession; Path=/'})
+        elif path == '/data/auth':
+            self.server.count('auth')
+            self.send_body("User 'benchmark' is logged in", content_type='text/plain')
+        elif path == '/data/version':
+            self.server.count('model')
+            self.send_body(XNAT_VERSION, content_type='text/plain')
+        elif path == '/xapi/siteConfig/buildInfo':
+            self.server.count('model')
+            self.send_json({'version': XNAT_VERSION})
+        elif path == '/xapi/schemas':
+            self.server.count('model')
+            self.send_json(['xnat'])
+        elif path == '/xapi/schemas/xnat':
+            self.server.count('model')
+            self.send_body(SCHEMA_PATH.read_bytes(), content_type='application/xml')
+        elif path == '/data/search/elements':
+            self.server.count('model')
+            self.send_rows([])
+        else:
+            return False
+        return True
+
+    # --- Listings and objects ---
+
+    @property
+    def data(self):
+        return self.server.project
+
+    def get_projects(self, query):
+        self.send_rows([{'ID': self.data.project_id, 'name': f"{self.data.project_id} benchmark",
+                         'description': 'Synthetic benchmark project', 'secondary_ID': self.data.project_id,
+                         'URI': f"/data/projects/{self.data.project_id}"}])
+
+    def get_project(self, query, project):
+        if project != self.data.project_id:
+            return self.send_not_found()
+        self.send_object('xnat:projectData', {'ID': project, 'name': f"{project} benchmark",
+                                              'description': 'Synthetic benchmark project'})
+
+    def get_subjects(self, query, project):
+        self.send_rows([dict(subject, URI=f"/data/subjects/{subject['ID']}") for subject in self.data.subjects.values()])
+
+    def get_subject(self, query, project, subject):
+        subject = self.data.find_subject(subject)
+        if subject is None:
+            return self.send_not_found()
+        self.send_object('xnat:subjectData', subject)
+
+    def get_experiments(self, query, project=None, subject=None):
+        experiments = list(self.data.experiments.values())
+        if subject is not None:
+            subject = self.data.find_subject(subject)
+            experiments = [x for x in experiments if subject and x['subject_ID'] == subject['ID']]
+
+        rows = []
+        columns = query.get('columns', '').lower().split(',')
+        scan_columns = [c for c in columns if c.startswith('xnat:imagescandata/')]
+        for experiment in experiments:
+            row = {key: value for key, value in experiment.items() if key not in ('scans', 'resources')}
+            row['URI'] = f"/data/experiments/{experiment['ID']}"
+            row['subject_label'] = self.data.subjects[experiment['subject_ID']]['label']
+            if RESOURCE_LABEL_COLUMN in columns:
+                # The resource label column turns the listing into one row per session resource
+                rows += [dict(row, **{RESOURCE_LABEL_COLUMN: label}) for label in experiment['resources']]
+                continue
+            if not scan_columns:
+                rows.append(row)
+                continue
+            # Scan columns turn the listing into one row per scan
+            for scan in experiment['scans'].values():
+                scan_row = dict(row)
+                scan_row.update({
+                    'xnat:imagescandata/id': scan['ID'], 'xnat:imagescandata/type': scan['type'],
+                    'xnat:imagescandata/series_description': scan['series_description'],
+                })
+                rows.append(scan_row)
+        self.send_rows(rows)
+
+    def get_experiment(self, query, experiment, project=None, subject=None):
+        experiment = self.data.find_experiment(experiment)
+        if experiment is None:
+            return self.send_not_found()
+        self.send_object(experiment['xsiType'],
+                         {key: value for key, value in experiment.items() if key not in ('scans', 'resources', 'xsiType')})
+
+    def get_scans(self, query, experiment, project=None, subject=None):
+        experiment = self.data.find_experiment(experiment)
+        if experiment is None:
+            return self.send_not_found()
+        self.send_rows([{'ID': scan['ID'], 'type': scan['type'], 'series_description': scan['series_description'],
+                         'xsiType': 'xnat:mrScanData', 'quality': 'usable', 'note': '',
+                         'URI': f"/data/experiments/{experiment['ID']}/scans/{scan['ID']}"}
+                        for scan in experiment['scans'].values()])
+
+    def get_scan(self, query, experiment, scan, project=None, subject=None):
+        owner = self.find_owner(experiment, scan)
+        if owner is None:
+            return self.send_not_found()
+        experiment, scan = owner
+        self.send_object('xnat:mrScanData', {
+            'ID': scan['ID'], 'type': scan['type'], 'series_description': scan['series_description'],
+            'scanner': 'MockScanner', 'fieldStrength': '3.0', 'startTime': '12:00:00', 'start_date': '2024-01-01',
+            'bodyPartExamined': 'BRAIN', 'image_session_ID': experiment['ID'], 'project': experiment['project'],
+        })
+
+    def get_scan_files(self, query, experiment, scan, project=None, subject=None):
+        owner = self.find_owner(experiment, scan)
+        if owner is None:
+            return self.send_not_found()
+        experiment, scan = owner
+        rows = []
+        for resource in scan['resources'].values():
+            rows.extend(self.catalog_rows(experiment, scan, resource))
+        self.send_rows(rows)
+
+    def get_resources(self, query, experiment, scan=None, project=None, subject=None):
+        owner = self.find_owner(experiment, scan)
+        if owner is None:
+            return self.send_not_found()
+        resources = (owner[1] or owner[0])['resources'].values()
+        self.send_rows([self.resource_fields(owner[0], owner[1], resource) for resource in resources])
+
+    def get_resource(self, query, experiment, resource, scan=None, project=None, subject=None):
+        found = self.find_resource(experiment, scan, resource)
+        if found is None:
+            return self.send_not_found()
+        self.send_object('xnat:resourceCatalog', self.resource_fields(*found))
+
+    def get_files(self, query, experiment, resource, scan=None, project=None, subject=None):
+        found = self.find_resource(experiment, scan, resource)
+        if found is None:
+            return self.send_not_found()
+        if query.get('format') == 'zip':
+            self.server.count('zip')
+            return self.send_zip(*found)
+        self.send_rows(self.catalog_rows(*found))
+
+    def get_file(self, query, experiment, resource, path, scan=None, project=None, subject=None):
+        found = self.find_resource(experiment, scan, resource)
+        if found is None or path not in found[2]['files']:
+            return self.send_not_found()
+        content = self.data.content(self.file_key(*found, path))
+        if self.server.should_fail():
+            return self.send_truncated(content)
+
+        # Honour simple "bytes=<start>-" range requests so downloads can resume
+        match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match and int(match.group(1)) < len(content):
+            start = int(match.group(1))
+            self.server.count_bytes(len(content) - start)
+            self.send_body(content[start:], content_type='application/octet-stream', status=206, headers={
+                'Accept-Ranges': 'bytes', 'Content-Range': f"bytes {start}-{len(content) - 1}/{len(content)}"})
+        else:
+            self.server.count_bytes(len(content))
+            self.send_body(content, content_type='application/octet-stream', headers={'Accept-Ranges': 'bytes'})
+
+    # --- Uploads ---
+
+    def put_resource(self, query, experiment, resource, scan=None, project=None, subject=None):
+        owner = self.find_owner(experiment, scan)
+        if owner is None:
+            return self.send_not_found()
+        self.data.add_resource(owner[1] or owner[0], resource)
+        self.send_body('', content_type='text/plain')
+
+    def put_file(self, query, experiment, resource, path, scan=None, project=None, subject=None):
+        owner = self.find_owner(experiment, scan)
+        if owner is None:
+            return self.send_not_found()
+        # Like XNAT, uploading into a resource that does not exist yet creates it
+        found = self.data.add_resource(owner[1] or owner[0], resource)
+        self.server.count('upload')
+        if query.get('extract') == 'true' and path.endswith('.zip'):
+            # Members are extracted next to where the zip would have been stored
+            folder = path.rsplit('/', 1)[0] + '/' if '/' in path else ''
+            with zipfile.ZipFile(io.BytesIO(self.body)) as archive:
+                for member in archive.infolist():
+                    if not member.is_dir():
+                        member_path = folder + member.filename
+                        self.data.store_file(found, self.file_key(owner[0], owner[1], found, member_path),
+                                             member_path, archive.read(member))
+        else:
+            self.data.store_file(found, self.file_key(owner[0], owner[1], found, path), path, self.body)
+        self.send_body('', content_type='text/plain')
+
+    def send_truncated(self, content):
+        """Announce the full file but drop the connection halfway through it."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content[:len(content) // 2])
+        self.server.count_bytes(len(content) // 2)
+        self.close_connection = True
+
+    # --- Helpers ---
+
+    def find_owner(self, experiment, scan=None):
+        """Return (experiment, scan or None) or None if either does not exist."""
+        experiment = self.data.find_experiment(experiment)
+        if experiment is None:
+            return None
+        if scan is None:
+            return experiment, None
+        scan = experiment['scans'].get(scan)
+        return (experiment, scan) if scan else None
+
+    def find_resource(self, experiment, scan, resource):
+        """Return (experiment, scan, resource) with the resource looked up by ID or label."""
+        owner = self.find_owner(experiment, scan)
+        if owner is None:
+            return None
+        resources = (owner[1] or owner[0])['resources']
+        found = resources.get(resource) or next((r for r in resources.values() if r['id'] == resource), None)
+        return (owner[0], owner[1], found) if found else None
+
+    def resource_fields(self, experiment, scan, resource):
+        return {'xnat_abstractresource_id': resource['id'], 'label': resource['label'],
+                'element_name': 'xnat:resourceCatalog', 'format': 'DICOM' if resource['label'] == 'DICOM' else '',
+                'file_count': str(len(resource['files'])),
+                'file_size': str(sum(self.data.size(self.file_key(experiment, scan, resource, path))
+                                     for path in resource['files']))}
+
+    def resource_uri(self, experiment, scan, resource):
+        scan_part = f"/scans/{scan['ID']}" if scan else ''
+        return f"/data/experiments/{experiment['ID']}{scan_part}/resources/{resource['id']}"
+
+    def file_key(self, experiment, scan, resource, path):
+        return f"{self.resource_uri(experiment, scan, resource)}/{path}"
+
+    def catalog_rows(self, experiment, scan, resource):
+        uri = self.resource_uri(experiment, scan, resource)
+        return [{'Name': path.split('/')[-1], 'Size': str(self.data.size(self.file_key(experiment, scan, resource, path))),
+                 'URI': f"{uri}/files/{path}",
+                 'collection': resource['label'], 'file_tags': '', 'file_format': '', 'file_content': '',
+                 'cat_ID': resource['id'], 'digest': self.data.digest(self.file_key(experiment, scan, resource, path))}
+                for path in resource['files']]
+
+    def send_zip(self, experiment, scan, resource):
+        """Stream a resource as a zip with the member layout XNAT uses, using chunked transfer encoding."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        if scan:
+            prefix = f"{experiment['label']}/scans/{scan['ID']}-{scan['type']}/resources/{resource['label']}/files"
+        else:
+            prefix = f"{experiment['label']}/resources/{resource['label']}/files"
+
+        # A failing download stops after half of the members without ending the chunked body
+        files = resource['files']
+        fail_after = len(files) // 2 if self.server.should_fail() else None
+
+        writer = ChunkedWriter(self.wfile, self.server)
+        # Level 0 deflate keeps the server cheap while still producing data descriptors like XNAT
+        archive = zipfile.ZipFile(writer, 'w', zipfile.ZIP_DEFLATED, compresslevel=0)
+        for index, path in enumerate(files):
+            if index == fail_after:
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            archive.writestr(f"{prefix}/{path}", self.data.content(self.file_key(experiment, scan, resource, path)))
+        archive.close()
+        writer.finish()
+
+class ChunkedWriter(io.RawIOBase):
+    """Non-seekable file object that sends everything written as HTTP chunks."""
+
+    def __init__(self, wfile, server):
+        self.wfile = wfile
+        self.server = server
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if data:
+            self.wfile.write(f"{len(data):x}\r\n".encode() + bytes(data) + b"\r\n")
+            self.server.count_bytes(len(data))
+        return len(data)
+
+    def finish(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+class MockXnatServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the synthetic project and request counters."""
+
+    daemon_threads = True
+
+    def __init__(self, address, project, latency=0.0, failure_rate=0.0):
+        super().__init__(address, MockXnatHandler)
+        self.project = project
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(1)
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+
+    def should_fail(self):
+        """Decide whether to drop the current file or zip download, counting each drop."""
+        with self._lock:
+            if not self.failure_rate or self.random.random() >= self.failure_rate:
+                return False
+            self.requests['dropped'] += 1
+            return True
+
+    def count_bytes(self, nbytes):
+        with self._lock:
+            self.bytes_sent += nbytes
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests.clear()
+            self.bytes_sent = 0
+
+    def start(self):
+        """Serve requests from a background thread."""
+        thread = threading.Thread(target=self.serve_forever, name='mock-xnat', daemon=True)
+        thread.start()
+        return self
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local mock XNAT server with a synthetic project')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--project', default='BENCH', help='Project ID')
+    parser.add_argument('--subjects', type=int, default=2, help='Number of subjects')
+    parser.add_argument('--sessions', type=int, default=1, help='Sessions per subject')
+    parser.add_argument('--scans', type=int, default=4, help='Scans per session')
+    parser.add_argument('--files', type=int, default=100, help='DICOM files per scan')
+    parser.add_argument('--file-size', type=int, default=256, help='File size in KiB')
+    parser.add_argument('--latency', type=float, default=0.0, help='Extra delay per request in milliseconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of file and zip downloads cut off halfway')
+    args = parser.parse_args()
+
+    project = SyntheticProject(args.project, args.subjects, args.sessions, args.scans, args.files,
+                               args.file_size * 1024)
+    server = MockXnatServer((args.host, args.port), project, args.latency / 1000, args.failure_rate)
+    print(f"Mock XNAT serving project {args.project} at {server.url} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
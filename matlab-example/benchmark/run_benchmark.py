@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""
+Download throughput benchmark for the XNAT scripts.
+
+Starts the mock XNAT server from mock_xnat_server.py with a synthetic project
+and runs the real scripts against it end to end, each in its own process:
+session-download-v1.py, session-resources-v1.py and the 4_download_session.py
+template. For every scenario it reports wall time, MB/s and files/s written,
+the number of REST requests by kind, and the peak memory of the client process.
+
+Examples:
+    python run_benchmark.py
+    python run_benchmark.py --subjects 4 --scans 6 --files 200 --file-size 512 --repeat 3
+    python run_benchmark.py --scenarios download download-stream --latency 20 --json results.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from mock_xnat_server import MockXnatServer, SyntheticProject
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+SESSION_DOWNLOAD = BENCHMARK_DIR.parent / 'session-download-v1.py'
+SESSION_RESOURCES = BENCHMARK_DIR.parent / 'session-resources-v1.py'
+TEMPLATE_SESSION = BENCHMARK_DIR.parent.parent / '4_download_session.py'
+
+USER = 'benchmark'  # The mock server accepts any credentials but reports this user as logged in
+
+# Scenario name -> (script, extra arguments)
+SCENARIOS = {
+    'download': (SESSION_DOWNLOAD, []),
+    'download-stream': (SESSION_DOWNLOAD, ['--stream']),
+    'download-jobs4': (SESSION_DOWNLOAD, ['--stream', '--jobs', '4']),
+    'download-async': (SESSION_DOWNLOAD, ['--async-downloads']),
+    'resources': (SESSION_RESOURCES, []),
+    'template-session': (TEMPLATE_SESSION, []),
+    'template-session-stream': (TEMPLATE_SESSION, ['--stream']),
+}
+
+def scenario_command(name, server, work_dir):
+    """Build the command line that runs a scenario against the mock server."""
+    script, extra = SCENARIOS[name]
+    project = server.project
+    subjects = [subject['label'] for subject in project.subjects.values()]
+
+    if script == TEMPLATE_SESSION:
+        # The template has its server and credentials as constants, so it is driven through this file
+        return [sys.executable, __file__, '--run-template', server.url, project.project_id,
+                str(work_dir / 'output'), *extra]
+
+    command = [sys.executable, str(script), '--logs-dir', str(work_dir / 'logs'),
+               '--download-dir', str(work_dir / 'output'), '--server-url', server.url,
+               '--api-token-id', USER, '--api-token-secret', USER, '--project-id', project.project_id,
+               '--subjects', *subjects]
+    if script == SESSION_RESOURCES:
+        sessions = sorted({experiment['label'].split('_', 1)[1] for experiment in project.experiments.values()})
+        command += ['--sessions', *sessions, '--resource-name', project.resource_name]
+    return command + extra
+
+def run_template(server_url, project_id, output_dir, stream):
+    """Run download_session from 4_download_session.py against server_url (child process entry point)."""
+    spec = importlib.util.spec_from_file_location('download_session_template', TEMPLATE_SESSION)
+    template = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(template)
+    template.DEFAULT_SERVER = server_url
+    template.DEFAULT_TOKEN = template.DEFAULT_SECRET = USER
+    template.download_session(project_id, output_dir=output_dir, stream=stream)
+
+def directory_size(path):
+    """Return (number of files, total bytes) below path."""
+    files = total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            total += os.path.getsize(os.path.join(root, name))
+    return files, total
+
+def run_scenario(name, server):
+    """Run one scenario in a fresh directory and return its measurements."""
+    with tempfile.TemporaryDirectory(prefix=f"xnat-bench-{name}-") as tmp:
+        work_dir = Path(tmp)
+        (work_dir / 'logs').mkdir()
+        server.reset_counters()
+
+        with open(work_dir / 'output.log', 'w') as log:
+            start = time.perf_counter()
+            process = subprocess.Popen(scenario_command(name, server, work_dir), cwd=work_dir,
+                                       stdout=log, stderr=subprocess.STDOUT)
+            # wait4 reports the resource usage of this child alone
+            _, status, usage = os.wait4(process.pid, 0)
+            elapsed = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        if process.returncode != 0:
+            tail = (work_dir / 'output.log').read_text(errors='replace').splitlines()[-15:]
+            raise RuntimeError(f"Scenario {name} exited with {process.returncode}:\n" + '\n'.join(tail))
+
+        files, nbytes = directory_size(work_dir / 'output')
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        return {
+            'scenario': name, 'seconds': elapsed, 'files': files, 'bytes': nbytes,
+            'mb_per_s': nbytes / 1e6 / elapsed, 'files_per_s': files / elapsed,
+            'requests': sum(server.requests.values()), 'requests_by_kind': dict(server.requests),
+            'bytes_served': server.bytes_sent, 'peak_rss_mb': peak_rss / 1e6,
+        }
+
+def summarise(runs):
+    """Combine repeated runs of a scenario, using the median run time."""
+    median = sorted(runs, key=lambda run: run['seconds'])[len(runs) // 2]
+    return dict(median, runs=len(runs), seconds_all=[round(run['seconds'], 3) for run in runs],
+                seconds_stdev=statistics.stdev(run['seconds'] for run in runs) if len(runs) > 1 else 0.0)
+
+def print_table(results):
+    print(f"\n{'Scenario':<26}{'Time (s)':>10}{'MB/s':>9}{'Files/s':>10}{'Files':>8}{'Requests':>10}{'Peak RSS (MB)':>15}")
+    print('-' * 88)
+    for result in results:
+        print(f"{result['scenario']:<26}{result['seconds']:>10.2f}{result['mb_per_s']:>9.1f}"
+              f"{result['files_per_s']:>10.0f}{result['files']:>8}{result['requests']:>10}{result['peak_rss_mb']:>15.1f}")
+    print("\nRequests by kind:")
+    for result in results:
+        kinds = ', '.join(f"{kind}={count}" for kind, count in sorted(result['requests_by_kind'].items()))
+        print(f"  {result['scenario']}: {kinds}")
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--run-template':
+        server_url, project_id, output_dir = sys.argv[2:5]
+        run_template(server_url, project_id, output_dir, stream='--stream' in sys.argv[5:])
+        return
+
+    parser = argparse.ArgumentParser(description='Benchmark the XNAT download scripts against a local mock server')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS),
+                        help='Scenarios to run (default: all)')
+    parser.add_argument('--subjects', type=int, default=2, help='Number of subjects')
+    parser.add_argument('--sessions', type=int, default=1, help='Sessions per subject')
+    parser.add_argument('--scans', type=int, default=4, help='Scans per session')
+    parser.add_argument('--files', type=int, default=100, help='DICOM files per scan')
+    parser.add_argument('--file-size', type=int, default=256, help='File size in KiB')
+    parser.add_argument('--resource-files', type=int, default=20, help='Files in each session resource')
+    parser.add_argument('--latency', type=float, default=0.0, help='Extra server delay per request in milliseconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of file and zip downloads the server cuts off halfway')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per scenario; the median is reported')
+    parser.add_argument('--json', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    project = SyntheticProject(subjects=args.subjects, sessions=args.sessions, scans=args.scans, files=args.files,
+                               file_size=args.file_size * 1024, resource_files=args.resource_files)
+    server = MockXnatServer(('127.0.0.1', 0), project, args.latency / 1000, args.failure_rate).start()
+    print(f"Mock XNAT at {server.url}: {args.subjects} subjects x {args.sessions} sessions x {args.scans} scans "
+          f"x {args.files} files of {args.file_size} KiB")
+
+    results = []
+    try:
+        for name in args.scenarios:
+            print(f"Running {name}...", flush=True)
+            try:
+                results.append(summarise([run_scenario(name, server) for _ in range(args.repeat)]))
+            except RuntimeError as e:
+                print(f"  {e}")
+    finally:
+        server.shutdown()
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'parameters': vars(args), 'results': results}, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+if __name__ == '__main__':
+    main()
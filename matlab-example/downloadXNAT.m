@@ -7,7 +7,31 @@ function status = downloadXNAT(varargin)
     p.addParameter('test', false, @islogical);
     p.addParameter('subjects', {}, @iscell);
     p.addParameter('sessions', {}, @iscell);
+    p.addParameter('scan_types', {}, @iscell);    % Only scans whose type contains one of these
     p.addParameter('resource', '', @ischar);  % New parameter for resource name
+    p.addParameter('include', {}, @iscell);   % Only resource files matching these glob patterns
+    p.addParameter('exclude', {}, @iscell);   % Resource files to leave out (default: README etc.)
+    p.addParameter('jobs', 1, @isnumeric);    % Scans downloaded in parallel per session
+    p.addParameter('workers', 1, @isnumeric); % Worker processes sharing the subjects
+    p.addParameter('largest_first', false, @islogical); % Start the largest scans of a session first
+    p.addParameter('stream', false, @islogical); % Extract DICOM while downloading, no temp copy
+    p.addParameter('sync', false, @islogical);   % Only fetch missing or changed files
+    p.addParameter('verify', false, @islogical); % Check every file against the server's checksums
+    p.addParameter('cache', false, @islogical);  % Cache XNAT metadata on disk between runs
+    p.addParameter('async', false, @islogical);  % Fetch files concurrently over pooled connections
+    p.addParameter('refresh', false, @islogical); % Ignore previously cached metadata
+    p.addParameter('retries', 5, @isnumeric);     % Attempts per download, with growing delays
+    p.addParameter('profile', false, @islogical); % Log time and REST calls per phase
+    p.addParameter('store', '', @ischar);         % Blob store shared between download folders
+    p.addParameter('convert', false, @islogical); % Convert scans to NIfTI while downloading
+    p.addParameter('archive', false, @islogical); % One packed .dcmpack file per scan
+    p.addParameter('index', false, @islogical);   % Index DICOM headers in dicom_headers.sqlite
+    p.addParameter('persistent', false, @islogical); % Run in a Python worker kept alive between calls
+    p.addParameter('reuse', false, @islogical);   % Reuse the XNAT login of earlier runs
+    p.addParameter('queue', '', @ischar);         % Work queue directory shared with other nodes
+    p.addParameter('plan', '', @ischar);          % Only size the download and write a plan file
+    p.addParameter('execute_plan', '', @ischar);  % Download the scans of a plan file
+    p.addParameter('mirror', false, @islogical);  % Only sessions changed since the last mirror run
     p.parse(varargin{:});
     
     % Verify config is provided
@@ -28,61 +52,18 @@ function status = downloadXNAT(varargin)
         mkdir(downloadDir);
     end
     
-    % Find conda command
-    if ismac || isunix
-        conda_paths = {
-            fullfile(getenv('HOME'), 'miniconda3', 'bin', 'conda'),
-            fullfile(getenv('HOME'), 'anaconda3', 'bin', 'conda'),
-            '/usr/local/bin/conda',
-            'conda'  % try system path as fallback
-        };
-    else  % Windows
-        conda_paths = {
-            fullfile(getenv('USERPROFILE'), 'miniconda3', 'Scripts', 'conda.exe'),
-            fullfile(getenv('USERPROFILE'), 'anaconda3', 'Scripts', 'conda.exe'),
-            'conda.exe'  % try system path as fallback
-        };
-    end
-    
-    % Find working conda command
-    conda_cmd = '';
-    for i = 1:length(conda_paths)
-        if ismac || isunix
-            [status, ~] = system([conda_paths{i} ' --version']);
-        else
-            [status, ~] = system(['"' conda_paths{i} '" --version']);
-        end
-        if status == 0
-            conda_cmd = conda_paths{i};
-            break;
-        end
-    end
-    
-    if isempty(conda_cmd)
-        error('Conda not found. Please install Miniconda or Anaconda');
-    end
-    
-    % Try to use conda environment
-    [status, ~] = system([conda_cmd ' run -n xnat_env python --version']);
-    if status == 0
-        python_cmd = [conda_cmd ' run -n xnat_env python'];
-    else
-        error(['Conda environment ''xnat_env'' not found. ', ...
-               'Please run setup_xnat_env() first']);
-    end
-    
     % Choose which Python script to use based on whether resource is specified
     if ~isempty(p.Results.resource)
-        pythonScript = fullfile(scriptDir, 'session-resources-v1.py');
+        scriptName = 'session-resources-v1.py';
     else
-        pythonScript = fullfile(scriptDir, 'session-download-v1.py');
+        scriptName = 'session-download-v1.py';
     end
     
-    % Build the command string
-    cmd = sprintf(['%s "%s" --logs-dir "%s" --download-dir "%s" ' ...
+    % Build the argument string
+    cmd = sprintf(['--logs-dir "%s" --download-dir "%s" ' ...
                   '--server-url "%s" --api-token-id "%s" ' ...
                   '--api-token-secret "%s" --project-id "%s" '], ...
-        python_cmd, pythonScript, logsDir, downloadDir, ...
+        logsDir, downloadDir, ...
         p.Results.config.server_url, ...
         p.Results.config.api_token_id, ...
         p.Results.config.api_token_secret, ...
@@ -93,6 +74,118 @@ function status = downloadXNAT(varargin)
         cmd = sprintf('%s --resource-name "%s" ', cmd, p.Results.resource);
     end
     
+    % Add include/exclude patterns if specified (resource downloads only)
+    if ~isempty(p.Results.resource) && ~isempty(p.Results.include)
+        cmd = [cmd '--include'];
+        for i = 1:length(p.Results.include)
+            cmd = sprintf('%s "%s"', cmd, p.Results.include{i});
+        end
+        cmd = [cmd ' '];
+    end
+    if ~isempty(p.Results.resource) && ~isempty(p.Results.exclude)
+        cmd = [cmd '--exclude'];
+        for i = 1:length(p.Results.exclude)
+            cmd = sprintf('%s "%s"', cmd, p.Results.exclude{i});
+        end
+        cmd = [cmd ' '];
+    end
+    
+    % Add parallel scan downloads if requested (DICOM downloads only)
+    if isempty(p.Results.resource) && p.Results.jobs > 1
+        cmd = sprintf('%s--jobs %d ', cmd, p.Results.jobs);
+    end
+    
+    % Add worker processes if requested (DICOM downloads only)
+    if isempty(p.Results.resource) && p.Results.workers > 1
+        cmd = sprintf('%s--workers %d ', cmd, p.Results.workers);
+    end
+    
+    % Start the largest scans first if requested (DICOM downloads only)
+    if isempty(p.Results.resource) && p.Results.largest_first
+        cmd = [cmd '--largest-first '];
+    end
+    
+    % Add streaming extraction if requested (DICOM downloads only; resources are always streamed)
+    if isempty(p.Results.resource) && p.Results.stream
+        cmd = [cmd '--stream '];
+    end
+    
+    % Add per-file sync if requested (DICOM downloads only)
+    if isempty(p.Results.resource) && p.Results.sync
+        cmd = [cmd '--sync '];
+    end
+    
+    % Verify checksums while downloading if requested
+    if p.Results.verify
+        cmd = [cmd '--verify '];
+    end
+    
+    % Add metadata cache options if requested
+    if p.Results.cache
+        cmd = [cmd '--metadata-cache '];
+        if p.Results.refresh
+            cmd = [cmd '--refresh '];
+        end
+    end
+    
+    % Reuse the XNAT session of earlier runs if requested
+    if p.Results.reuse
+        cmd = [cmd '--reuse-session '];
+    end
+    
+    % Add the asyncio download engine if requested
+    if p.Results.async
+        cmd = [cmd '--async-downloads '];
+    end
+    
+    % Add the number of download attempts if it differs from the default
+    if p.Results.retries ~= 5
+        cmd = sprintf('%s--retries %d ', cmd, p.Results.retries);
+    end
+    
+    % Add the content-addressed blob store if requested
+    if ~isempty(p.Results.store)
+        cmd = sprintf('%s--blob-store "%s" ', cmd, p.Results.store);
+    end
+    
+    % Add NIfTI conversion if requested (DICOM downloads only)
+    if isempty(p.Results.resource) && p.Results.convert
+        cmd = [cmd '--convert '];
+    end
+    
+    % Add packed scan archives if requested (DICOM downloads only)
+    if isempty(p.Results.resource) && p.Results.archive
+        cmd = [cmd '--archive '];
+    end
+    
+    % Share the scans through a work queue if requested (DICOM downloads only)
+    if isempty(p.Results.resource) && ~isempty(p.Results.queue)
+        cmd = sprintf('%s--queue "%s" ', cmd, p.Results.queue);
+    end
+    
+    % Write a plan instead of downloading, or download a plan (DICOM downloads only)
+    if isempty(p.Results.resource) && ~isempty(p.Results.plan)
+        cmd = sprintf('%s--plan "%s" ', cmd, p.Results.plan);
+    end
+    if isempty(p.Results.resource) && ~isempty(p.Results.execute_plan)
+        cmd = sprintf('%s--execute-plan "%s" ', cmd, p.Results.execute_plan);
+    end
+    
+    % Keep the download folder a mirror of the project (DICOM downloads only)
+    if isempty(p.Results.resource) && p.Results.mirror
+        cmd = [cmd '--mirror '];
+    end
+    
+    % Add the DICOM header index if requested (DICOM downloads only)
+    if isempty(p.Results.resource) && p.Results.index
+        cmd = [cmd '--header-index '];
+    end
+    
+    % Add phase profiling if requested
+    if p.Results.profile
+        cmd = [cmd '--profile '];
+    end
+    
     % Add test flag if requested
     if p.Results.test
         cmd = [cmd '--test '];
@@ -114,8 +207,13 @@ function status = downloadXNAT(varargin)
         end
     end
     
-    % Display the command being run
-    fprintf('Executing command: %s\n', cmd);
+    % Add scan types if specified (DICOM downloads only)
+    if isempty(p.Results.resource) && ~isempty(p.Results.scan_types)
+        cmd = [cmd '--scan-types '];
+        for i = 1:length(p.Results.scan_types)
+            cmd = [cmd p.Results.scan_types{i} ' '];
+        end
+    end
     
     % Delete any existing done file and log file
     done_file = fullfile(logsDir, 'download_complete');
@@ -127,19 +225,30 @@ function status = downloadXNAT(varargin)
         delete(log_file);
     end
     
-    % Run the command with real-time output
-    if ispc
-        [status, output] = system(cmd);  % Windows doesn't support async output well
-        fprintf('%s\n', output);
+    if p.Results.persistent
+        % Hand the download to the worker, which is already logged in to XNAT
+        fprintf('Sending %s job to the XNAT worker\n', scriptName);
+        status = runInWorker(scriptDir, logsDir, scriptName, cmd);
     else
-        % For Mac/Linux, use system with echo
-        cmd = [cmd ' 2>&1'];  % Redirect stderr to stdout
-        [status, ~] = system(cmd, '-echo');  % Use -echo to show output in real time
+        cmd = sprintf('%s "%s" %s', findPython(), fullfile(scriptDir, scriptName), cmd);
+        
+        % Display the command being run
+        fprintf('Executing command: %s\n', cmd);
         
-        % Check the log file for any output
-        if exist(log_file, 'file')
-            fprintf('\nLog file contents:\n');
-            type(log_file);
+        % Run the command with real-time output
+        if ispc
+            [status, output] = system(cmd);  % Windows doesn't support async output well
+            fprintf('%s\n', output);
+        else
+            % For Mac/Linux, use system with echo
+            cmd = [cmd ' 2>&1'];  % Redirect stderr to stdout
+            [status, ~] = system(cmd, '-echo');  % Use -echo to show output in real time
+            
+            % Check the log file for any output
+            if exist(log_file, 'file')
+                fprintf('\nLog file contents:\n');
+                type(log_file);
+            end
         end
     end
     
@@ -149,4 +258,128 @@ function status = downloadXNAT(varargin)
     else
         fprintf('XNAT download completed successfully.\n');
     end
-end
\ No newline at end of file
+end
+
+function python_cmd = findPython()
+    % FINDPYTHON Return the command that runs Python in the xnat_env conda environment
+
+    % Find conda command
+    if ismac || isunix
+        conda_paths = {
+            fullfile(getenv('HOME'), 'miniconda3', 'bin', 'conda'),
+            fullfile(getenv('HOME'), 'anaconda3', 'bin', 'conda'),
+            '/usr/local/bin/conda',
+            'conda'  % try system path as fallback
+        };
+    else  % Windows
+        conda_paths = {
+            fullfile(getenv('USERPROFILE'), 'miniconda3', 'Scripts', 'conda.exe'),
+            fullfile(getenv('USERPROFILE'), 'anaconda3', 'Scripts', 'conda.exe'),
+            'conda.exe'  % try system path as fallback
+        };
+    end
+    
+    % Find working conda command
+    conda_cmd = '';
+    for i = 1:length(conda_paths)
+        if ismac || isunix
+            [status, ~] = system([conda_paths{i} ' --version']);
+        else
+            [status, ~] = system(['"' conda_paths{i} '" --version']);
+        end
+        if status == 0
+            conda_cmd = conda_paths{i};
+            break;
+        end
+    end
+    
+    if isempty(conda_cmd)
+        error('Conda not found. Please install Miniconda or Anaconda');
+    end
+    
+    % Try to use conda environment
+    [status, ~] = system([conda_cmd ' run -n xnat_env python --version']);
+    if status == 0
+        python_cmd = [conda_cmd ' run -n xnat_env python'];
+    else
+        error(['Conda environment ''xnat_env'' not found. ', ...
+               'Please run setup_xnat_env() first']);
+    end
+end
+
+function status = runInWorker(scriptDir, logsDir, scriptName, args)
+    % RUNINWORKER Run a download in the persistent Python worker, starting it if needed
+    %   The worker (xnat_worker.py) stays logged in to XNAT between calls. Its
+    %   port and access token are kept in logs/worker.json.
+    infoFile = fullfile(logsDir, 'worker.json');
+    [client, token] = connectWorker(infoFile);
+    if isempty(client)
+        workerLog = fullfile(logsDir, 'worker.log');
+        if exist(infoFile, 'file')
+            delete(infoFile);
+        end
+        % Let the worker write its own log instead of conda collecting its output
+        python_cmd = strrep(findPython(), ' run -n ', ' run --no-capture-output -n ');
+        workerCmd = sprintf('%s "%s" --info-file "%s" > "%s" 2>&1', ...
+            python_cmd, fullfile(scriptDir, 'xnat_worker.py'), infoFile, workerLog);
+        fprintf('Starting the XNAT worker (log: %s)\n', workerLog);
+        if ispc
+            system(['start "xnat_worker" /B ' workerCmd]);
+        else
+            system([workerCmd ' &']);
+        end
+        
+        % Wait for the worker to write its port and token
+        for attempt = 1:120
+            pause(0.5);
+            [client, token] = connectWorker(infoFile);
+            if ~isempty(client)
+                break;
+            end
+        end
+        if isempty(client)
+            error('The XNAT worker did not start; see %s', workerLog);
+        end
+    end
+    
+    request = struct('token', token, 'id', 1, 'action', 'download', ...
+                     'script', scriptName, 'arguments', args);
+    writeline(client, jsonencode(request));
+    
+    % Print the log lines of the job until it is done
+    status = 1;
+    while true
+        line = readline(client);
+        if isempty(line)
+            continue;  % Read timeout; the job is still running
+        end
+        message = jsondecode(char(line));
+        if strcmp(message.event, 'log')
+            fprintf('%s\n', message.message);
+        elseif strcmp(message.event, 'done')
+            status = message.exit_code;
+            fprintf('Worker finished the job in %.1f seconds\n', message.seconds);
+            break;
+        elseif strcmp(message.event, 'error')
+            error('XNAT worker: %s', message.message);
+        end
+    end
+    clear client;
+end
+
+function [client, token] = connectWorker(infoFile)
+    % CONNECTWORKER Connect to a running worker; returns an empty client if there is none
+    client = [];
+    token = '';
+    if ~exist(infoFile, 'file')
+        return;
+    end
+    try
+        info = jsondecode(fileread(infoFile));
+        client = tcpclient('127.0.0.1', info.port, 'ConnectTimeout', 5, 'Timeout', 3600);
+        configureTerminator(client, 'LF');
+        token = info.token;
+    catch
+        client = [];
+    end
+end
@@ -2,7 +2,6 @@
 
 # Import required libraries
 import time
-import xnat          # For connecting to and downloading from XNAT server
 import os           # For operating system operations
 import shutil       # For file operations like moving files
 from pathlib import Path  # For cross-platform path handling
@@ -10,6 +9,28 @@ import tempfile     # For creating temporary directories
 import argparse     # For parsing command line arguments
 import logging
 import sys
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed  # For parallel downloads
+import requests     # HTTP library used by xnat, needed to size its connection pool
+from xnat_transfer import (  # Streaming zip extraction and per-file sync
+    download_file, download_resource_zip, find_stale_files, flat_dicom_destination, list_resource_files)
+from xnat_cache import DEFAULT_CACHE_DIR, DEFAULT_TTL, install_metadata_cache  # On-disk metadata cache
+from xnat_connection import open_session  # XNAT login, optionally reusing the session of an earlier run
+from xnat_async import DEFAULT_CONNECTIONS, AsyncTransferEngine  # Optional asyncio download engine
+from xnat_retry import RetryPolicy  # Backoff with jitter for failed downloads
+from xnat_metrics import TransferMetrics, format_bytes  # Throughput measurements and run reports
+from xnat_profile import Profiler  # Phase timing and request accounting for --profile
+from xnat_blobstore import BlobStore  # Content-addressed store of downloaded files
+from xnat_convert import DEFAULT_PROCESSES, ConversionPool  # Background DICOM to NIfTI conversion
+from xnat_headers import HeaderIndex  # SQLite index of the downloaded DICOM headers
+from xnat_archive import COMPRESSIONS, archive_path, find_stale_members, pack_directory, read_index  # Packed scans
+from xnat_queue import DEFAULT_LEASE, WorkQueue  # Work queue shared by processes on several nodes
+from xnat_schedule import (  # Largest-first ordering of parallel scan downloads
+    ThroughputModel, largest_first, log_summary, lpt_shares, predict_makespan, resource_size, scan_resources, summarize)
+from xnat_checksums import ChecksumManifest, refetch_mismatches  # Checksums computed while downloading
+from xnat_plan import (  # Dry-run download plans
+    RequestCounter, build_plan, local_state, log_plan, planned_scans, read_plan, recent_throughput, write_plan)
+from xnat_mirror import MirrorState, changed_sessions, list_project_sessions, new_watermark  # Incremental project mirrors
 
 # Default lists for subjects and sessions
 DEFAULT_SUBJECTS = [
@@ -28,13 +49,86 @@ parser.add_argument('--project-id', required=True, help='XNAT project ID')
 parser.add_argument('--test', action='store_true', help='Run in test mode')
 parser.add_argument('--subjects', nargs='+', help='List of subject IDs to download')
 parser.add_argument('--sessions', nargs='+', help='List of session labels to download')
+parser.add_argument('--scan-types', nargs='+', help='Only download scans whose type contains one of these (e.g. T1w bold)')
+parser.add_argument('--jobs', type=int, default=1, help='Number of scans to download in parallel within a session')
+parser.add_argument('--stream', action='store_true', help='Extract DICOM files straight from the download stream instead of via a temporary directory')
+parser.add_argument('--sync', action='store_true', help='Compare each scan with the server file catalog and only fetch missing or changed files')
+parser.add_argument('--verify', '--verify-checksums', dest='verify', action='store_true', help='Hash every file while it downloads, compare it with the MD5 checksum in the XNAT catalog, fetch mismatching files again and keep the verified checksums in each scan folder, so later runs check scans against the catalog without hashing them again. Implies --sync, with MD5 checksums compared as well as sizes')
+parser.add_argument('--metadata-cache', action='store_true', help='Cache project/subject/session/scan metadata on disk between runs')
+parser.add_argument('--cache-dir', default=str(DEFAULT_CACHE_DIR), help='Directory of the metadata cache and of reused sessions')
+parser.add_argument('--cache-ttl', type=float, default=DEFAULT_TTL, help='Seconds before cached metadata is fetched again')
+parser.add_argument('--refresh', action='store_true', help='Ignore metadata cached by earlier runs')
+parser.add_argument('--reuse-session', action='store_true', help='Keep the XNAT session cookie in the cache directory and reuse it in later runs instead of logging in again')
+parser.add_argument('--async-downloads', action='store_true', help='Fetch DICOM files with the asyncio engine over a shared pool of keep-alive connections (needs aiohttp)')
+parser.add_argument('--connections', type=int, default=DEFAULT_CONNECTIONS, help='Connections to the server used by --async-downloads')
+parser.add_argument('--workers', type=int, default=1, help='Number of worker processes, each downloading a share of the subjects over its own connection')
+parser.add_argument('--profile', action='store_true', help='Time each phase, count REST requests per phase and write a trace file to the logs directory')
+parser.add_argument('--cprofile', action='store_true', help='With --profile, also run the main thread under cProfile')
+parser.add_argument('--retries', type=int, default=5, help='Attempts per scan download before giving up')
+parser.add_argument('--progress-interval', type=float, default=10, help='Seconds between progress lines with throughput and ETA (0 to disable)')
+parser.add_argument('--blob-store', help='Keep each file once in this content-addressed store and hardlink it into the download directory; files already stored are not downloaded again')
+parser.add_argument('--convert', action='store_true', help='Convert each scan to NIfTI in background processes as soon as its files are in place (needs pydicom, numpy and nibabel)')
+parser.add_argument('--convert-processes', type=int, default=DEFAULT_PROCESSES, help='Number of processes converting scans with --convert')
+parser.add_argument('--archive', action='store_true', help='Write each scan as one indexed scan-<id>_<type>.dcmpack file instead of a directory of DICOM files')
+parser.add_argument('--archive-compression', choices=COMPRESSIONS, default='none', help='Compression of the files in --archive scans (zstd needs the zstandard package)')
+parser.add_argument('--header-index', action='store_true', help='Index selected DICOM header tags of every downloaded scan in dicom_headers.sqlite in the download directory (needs pydicom)')
+parser.add_argument('--queue', help='Work queue directory on shared storage: the first process lists one item per scan into it and every process started with the same queue claims scans until none are left')
+parser.add_argument('--queue-lease', type=float, default=DEFAULT_LEASE, help='Seconds after which a claimed scan of a process that stopped renewing it goes back to the queue')
+parser.add_argument('--largest-first', action='store_true', help='Read the size of every scan before a session is downloaded and start the largest scans first, logging the predicted and actual time of each session')
+parser.add_argument('--plan', metavar='PLAN_FILE', help='Do not download: list and size the selected scans, compare them with the download directory, estimate the time and write all of it to PLAN_FILE')
+parser.add_argument('--execute-plan', metavar='PLAN_FILE', help='Download exactly the scans marked for download in a plan written by --plan (--subjects, --sessions and --scan-types are taken from the plan)')
+parser.add_argument('--mirror', action='store_true', help='Keep the download directory a mirror of the project: list the sessions with their modification times in one request and only open the sessions changed since the last complete mirror run (all subjects unless --subjects is given)')
+parser.add_argument('--retry-delay', type=float, default=2.0, help='Base delay in seconds between attempts, doubled after every failure (with random jitter)')
 
 args = parser.parse_args()
+if args.jobs < 1:
+    parser.error('--jobs must be at least 1')
+if args.workers < 1:
+    parser.error('--workers must be at least 1')
+if args.retries < 1:
+    parser.error('--retries must be at least 1')
+if args.convert_processes < 1:
+    parser.error('--convert-processes must be at least 1')
+if args.queue_lease < 10:
+    parser.error('--queue-lease must be at least 10 seconds')
+if args.plan and args.execute_plan:
+    parser.error('--plan and --execute-plan cannot be combined')
+if args.execute_plan and args.queue:
+    parser.error('--execute-plan cannot be combined with --queue')
+if args.mirror and (args.plan or args.execute_plan or args.queue or args.test):
+    parser.error('--mirror cannot be combined with --plan, --execute-plan, --queue or --test')
+
+# Retry policy of all downloads: only dropped connections, timeouts and server errors are retried
+retry_policy = RetryPolicy(max_attempts=args.retries, base_delay=args.retry_delay)
+
+# Bytes, files and time of every scan, session and subject downloaded by this process
+metrics = TransferMetrics()
+
+# Phase spans and request counts, collected only with --profile
+profiler = Profiler(enabled=args.profile)
+
+# Download time per scan size, fitted to the scans downloaded so far, for --largest-first predictions
+throughput = ThroughputModel()
+
+# Content-addressed store the downloaded files are hardlinked from, with --blob-store
+blob_store = BlobStore(args.blob_store) if args.blob_store else None
+
+# Shared asyncio transfer engine of this process, set while a download runs with --async-downloads
+async_engine = None
+
+# Pool converting finished scans to NIfTI, set while a download runs with --convert
+converter = None
 
 # Use the provided directories
 log_file = os.path.join(args.logs_dir, 'download.log')
 DOWNLOAD_BASE_DIR = Path(args.download_dir)
 
+# DICOM header index of the download directory, with --header-index
+try:
+    header_index = HeaderIndex(DOWNLOAD_BASE_DIR) if args.header_index else None
+except RuntimeError as e:
+    parser.error(str(e))
+
 # Set up logging
 logging.basicConfig(
     level=logging.INFO,
@@ -74,6 +168,89 @@ def check_existing_scan(scan_dir, scan):
             
     return False
 
+def check_existing_archive(archive, scan):
+    """Check if the archive of a scan holds all of its files, reading only the archive index."""
+    if not archive.exists():
+        return False
+    try:
+        members = len(read_index(archive)['members'])
+    except ValueError as e:
+        logging.warning(f"      Cannot read {archive}, downloading the scan again: {str(e)}")
+        return False
+    
+    total_files = len(scan.files.values())
+    if members == total_files:
+        logging.info(f"      Scan {scan.id} already exists with {members} DICOM file(s) in {archive.name}")
+        return True
+    return False
+
+def scan_selected(scan):
+    """Check if a scan's type matches --scan-types (all scans match without it)."""
+    return not args.scan_types or any(scan_type in (scan.type or '') for scan_type in args.scan_types)
+
+def count_local_dicoms(scan_dir):
+    """Return the number of DICOM files of a scan already in the download directory."""
+    if args.archive:
+        try:
+            return len(read_index(archive_path(scan_dir))['members'])
+        except (OSError, ValueError):
+            return 0
+    return len(list(scan_dir.glob('*.dcm'))) if scan_dir.exists() else 0
+
+def list_dicom_catalog(resource):
+    """Return the server-side catalog entries of the DICOM files in a resource."""
+    return [entry for entry in list_resource_files(args.server_url, resource) if entry['name'].endswith('.dcm')]
+
+def find_stale_dicom_files(scan_dir, scan):
+    """Compare the server's DICOM file catalog with the local scan directory.
+    Returns the missing or changed files, or None if the whole scan should be downloaded."""
+    local_copy = archive_path(scan_dir) if args.archive else scan_dir
+    if 'DICOM' not in scan.resources or not local_copy.exists():
+        return None
+    
+    catalog = list_dicom_catalog(scan.resources['DICOM'])
+    if args.archive:
+        # Archives keep the MD5 of every member in their index
+        try:
+            stale_files = find_stale_members(catalog, read_index(local_copy), verify_checksums=args.verify)
+        except ValueError as e:
+            logging.warning(f"      Cannot read {local_copy}, downloading the scan again: {str(e)}")
+            return None
+    else:
+        # Checksums stored by --verify are used for files that did not change since; the others are hashed once
+        manifest = ChecksumManifest(scan_dir) if args.verify else None
+        stale_files = find_stale_files(catalog, scan_dir, verify_checksums=args.verify, manifest=manifest)
+        if manifest is not None:
+            manifest.save()
+    
+    if not stale_files:
+        logging.info(f"      Scan {scan.id} is in sync with {len(catalog)} DICOM file(s)")
+    elif len(stale_files) * 2 > len(catalog):
+        # Most files are missing, so one zip download is cheaper than fetching files one by one
+        logging.info(f"      Scan {scan.id} is missing {len(stale_files)}/{len(catalog)} files, downloading whole scan")
+        return None
+    else:
+        logging.info(f"      Scan {scan.id} is missing or has changed {len(stale_files)}/{len(catalog)} files")
+    return stale_files
+
+def link_stored_dicom_files(resource, scan_dir, stale_files=None):
+    """Hardlink the DICOM files whose content is already in the blob store into scan_dir.
+    Returns the catalog entries that still have to be downloaded, or None if nothing of the scan was stored."""
+    with profiler.span('metadata'):
+        catalog = stale_files if stale_files is not None else list_dicom_catalog(resource)
+    with profiler.span('dedup'):
+        remaining = blob_store.link_entries([(entry, scan_dir / entry['name']) for entry in catalog])
+    unlinked = {entry['name'] for entry, _ in remaining}
+    for entry in catalog:
+        if entry['name'] not in unlinked:
+            metrics.record_file(scan_dir / entry['name'], entry['size'])
+    linked = len(catalog) - len(remaining)
+    if linked:
+        logging.info(f"      Linked {linked}/{len(catalog)} DICOM files from the blob store")
+    elif stale_files is None:
+        return None  # Download the whole scan as one zip
+    return [entry for entry, _ in remaining]
+
 def move_files_from_download(temp_dir, target_dir, scan_label):
     """Move files from XNAT's directory structure to our desired location."""
     # Find all DICOM files in the temporary directory
@@ -84,30 +261,290 @@ def move_files_from_download(temp_dir, target_dir, scan_label):
     moved_files = 0
     for filepath in dicom_files:
         if filepath.is_file():
+            nbytes = filepath.stat().st_size
             shutil.move(str(filepath), str(target_dir / filepath.name))
+            metrics.record_file(target_dir / filepath.name, nbytes)
             moved_files += 1
     logging.info(f"      Moved {moved_files}/{num_files} DICOM files to {target_dir}")
 
+def connect_to_xnat():
+    """Open a connection to the XNAT server using the command line credentials."""
+    with profiler.span('connect'):
+        session = open_session(args.server_url, args.api_token_id, args.api_token_secret,
+                               reuse=args.reuse_session, cache_dir=args.cache_dir)
+    metrics.count_file_responses(session)
+    profiler.instrument(session)
+    
+    # Serve repeated metadata requests from the on-disk cache (a mirror run needs the current listings)
+    if args.metadata_cache:
+        install_metadata_cache(session, args.server_url, args.cache_dir, args.cache_ttl, args.refresh or args.mirror,
+                               pool_maxsize=max(args.jobs, requests.adapters.DEFAULT_POOLSIZE))
+    # Give every parallel scan download its own pooled connection to the server
+    elif args.jobs > 1:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.jobs)
+        session.interface.mount('https://', adapter)
+        session.interface.mount('http://', adapter)
+    return session
+
+@contextmanager
+def transfer_engine(session):
+    """Run the enclosed downloads with the asyncio engine if --async-downloads is set."""
+    global async_engine
+    if not args.async_downloads:
+        yield
+        return
+    
+    with AsyncTransferEngine(session, args.connections, retry_policy, metrics.add_bytes,
+                             profiler.count_transfer_request, metrics.record_file) as async_engine:
+        logging.info(f"Using the async download engine with {args.connections} connections")
+        try:
+            yield
+        finally:
+            async_engine = None
+
+@contextmanager
+def conversion_stage(enabled=True):
+    """Convert scans to NIfTI in background processes while the enclosed downloads run, if --convert is set.
+    Leaving the block waits for the conversions still running."""
+    global converter
+    if not (args.convert and enabled):
+        yield
+        return
+    
+    with ConversionPool(args.convert_processes) as converter:
+        logging.info(f"Converting finished scans to NIfTI with {args.convert_processes} processes")
+        try:
+            yield
+        finally:
+            converter = None
+
+def download_subjects(project, subject_ids, sessions, planned=None):
+    """Download the given subjects. Returns the lists of processed and failed subject IDs.
+    With planned (from --execute-plan) only the planned scans of each subject are downloaded."""
+    total_subjects = len(subject_ids)
+    processed_subjects = []
+    failed_subjects = []
+    
+    for subject_id in subject_ids:
+        with profiler.span('metadata'):
+            subject = project.subjects[subject_id] if subject_id in project.subjects else None
+        if subject is not None:
+            try:
+                process_subject(subject, sessions, planned[subject_id] if planned is not None else None)
+                processed_subjects.append(subject_id)
+                logging.info(f"Successfully processed subject {subject_id} ({len(processed_subjects)}/{total_subjects})")
+            except Exception as e:
+                failed_subjects.append(subject_id)
+                logging.error(f"Failed to process subject {subject_id}: {str(e)}")
+        else:
+            failed_subjects.append(subject_id)
+            logging.warning(f"\nWarning: Subject {subject_id} not found in project")
+    
+    return processed_subjects, failed_subjects
+
+def download_subject_share(subject_ids, sessions, planned=None):
+    """Worker process entry point: download a share of the subjects over a dedicated connection.
+    Returns the processed and failed subject IDs and the worker's metrics and profile."""
+    # Start from empty measurements: a forked or reused worker process may still hold earlier ones
+    global metrics, profiler
+    metrics = TransferMetrics()
+    profiler = Profiler(enabled=args.profile)
+    with conversion_stage(), connect_to_xnat() as session, transfer_engine(session), \
+            metrics.progress(args.progress_interval, label=f"worker {os.getpid()}"):
+        project = session.projects[args.project_id]
+        processed, failed = download_subjects(project, subject_ids, sessions, planned)
+    return processed, failed, metrics.export(), profiler.export()
+
+def download_subjects_in_workers(subject_ids, sessions, planned=None):
+    """Spread the subjects over a pool of worker processes and collect their results.
+    Raises an error if any worker did not finish, so no completion marker is written."""
+    num_workers = min(args.workers, len(subject_ids))
+    if planned is not None:
+        # The plan knows the size of every subject: give every worker a similar number of bytes
+        sizes = [sum(sum(scans.values()) for scans in planned[subject_id].values()) for subject_id in subject_ids]
+        shares = lpt_shares(subject_ids, sizes, num_workers)
+    else:
+        # Deal subjects out round-robin so every worker gets a similar share
+        shares = [subject_ids[i::num_workers] for i in range(num_workers)]
+    logging.info(f"Downloading {len(subject_ids)} subjects with {num_workers} worker processes")
+    
+    processed_subjects = []
+    failed_subjects = []
+    crashed_workers = 0
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = {pool.submit(download_subject_share, share, sessions, planned): share for share in shares}
+        for future in as_completed(futures):
+            share = futures[future]
+            try:
+                processed, failed, worker_metrics, worker_profile = future.result()
+                metrics.merge(worker_metrics)
+                profiler.merge(worker_profile)
+                processed_subjects.extend(processed)
+                failed_subjects.extend(failed)
+            except Exception as e:
+                crashed_workers += 1
+                failed_subjects.extend(share)
+                logging.error(f"Worker for subjects {share} failed: {str(e)}")
+    
+    return processed_subjects, failed_subjects, crashed_workers
+
+def list_queue_items(project, subject_ids, sessions):
+    """Yield one work queue item per scan of the given subjects and sessions."""
+    for subject_id in subject_ids:
+        with profiler.span('metadata'):
+            subject = project.subjects[subject_id] if subject_id in project.subjects else None
+            experiments = list(subject.experiments.values()) if subject is not None else []
+        if subject is None:
+            logging.warning(f"\nWarning: Subject {subject_id} not found in project")
+            continue
+        for experiment in experiments:
+            if sessions and not any(session in experiment.label for session in sessions):
+                continue
+            with profiler.span('metadata'):
+                scans = list(experiment.scans.values())
+            for scan in filter(scan_selected, scans):
+                yield {'subject': subject.label, 'session': experiment.label, 'experiment': experiment.id,
+                       'scan': scan.id, 'type': scan.type}
+
+def download_queue_items(project, queue, list_items):
+    """Claim scans from the work queue with --jobs threads and download them until every item is finished.
+    Returns the numbers of scans finished and failed by this process."""
+    experiments = {}
+    
+    def find_scan(item):
+        key = (item['subject'], item['experiment'])
+        with profiler.span('metadata'):
+            if key not in experiments:
+                experiments[key] = project.subjects[item['subject']].experiments[item['experiment']]
+            return experiments[key].scans[item['scan']]
+    
+    def work():
+        finished = failed = 0
+        while True:
+            claim = queue.claim()
+            if claim is None:
+                if queue.finished():
+                    return finished, failed
+                # Take over listing the items if the process doing it stopped
+                if queue.stalled():
+                    queue.fill(list_items)
+                queue.wait()
+                continue
+            item = claim.item
+            start = time.time()
+            try:
+                session_dir = DOWNLOAD_BASE_DIR / item['subject'] / item['session']
+                session_dir.mkdir(parents=True, exist_ok=True)
+                metrics.expect(1)
+                download_scan_if_needed(find_scan(item), session_dir)
+                queue.complete(claim, seconds=round(time.time() - start, 1))
+                finished += 1
+            except Exception as e:
+                logging.error(f"Failed to process scan {item['scan']} of {item['subject']}/{item['session']}: {str(e)}")
+                queue.fail(claim, str(e))
+                failed += 1
+    
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        results = [future.result() for future in [pool.submit(work) for _ in range(args.jobs)]]
+    return sum(finished for finished, _ in results), sum(failed for _, failed in results)
+
+def download_queue_share(subject_ids, sessions):
+    """Worker process entry point for --queue: claim scans over a dedicated connection.
+    Returns the finished and failed counts and the worker's metrics and profile."""
+    global metrics, profiler
+    metrics = TransferMetrics()
+    profiler = Profiler(enabled=args.profile)
+    with conversion_stage(), connect_to_xnat() as session, transfer_engine(session), \
+            metrics.progress(args.progress_interval, label=f"worker {os.getpid()}"):
+        project = session.projects[args.project_id]
+        queue = WorkQueue(args.queue, args.queue_lease)
+        finished, failed = download_queue_items(
+            project, queue, lambda: list_queue_items(project, subject_ids, sessions))
+    return finished, failed, metrics.export(), profiler.export()
+
+def download_from_queue(project, subject_ids, sessions):
+    """Fill the work queue unless another process did, then claim scans from it here
+    or in --workers processes. Returns the numbers of scans finished and failed by this run."""
+    queue = WorkQueue(args.queue, args.queue_lease)
+    added = queue.fill(lambda: list_queue_items(project, subject_ids, sessions))
+    if added:
+        logging.info(f"Listed {added} scans into the work queue {args.queue}")
+    else:
+        logging.info(f"Working on the work queue {args.queue} filled by another process")
+    
+    if args.workers == 1:
+        return download_queue_items(project, queue, lambda: list_queue_items(project, subject_ids, sessions))
+    
+    finished = failed = crashed_workers = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(download_queue_share, subject_ids, sessions) for _ in range(args.workers)]
+        for future in as_completed(futures):
+            try:
+                worker_finished, worker_failed, worker_metrics, worker_profile = future.result()
+                metrics.merge(worker_metrics)
+                profiler.merge(worker_profile)
+                finished += worker_finished
+                failed += worker_failed
+            except Exception as e:
+                crashed_workers += 1
+                logging.error(f"Queue worker failed: {str(e)}")
+    if crashed_workers:
+        # Their claims go back to the queue once their leases run out
+        raise RuntimeError(f"{crashed_workers} worker process(es) did not finish")
+    return finished, failed
+
 def download_project_data(test_mode=False, subjects=None, sessions=None):
     """Download all subject data from the specified project."""
+    global throughput
     # Use provided lists or fall back to defaults
     subjects_to_download = subjects if subjects else DEFAULT_SUBJECTS
     sessions_to_download = sessions if sessions else DEFAULT_SESSIONS
     
+    # A plan fixes the subjects, sessions and scans to download
+    plan = planned = None
+    if args.execute_plan:
+        plan = read_plan(args.execute_plan)
+        if plan['project'] != args.project_id or plan['server'].rstrip('/') != args.server_url.rstrip('/'):
+            raise ValueError(f"Plan {args.execute_plan} was made for project {plan['project']} on {plan['server']}")
+        planned = planned_scans(plan)
+        subjects_to_download = list(planned)
+        sessions_to_download = []
+        logging.info(f"Executing plan {args.execute_plan} of {plan['created']}: "
+                     f"{plan['totals']['download_scans']} scans, estimated {plan['estimate']['seconds']:.0f}s")
+    if args.largest_first or plan is not None or args.mirror:
+        # Predict session times from the scans of the last run until this run has measured its own
+        throughput, _ = recent_throughput(args.logs_dir)
+    start = time.time()
+    
     logging.info(f"Starting download from XNAT server: {args.server_url}")
-    logging.info(f"Subjects to process: {subjects_to_download}")
+    if args.mirror:
+        logging.info(f"Mirroring the sessions changed since the last complete run of "
+                     f"{', '.join(args.subjects) if args.subjects else 'all subjects'}")
+    else:
+        logging.info(f"Subjects to process: {subjects_to_download}")
     if sessions_to_download:
         logging.info(f"Sessions to process: {sessions_to_download}")
     else:
         logging.info("Processing all available sessions")
+    if args.jobs > 1:
+        logging.info(f"Downloading up to {args.jobs} scans in parallel per session")
     
     # Connect to XNAT server using credentials
-    with xnat.connect(args.server_url, user=args.api_token_id, password=args.api_token_secret) as session:
-        project = session.projects[args.project_id]
+    # Worker processes report their own progress and convert their own scans
+    progress_interval = args.progress_interval if args.workers == 1 else 0
+    with conversion_stage(enabled=args.workers == 1 or test_mode), connect_to_xnat() as session, \
+            transfer_engine(session), metrics.progress(progress_interval):
+        with profiler.span('metadata'):
+            project = session.projects[args.project_id]
         logging.info(f"Connected to project: {project.id}")
         
         create_clean_dir(DOWNLOAD_BASE_DIR)
         
+        # Only the sessions changed since the last complete mirror run are opened
+        if args.mirror:
+            mirror, planned, watermark = mirror_changes(session, project, sessions_to_download)
+            subjects_to_download = list(planned)
+        
         # In test mode, only process the first available subject
         if test_mode:
             first_subject = next(iter(project.subjects.values()))
@@ -115,32 +552,81 @@ def download_project_data(test_mode=False, subjects=None, sessions=None):
             logging.info("\nTest download completed!")
             return
         
-        # Process each specified subject
-        total_subjects = len(subjects_to_download)
-        processed_subjects = 0
-        failed_subjects = []
+        # Share the scans with every process working on the same queue
+        if args.queue:
+            finished, failed = download_from_queue(project, subjects_to_download, sessions_to_download)
+            logging.info("\n=== Download Summary ===")
+            logging.info(f"Scans finished by this run: {finished}, failed: {failed}")
+            counts = WorkQueue(args.queue, args.queue_lease).counts()
+            logging.info(f"Work queue: {counts['done']} scans done, {counts['failed']} failed")
+            if counts['failed']:
+                logging.warning(f"Failed scans are listed in {Path(args.queue) / 'failed'}")
+            return
         
-        for subject_id in subjects_to_download:
-            if subject_id in project.subjects:
-                try:
-                    process_subject(project.subjects[subject_id], sessions_to_download)
-                    processed_subjects += 1
-                    logging.info(f"Successfully processed subject {subject_id} ({processed_subjects}/{total_subjects})")
-                except Exception as e:
-                    failed_subjects.append(subject_id)
-                    logging.error(f"Failed to process subject {subject_id}: {str(e)}")
-            else:
-                failed_subjects.append(subject_id)
-                logging.warning(f"\nWarning: Subject {subject_id} not found in project")
+        # Process each specified subject, either here or spread over worker processes
+        total_subjects = len(subjects_to_download)
+        crashed_workers = 0
+        if args.workers > 1 and subjects_to_download:
+            processed_subjects, failed_subjects, crashed_workers = download_subjects_in_workers(
+                subjects_to_download, sessions_to_download, planned)
+        else:
+            processed_subjects, failed_subjects = download_subjects(
+                project, subjects_to_download, sessions_to_download, planned)
         
         # Log summary
         logging.info("\n=== Download Summary ===")
-        logging.info(f"Total subjects processed: {processed_subjects}/{total_subjects}")
+        logging.info(f"Total subjects processed: {len(processed_subjects)}/{total_subjects}")
         if failed_subjects:
             logging.warning(f"Failed subjects: {failed_subjects}")
+        log_summary(summarize(metrics.export()['records']))
+        if plan is not None:
+            logging.info(f"Plan estimated {plan['estimate']['seconds']:.1f}s, the download took {time.time() - start:.1f}s")
+        if crashed_workers:
+            raise RuntimeError(f"{crashed_workers} worker process(es) did not finish")
+        if args.mirror:
+            # Move the watermark only when nothing is left to download below it
+            incomplete = [record for record in metrics.export()['records'] if record['status'] in ('failed', 'incomplete')]
+            if failed_subjects or incomplete:
+                logging.warning("Some sessions were not downloaded completely; the next mirror run looks at them again")
+            elif watermark[0] is not None:
+                mirror.save(*watermark)
+                logging.info(f"Mirror is up to date with the changes until {watermark[0]}")
 
-def process_subject(subject, sessions):
-    """Process a single subject's data."""
+def mirror_changes(session, project, sessions):
+    """List the selected sessions changed since the last complete mirror run and size their selected scans.
+    Returns the mirror state, the scans to download ({subject: {experiment ID: {scan ID: bytes}}})
+    and the watermark (with the sessions at it) to store once they are downloaded."""
+    selection = {'subjects': args.subjects or [], 'sessions': sessions, 'scan_types': args.scan_types or []}
+    mirror = MirrorState(DOWNLOAD_BASE_DIR, args.server_url, args.project_id, selection)
+    watermark, at_watermark = mirror.watermark()
+    with profiler.span('metadata'):
+        rows = list_project_sessions(session.interface, args.server_url, args.project_id)
+    rows = [row for row in rows if (not args.subjects or row['subject'] in args.subjects)
+            and (not sessions or any(label in row['label'] for label in sessions))]
+    changed = changed_sessions(rows, watermark, at_watermark)
+    if watermark is None:
+        logging.info(f"No earlier mirror run: checking all {len(rows)} sessions")
+    else:
+        logging.info(f"{len(changed)}/{len(rows)} sessions changed since {watermark}")
+    
+    planned = {}
+    for row in changed:
+        with profiler.span('metadata'):
+            experiment = project.subjects[row['subject']].experiments[row['id']]
+            scans = [scan for scan in experiment.scans.values() if scan_selected(scan)]
+            # One resource listing per scan holds its DICOM size, for the largest-first order
+            with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+                listings = list(pool.map(scan_resources, scans))
+        planned.setdefault(row['subject'], {})[row['id']] = {
+            scan.id: resources['DICOM'][1] for scan, resources in zip(scans, listings) if 'DICOM' in resources}
+    
+    if rows and not any(row['modified'] for row in rows):
+        logging.warning("The server lists no modification times; every mirror run checks all sessions")
+    return mirror, planned, new_watermark(rows, watermark, at_watermark)
+
+def process_subject(subject, sessions, planned=None):
+    """Process a single subject's data. With planned ({experiment ID: {scan ID: bytes}})
+    only the planned sessions and scans are downloaded."""
     logging.info(f"\nProcessing subject: {subject.label}")
     subject_dir = DOWNLOAD_BASE_DIR / subject.label
     create_clean_dir(subject_dir)
@@ -149,84 +635,383 @@ def process_subject(subject, sessions):
     total_sessions = 0
     processed_sessions = 0
     
-    for experiment in subject.experiments.values():
-        # If sessions list is empty, process all sessions
-        # Otherwise, only process sessions that match the specified session labels
-        if not sessions or any(session in experiment.label for session in sessions):
-            try:
-                process_session(experiment, subject_dir)
-                processed_sessions += 1
-            except Exception as e:
-                logging.error(f"Failed to process session {experiment.label}: {str(e)}")
-            total_sessions += 1
+    with profiler.span('metadata'):
+        experiments = list(subject.experiments.values())
+    
+    with metrics.measure('subject', subject_dir, subject=subject.label) as subject_span:
+        for experiment in experiments:
+            # If sessions list is empty, process all sessions
+            # Otherwise, only process sessions that match the specified session labels
+            if planned is not None:
+                selected = experiment.id in planned
+            else:
+                selected = not sessions or any(session in experiment.label for session in sessions)
+            if selected:
+                try:
+                    with metrics.measure('session', subject_dir / experiment.label,
+                                         subject=subject.label, session=experiment.label) as session_span:
+                        if process_session(experiment, subject_dir, session_span,
+                                           planned[experiment.id] if planned is not None else None):
+                            session_span.status = 'incomplete'
+                    processed_sessions += 1
+                except Exception as e:
+                    logging.error(f"Failed to process session {experiment.label}: {str(e)}")
+                total_sessions += 1
+        if processed_sessions < total_sessions:
+            subject_span.status = 'incomplete'
     
     logging.info(f"Completed subject {subject.label}: {processed_sessions}/{total_sessions} sessions processed")
 
-def process_session(experiment, subject_dir):
-    """Process a single session's data."""
+def download_scan_if_needed(scan, session_dir):
+    """Download a scan unless it already exists locally. Returns False if it was skipped.
+    The bytes, files and time of the scan are recorded in the run metrics."""
+    scan_dir = session_dir / f"scan-{scan.id}_{scan.type}"
+    # With --archive the scan is one file next to where its directory would be
+    scan_output = archive_path(scan_dir) if args.archive else scan_dir
+    with metrics.measure('scan', scan_output, subject=session_dir.parent.name, session=session_dir.name,
+                         scan=scan.id, type=scan.type) as span:
+        stale_files = None
+        with profiler.span('skip-check'):
+            # --verify implies --sync
+            if args.sync or args.verify:
+                stale_files = find_stale_dicom_files(scan_dir, scan)
+                skip = stale_files == []
+            elif args.archive:
+                skip = check_existing_archive(scan_output, scan)
+            else:
+                skip = check_existing_scan(scan_dir, scan)
+        if skip:
+            span.status = 'skipped'
+        else:
+            process_scan(scan, session_dir, stale_files)
+            span.status = 'downloaded'
+    
+    # The files are in place: index their headers while they are still cached, and convert them
+    # in the background while the next scans download
+    if header_index is not None:
+        index_scan_headers(scan_output, session_dir, scan)
+    if converter is not None:
+        converter.submit(scan_output)
+    return not skip
+
+def index_scan_headers(scan_output, session_dir, scan):
+    """Add the DICOM headers of a scan to the header index. Failures are logged, not raised."""
+    try:
+        with profiler.span('index'):
+            indexed = header_index.index_scan(scan_output, session_dir.parent.name, session_dir.name, scan.id, scan.type)
+        if indexed:
+            logging.info(f"      Indexed the headers of {indexed} DICOM files of scan {scan.id}")
+    except Exception as e:
+        logging.warning(f"      Could not index the headers of scan {scan.id}: {str(e)}")
+
+def size_scans(scans):
+    """Read the DICOM size of every scan from the server, --jobs scans at a time. Returns a dict by scan ID."""
+    def size(scan):
+        with profiler.span('metadata'):
+            return resource_size(scan)
+    
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        return dict(zip([scan.id for scan in scans], pool.map(size, scans)))
+
+def download_scan_measured(scan, session_dir, nbytes):
+    """Download a scan like download_scan_if_needed and add its time to the throughput model."""
+    start = time.time()
+    downloaded = download_scan_if_needed(scan, session_dir)
+    if downloaded:
+        throughput.observe(nbytes, time.time() - start)
+    return downloaded
+
+def process_session(experiment, subject_dir, session_span=None, planned=None):
+    """Process a single session's data. Returns the IDs of the scans that failed.
+    With planned ({scan ID: bytes}) only those scans are downloaded, largest first.
+    With --largest-first or a plan the predicted and actual download times are stored in session_span."""
     logging.info(f"  Processing session: {experiment.label}")
     session_dir = subject_dir / experiment.label
     create_clean_dir(session_dir)
     
     # Process each scan in the session
-    total_scans = len(experiment.scans)
+    with profiler.span('metadata'):
+        scans = list(experiment.scans.values())
+    if planned is not None:
+        scans = [scan for scan in scans if scan.id in planned]
+    else:
+        scans = [scan for scan in scans if scan_selected(scan)]
+    total_scans = len(scans)
+    metrics.expect(total_scans)
     processed_scans = 0
     skipped_scans = 0
     failed_scans = []
     
-    for scan in experiment.scans.values():
-        try:
-            scan_dir = session_dir / f"scan-{scan.id}_{scan.type}"
-            if check_existing_scan(scan_dir, scan):
-                skipped_scans += 1
-                continue
-                
-            process_scan(scan, session_dir)
-            processed_scans += 1
-        except Exception as e:
-            failed_scans.append(scan.id)
-            logging.error(f"Failed to process scan {scan.id}: {str(e)}")
+    scheduled = args.largest_first or planned is not None
+    if scheduled:
+        # Start the largest scans first, so no large scan is left downloading alone at the end
+        sizes = planned if planned is not None else size_scans(scans)
+        scans = largest_first(scans, [sizes[scan.id] for scan in scans])
+        predicted = predict_makespan([throughput.predict(sizes[scan.id]) for scan in scans], args.jobs)
+        logging.info(f"  Downloading {total_scans} scans ({format_bytes(sum(sizes.values()))}) largest first, "
+                     f"predicted {predicted:.1f}s at {throughput.describe()}")
+    start = time.time()
+    
+    # The pool size caps the number of scans (and so requests) in flight at once
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        if scheduled:
+            futures = {pool.submit(download_scan_measured, scan, session_dir, sizes[scan.id]): scan for scan in scans}
+        else:
+            futures = {pool.submit(download_scan_if_needed, scan, session_dir): scan for scan in scans}
+        for future in as_completed(futures):
+            scan = futures[future]
+            try:
+                if future.result():
+                    processed_scans += 1
+                else:
+                    skipped_scans += 1
+            except Exception as e:
+                failed_scans.append(scan.id)
+                logging.error(f"Failed to process scan {scan.id}: {str(e)}")
     
     logging.info(f"  Session {experiment.label} complete: {processed_scans} processed, {skipped_scans} skipped, {len(failed_scans)} failed out of {total_scans} total scans")
+    if scheduled:
+        actual = time.time() - start
+        logging.info(f"  Session {experiment.label} scans took {actual:.1f}s, predicted {predicted:.1f}s")
+        if session_span is not None:
+            session_span.details.update(predicted_seconds=round(predicted, 3), scan_seconds=round(actual, 3))
     if failed_scans:
         logging.warning(f"  Failed scans in session: {failed_scans}")
+    return failed_scans
 
-def process_scan(scan, fmri_dir):
-    """Process a single scan's data."""
-    logging.info(f"    Processing scan: {scan.id} ({scan.type})")
+def download_dicom_files(scan, scan_dir, stale_files=None, on_written=None):
+    """Download the DICOM files of a scan into scan_dir.
+    If stale_files is given, only those catalog entries are fetched.
+    With on_written(path, md5) every file is hashed while it is written."""
+    with profiler.span('metadata'):
+        resource = scan.resources['DICOM']
+    if blob_store is not None:
+        # Files whose checksum is in the store are linked instead of downloaded
+        stale_files = link_stored_dicom_files(resource, scan_dir, stale_files)
+        if stale_files == []:
+            return
     
-    # Create directory for this specific scan
-    scan_dir = fmri_dir / f"scan-{scan.id}_{scan.type}"
-    create_clean_dir(scan_dir)
+    if async_engine is not None:
+        # Fetch the files that are not on disk yet, many at once over the engine's shared connections
+        if stale_files is None:
+            with profiler.span('metadata'):
+                stale_files = find_stale_files(list_dicom_catalog(resource), scan_dir)
+        with profiler.span('transfer'):
+            async_engine.download_files([(entry['url'], scan_dir / entry['name']) for entry in stale_files], on_written)
+        logging.info(f"      Fetched {len(stale_files)} DICOM files to {scan_dir}")
+        return
+    
+    if stale_files:
+        # Fetch only the files that are missing or changed locally
+        with profiler.span('transfer'):
+            for entry in stale_files:
+                download_file(resource.xnat_session.interface, entry['url'], scan_dir / entry['name'], on_written,
+                              metrics.record_file)
+        logging.info(f"      Fetched {len(stale_files)} missing or changed DICOM files to {scan_dir}")
+        return
+    
+    if args.stream or on_written is not None:
+        # Write each .dcm file straight from the zip stream into the scan directory (and hash it on the way)
+        with profiler.span('transfer'):
+            written = download_resource_zip(args.server_url, resource, flat_dicom_destination(scan_dir), on_written,
+                                            metrics.record_file)
+        logging.info(f"      Streamed {len(written)} DICOM files to {scan_dir}")
+        return
     
     # Use temporary directory for download
     with tempfile.TemporaryDirectory() as temp_dir:
-        if 'DICOM' in scan.resources:
-            max_retries = 5
-            retry_count = 0
-            while retry_count < max_retries:
-                try:
-                    if retry_count == 0:
-                        logging.info(f"      Downloading DICOM files...")
-                    else:
-                        logging.info(f"      Downloading DICOM files... (Attempt {retry_count + 1}/{max_retries})")
-                    temp_download_dir = Path(temp_dir) / "DICOM"
-                    scan.resources['DICOM'].download_dir(str(temp_download_dir))
-                    move_files_from_download(temp_download_dir, scan_dir, scan.type)
-                    logging.info(f"      Successfully downloaded scan {scan.id}")
-                    break
-                except Exception as e:
-                    retry_count += 1
-                    if retry_count == max_retries:
-                        logging.error(f"      Error downloading DICOM for scan {scan.id} after {max_retries} attempts: {str(e)}")
-                        raise
-                    else:
-                        logging.warning(f"      Download attempt {retry_count} failed: {str(e)}. Retrying in 5 seconds...")
-                        time.sleep(5)
+        temp_download_dir = Path(temp_dir) / "DICOM"
+        # The zip download inside download_dir is timed as transfer, the unzipping as extract
+        with profiler.span('extract'):
+            resource.download_dir(str(temp_download_dir))
+        with profiler.span('relocate'):
+            move_files_from_download(temp_download_dir, scan_dir, scan.type)
+
+def resume_dicom_files(scan, scan_dir, on_written=None):
+    """Continue a failed DICOM download, keeping the files that were already written."""
+    with profiler.span('metadata'):
+        resource = scan.resources['DICOM']
+        catalog = list_dicom_catalog(resource)
+    stale_files = find_stale_files(catalog, scan_dir)
+    if not stale_files:
+        logging.info(f"      All {len(catalog)} DICOM files are on disk")
+        return
+    
+    if async_engine is None and len(stale_files) > 1 and len(stale_files) * 2 > len(catalog):
+        # Most of the scan is missing: restart the zip, streamed so finished files are kept if it fails again
+        with profiler.span('transfer'):
+            written = download_resource_zip(args.server_url, resource, flat_dicom_destination(scan_dir), on_written,
+                                            metrics.record_file)
+        logging.info(f"      Streamed {len(written)} DICOM files to {scan_dir}")
+    else:
+        # Fetch the remaining files one by one; interrupted files continue with HTTP Range requests
+        download_dicom_files(scan, scan_dir, stale_files, on_written)
+
+def verify_dicom_files(scan, scan_dir, manifest):
+    """Compare the checksums of the files written to scan_dir with the server's catalog
+    and fetch the files that do not match again."""
+    with profiler.span('metadata'):
+        resource = scan.resources['DICOM']
+        downloads = [(entry, scan_dir / entry['name']) for entry in list_dicom_catalog(resource)]
+    with profiler.span('transfer'):
+        refetch_mismatches(manifest, downloads, lambda entry, destination: download_file(
+            resource.xnat_session.interface, entry['url'], destination, manifest.record, metrics.record_file))
+    verified = sum(1 for entry, destination in downloads if entry['digest'] and destination.name in manifest.written)
+    logging.info(f"      Verified the checksums of {verified}/{len(manifest.written)} written DICOM files")
+
+def download_scan_files(scan, scan_dir, stale_files=None):
+    """Download the DICOM files of a scan into scan_dir. If stale_files is given, only those files are fetched.
+    Failed attempts are retried with backoff and continue from the files already on disk.
+    With --verify the files are hashed while they are written and checked against the server's checksums."""
+    manifest = ChecksumManifest(scan_dir) if args.verify else None
+    on_written = manifest.record if manifest is not None else None
+    
+    def attempt_download(attempt):
+        if attempt == 1:
+            logging.info(f"      Downloading DICOM files...")
+            download_dicom_files(scan, scan_dir, stale_files, on_written)
+        else:
+            logging.info(f"      Resuming DICOM download... (Attempt {attempt}/{retry_policy.max_attempts})")
+            resume_dicom_files(scan, scan_dir, on_written)
+    
+    try:
+        retry_policy.run(attempt_download)
+        if manifest is not None:
+            verify_dicom_files(scan, scan_dir, manifest)
+            # Archives keep the checksums in their index instead
+            if not args.archive:
+                manifest.save()
+    except Exception as e:
+        logging.error(f"      Error downloading DICOM for scan {scan.id}: {str(e)}")
+        raise
+
+def download_scan_archive(scan, scan_dir, stale_files=None):
+    """Download a scan into a staging directory and pack it into the scan's archive.
+    If only stale_files are fetched, the other files of the existing archive are kept."""
+    archive = archive_path(scan_dir)
+    # Stage in the system temp directory (set TMPDIR to a local disk) so the small files never reach scan_dir's file system
+    with tempfile.TemporaryDirectory(prefix=f"{scan_dir.name}-") as staging:
+        download_scan_files(scan, Path(staging), stale_files)
+        with profiler.span('pack'):
+            members = pack_directory(staging, archive, args.archive_compression,
+                                     previous=archive if stale_files else None)
+    metrics.record_file(archive)
+    logging.info(f"      Packed {members} DICOM files into {archive}")
+    if blob_store is not None:
+        with profiler.span('dedup'):
+            blob_store.add(archive)
+
+def process_scan(scan, fmri_dir, stale_files=None):
+    """Process a single scan's data. If stale_files is given, only those files are fetched."""
+    logging.info(f"    Processing scan: {scan.id} ({scan.type})")
+    
+    # Create directory for this specific scan (with --archive it only names the archive)
+    scan_dir = fmri_dir / f"scan-{scan.id}_{scan.type}"
+    if not args.archive:
+        create_clean_dir(scan_dir)
+    
+    with profiler.span('metadata'):
+        has_dicom = 'DICOM' in scan.resources
+    if has_dicom:
+        if args.archive:
+            download_scan_archive(scan, scan_dir, stale_files)
+        else:
+            download_scan_files(scan, scan_dir, stale_files)
+            if blob_store is not None:
+                with profiler.span('dedup'):
+                    # Digests of the files hashed while they were written (with --verify) are reused
+                    added = blob_store.add_tree(scan_dir, ChecksumManifest(scan_dir).trusted_md5)
+                if added:
+                    logging.info(f"      Added {added} DICOM files to the blob store")
+        logging.info(f"      Successfully downloaded scan {scan.id}")
+
+def plan_scans(project, subject_ids, sessions):
+    """List and size the selected scans and compare them with the download directory.
+    Returns the plan entries and the subjects that were not found."""
+    entries = []
+    missing_subjects = []
+    for subject_id in subject_ids:
+        with profiler.span('metadata'):
+            subject = project.subjects[subject_id] if subject_id in project.subjects else None
+            experiments = list(subject.experiments.values()) if subject is not None else []
+        if subject is None:
+            missing_subjects.append(subject_id)
+            continue
+        for experiment in experiments:
+            if sessions and not any(session in experiment.label for session in sessions):
+                continue
+            with profiler.span('metadata'):
+                scans = [scan for scan in experiment.scans.values() if scan_selected(scan)]
+                # One resource listing per scan holds the file count and size of every resource
+                with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+                    listings = list(pool.map(scan_resources, scans))
+            session_dir = DOWNLOAD_BASE_DIR / subject.label / experiment.label
+            for scan, resources in zip(scans, listings):
+                if 'DICOM' not in resources:
+                    continue
+                files, nbytes = resources['DICOM']
+                local_files = count_local_dicoms(session_dir / f"scan-{scan.id}_{scan.type}")
+                state = local_state(local_files, files)
+                missing_files = max(0, files - local_files)
+                entries.append({'subject': subject.label, 'session': experiment.label, 'experiment': experiment.id,
+                                'scan': scan.id, 'type': scan.type, 'files': files, 'bytes': nbytes, 'local': state,
+                                'missing_files': missing_files,
+                                'missing_bytes': nbytes * missing_files // files if files else 0,
+                                'download': state != 'present'})
+        logging.info(f"Planned subject {subject.label}: {sum(1 for entry in entries if entry['subject'] == subject.label)} scans")
+    return entries, missing_subjects
+
+def plan_download(subjects=None, sessions=None):
+    """Size the selected scans without downloading them and write the plan to --plan."""
+    subjects_to_plan = subjects if subjects else DEFAULT_SUBJECTS
+    sessions_to_plan = sessions if sessions else DEFAULT_SESSIONS
+    logging.info(f"Planning download from XNAT server: {args.server_url}")
+    logging.info(f"Subjects to plan: {subjects_to_plan}")
+    
+    with connect_to_xnat() as session:
+        counter = RequestCounter(session)
+        with profiler.span('metadata'):
+            project = session.projects[args.project_id]
+        entries, missing_subjects = plan_scans(project, subjects_to_plan, sessions_to_plan)
+        requests_made = counter.count
+    
+    selection = {'subjects': subjects_to_plan, 'sessions': sessions_to_plan, 'scan_types': args.scan_types or []}
+    plan = build_plan(entries, selection, args.server_url, args.project_id, args.jobs, args.workers,
+                      args.logs_dir, requests_made, missing_subjects)
+    write_plan(args.plan, plan)
+    log_plan(plan)
+    logging.info(f"Plan written to {args.plan}; run with --execute-plan {args.plan} to download")
+
+def write_run_reports(status):
+    """Write the JSON run report and Prometheus metrics (and the profile with --profile) next to the completion marker."""
+    try:
+        schedule = summarize(metrics.export()['records'])
+        details = {'schedule': schedule} if schedule else {}
+        report = metrics.write_reports(args.logs_dir, status, project=args.project_id, server=args.server_url, **details)
+        totals = report['totals']
+        logging.info(f"Transferred {totals['files']} files ({totals['bytes'] / 1e6:.1f} MB) "
+                     f"at {totals['bytes_per_second'] / 1e6:.1f} MB/s; run report written to {args.logs_dir}")
+    except Exception as e:
+        logging.warning(f"Could not write run report: {str(e)}")
+    write_profile()
+
+def write_profile():
+    """Write the profile of the run into the logs directory (with --profile or --cprofile)."""
+    try:
+        profiler.write_results(args.logs_dir)
+    except Exception as e:
+        logging.warning(f"Could not write profile: {str(e)}")
 
 def main():
     try:
         start_time = time.time()
+        if args.cprofile:
+            profiler.start_cprofile()
+        if args.plan:
+            # Only look: no completion marker, and the last run report stays for the next estimate
+            plan_download(subjects=args.subjects, sessions=args.sessions)
+            write_profile()
+            sys.exit(0)
         logging.info("\nStarting download process...")
         download_project_data(
             test_mode=args.test,
@@ -235,6 +1020,7 @@ def main():
         )
         end_time = time.time()
         logging.info(f"\nDownload process completed successfully! Time taken: {end_time - start_time:.2f} seconds")
+        write_run_reports('complete')
         
         # Create done file to signal completion
         with open(os.path.join(args.logs_dir, 'download_complete'), 'w') as f:
@@ -243,6 +1029,7 @@ def main():
         sys.exit(0)
     except Exception as e:
         logging.error(f"\nAn error occurred during download process: {str(e)}")
+        write_run_reports('failed')
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import time
-import xnat
 import os
 from pathlib import Path
 import tempfile
@@ -9,6 +8,25 @@ import argparse
 import logging
 import sys
 import shutil
+from pathlib import PurePosixPath
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from xnat_transfer import download_file, download_resource_zip, list_resource_files
+from xnat_async import DEFAULT_CONNECTIONS, AsyncTransferEngine
+from xnat_cache import DEFAULT_CACHE_DIR, DEFAULT_TTL, install_metadata_cache
+from xnat_connection import open_session
+from xnat_retry import RetryPolicy
+from xnat_metrics import TransferMetrics, format_bytes
+from xnat_profile import Profiler
+from xnat_selection import build_experiment_index, find_experiment, matches_any
+from xnat_blobstore import BlobStore
+from xnat_checksums import ChecksumManifest, refetch_mismatches
+
+# Files left out of every resource download unless --exclude is given
+DEFAULT_EXCLUDE = ['README', 'dataset_description.json', 'CHANGES']
+
+# The whole resource is fetched as one zip if the files it would transfer needlessly are less than this share of its bytes
+ZIP_WASTE_LIMIT = 0.1
 
 # Parse command line arguments
 parser = argparse.ArgumentParser()
@@ -21,8 +39,41 @@ parser.add_argument('--project-id', required=True, help='XNAT project ID')
 parser.add_argument('--subjects', nargs='+', help='List of subject IDs to download')
 parser.add_argument('--sessions', nargs='+', help='List of session labels to download')
 parser.add_argument('--resource-name', required=True, help='Name of resource folder to download')
+parser.add_argument('--metadata-cache', action='store_true', help='Cache project/session metadata on disk between runs')
+parser.add_argument('--cache-dir', default=str(DEFAULT_CACHE_DIR), help='Directory of the metadata cache and of reused sessions')
+parser.add_argument('--cache-ttl', type=float, default=DEFAULT_TTL, help='Seconds before cached metadata is fetched again')
+parser.add_argument('--refresh', action='store_true', help='Ignore metadata cached by earlier runs')
+parser.add_argument('--reuse-session', action='store_true', help='Keep the XNAT session cookie in the cache directory and reuse it in later runs instead of logging in again')
+parser.add_argument('--async-downloads', action='store_true', help='Fetch resource files with the asyncio engine over a shared pool of keep-alive connections (needs aiohttp)')
+parser.add_argument('--connections', type=int, default=DEFAULT_CONNECTIONS, help='Connections to the server used by --async-downloads')
+parser.add_argument('--include', nargs='+', help='Only download files matching one of these glob patterns (patterns with a / match the path in the download folder, others the file name)')
+parser.add_argument('--exclude', nargs='+', default=DEFAULT_EXCLUDE, help=f"Do not download files matching one of these glob patterns (default: {' '.join(DEFAULT_EXCLUDE)})")
+parser.add_argument('--verify', action='store_true', help='Hash every file while it downloads, compare it with the MD5 checksum in the XNAT catalog and fetch mismatching files again; verified files are not downloaded again by later runs')
+parser.add_argument('--jobs', type=int, default=4, help='Files fetched in parallel when only some files of a resource are downloaded')
+parser.add_argument('--progress-interval', type=float, default=10, help='Seconds between progress lines with throughput and ETA (0 to disable)')
+parser.add_argument('--profile', action='store_true', help='Time each phase, count REST requests per phase and write a trace file to the logs directory')
+parser.add_argument('--cprofile', action='store_true', help='With --profile, also run the main thread under cProfile')
+parser.add_argument('--retries', type=int, default=5, help='Attempts per resource download before giving up')
+parser.add_argument('--blob-store', help='Keep each file once in this content-addressed store and hardlink it into the download directory; files already stored are not downloaded again')
+parser.add_argument('--retry-delay', type=float, default=2.0, help='Base delay in seconds between attempts, doubled after every failure (with random jitter)')
 
 args = parser.parse_args()
+if args.retries < 1:
+    parser.error('--retries must be at least 1')
+if args.jobs < 1:
+    parser.error('--jobs must be at least 1')
+
+# Retry policy of all downloads: only dropped connections, timeouts and server errors are retried
+retry_policy = RetryPolicy(max_attempts=args.retries, base_delay=args.retry_delay)
+
+# Bytes, files and time of every session resource downloaded
+metrics = TransferMetrics(unit='session')
+
+# Phase spans and request counts, collected only with --profile
+profiler = Profiler(enabled=args.profile)
+
+# Content-addressed store the downloaded files are hardlinked from, with --blob-store
+blob_store = BlobStore(args.blob_store) if args.blob_store else None
 
 # Set up logging
 log_file = os.path.join(args.logs_dir, 'download.log')
@@ -83,87 +134,220 @@ def download_session_resources(session, resource_name, output_dir):
     else:
         logging.warning(f"Resource '{resource_name}' not found in session {session.label}")
 
+def resource_destination(parts, output_dir, file_rules):
+    """Map the path parts of a resource file to its place under output_dir.
+    file_rules is a pair of (include, exclude) glob patterns. Returns None for files that should not be kept."""
+    if 'files' not in parts:
+        return None
+    
+    # Get everything after 'files'
+    rel_parts = parts[parts.index('files')+1:]
+    
+    # Remove subject/session from path if they exist
+    if len(rel_parts) >= 2:
+        if rel_parts[0].startswith('sub-') and (
+            rel_parts[1].startswith('ses-') or 
+            rel_parts[1].startswith('ses_')
+        ):
+            rel_parts = rel_parts[2:]
+    if not rel_parts:
+        return None
+    
+    # Skip files left out by the include/exclude rules
+    include, exclude = file_rules
+    rel_path = PurePosixPath(*rel_parts)
+    if (include and not matches_any(rel_path, include)) or matches_any(rel_path, exclude or []):
+        return None
+    return output_dir / Path(*rel_parts)
+
+def catalog_downloads(catalog, output_dir, file_rules):
+    """Pair every kept file of a resource catalog with its destination under output_dir."""
+    downloads = []
+    for entry in catalog:
+        dest_path = resource_destination(('files',) + PurePosixPath(entry['path']).parts, output_dir, file_rules)
+        if dest_path is not None:
+            downloads.append((entry, dest_path))
+    return downloads
+
+def fetch_files(interface, downloads, on_written=None):
+    """Fetch (catalog entry, destination) pairs one file per request, --jobs at a time.
+    Files are renamed into place once complete, which also leaves blob store hardlinks untouched."""
+    def fetch(entry, dest_path):
+        with profiler.span('transfer'):
+            download_file(interface, entry['url'], dest_path, on_written, metrics.record_file)
+    
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for future in [pool.submit(fetch, entry, dest_path) for entry, dest_path in downloads]:
+            future.result()
+
+def download_experiment_resource(exp, output_dir, file_rules, engine=None, resume=False):
+    """Download the requested resource of an experiment into output_dir.
+    Only the files kept by file_rules are transferred: the rules and the path mapping are applied
+    to the server's file list first. With an async engine, the files are fetched over its shared connections.
+    With resume, files a failed attempt already completed are kept."""
+    with profiler.span('metadata'):
+        resource = exp.resources[args.resource_name] if args.resource_name in exp.resources else None
+    if resource is None:
+        logging.warning(f"Resource '{args.resource_name}' not found in session {exp.label}")
+        return
+    
+    logging.info(f"Downloading resource '{args.resource_name}' from session {exp.label}")
+    
+    # (catalog entry, destination) pairs of the files to keep
+    with profiler.span('metadata'):
+        catalog = list_resource_files(args.server_url, resource)
+    downloads = catalog_downloads(catalog, output_dir, file_rules)
+    total_bytes = sum(entry['size'] or 0 for entry in catalog)
+    kept_bytes = sum(entry['size'] or 0 for entry, _ in downloads)
+    if len(downloads) < len(catalog):
+        logging.info(f"Keeping {len(downloads)}/{len(catalog)} files ({format_bytes(kept_bytes)} of {format_bytes(total_bytes)})")
+    manifest = ChecksumManifest(output_dir) if args.verify else None
+    on_written = manifest.record if manifest is not None else None
+    if manifest is not None:
+        # Files verified by an earlier run and unchanged since are kept
+        remaining = [(entry, dest_path) for entry, dest_path in downloads
+                     if not entry['digest'] or manifest.trusted_md5(dest_path) != entry['digest'].lower()]
+        if len(remaining) < len(downloads):
+            logging.info(f"Keeping {len(downloads) - len(remaining)}/{len(downloads)} files already verified")
+        downloads = remaining
+    elif resume:
+        # Files with the size the catalog lists were completed by the failed attempt
+        remaining = [(entry, dest_path) for entry, dest_path in downloads
+                     if entry['size'] is None or not dest_path.is_file() or dest_path.stat().st_size != entry['size']]
+        if len(remaining) < len(downloads):
+            logging.info(f"Keeping {len(downloads) - len(remaining)}/{len(downloads)} files completed by the last attempt")
+        downloads = remaining
+    if blob_store is not None:
+        # Files whose checksum is in the store are linked instead of downloaded
+        with profiler.span('dedup'):
+            remaining = blob_store.link_entries(downloads)
+        unlinked = {dest_path for _, dest_path in remaining}
+        for entry, dest_path in downloads:
+            if dest_path not in unlinked:
+                metrics.record_file(dest_path, entry['size'])
+        linked = len(downloads) - len(remaining)
+        if linked:
+            logging.info(f"Linked {linked}/{len(downloads)} files from the blob store")
+        downloads = remaining
+    
+    fetched_bytes = sum(entry['size'] or 0 for entry, _ in downloads)
+    try:
+        if not downloads:
+            pass
+        elif engine is not None:
+            # Fetch the files concurrently over the engine's shared connections
+            with profiler.span('transfer'):
+                engine.download_files([(entry['url'], dest_path) for entry, dest_path in downloads], on_written)
+        elif len(downloads) > 1 and total_bytes - fetched_bytes <= total_bytes * ZIP_WASTE_LIMIT:
+            # (Nearly) every file is needed: one zip request, each kept member written straight to its destination
+            wanted = {dest_path for _, dest_path in downloads}
+            
+            def destination_for(name):
+                dest_path = resource_destination(PurePosixPath(name).parts, output_dir, file_rules)
+                return dest_path if dest_path in wanted else None
+            
+            with profiler.span('transfer'):
+                download_resource_zip(args.server_url, resource, destination_for, on_written, metrics.record_file)
+        else:
+            fetch_files(resource.xnat_session.interface, downloads, on_written)
+    except Exception:
+        if manifest is not None:
+            # Keep the digests of the files completed so far, so the next attempt checks them instead of fetching them
+            manifest.save()
+        raise
+    
+    if manifest is not None:
+        # Fetch the files whose checksum does not match the server's again, one by one
+        with profiler.span('transfer'):
+            refetch_mismatches(manifest, downloads, lambda entry, dest_path: download_file(
+                resource.xnat_session.interface, entry['url'], dest_path, on_written, metrics.record_file))
+        manifest.save()
+        if manifest.written:
+            logging.info(f"Verified the checksums of {len(manifest.written)} downloaded files")
+    if blob_store is not None:
+        with profiler.span('dedup'):
+            blob_store.add_tree(output_dir, manifest.trusted_md5 if manifest is not None else None)
+    logging.info(f"Successfully downloaded resource '{args.resource_name}'")
+
+def write_run_reports(status):
+    """Write the JSON run report and Prometheus metrics (and the profile with --profile) next to the completion marker."""
+    try:
+        report = metrics.write_reports(args.logs_dir, status, job='xnat_resource_download',
+                                       project=args.project_id, server=args.server_url, resource=args.resource_name)
+        totals = report['totals']
+        logging.info(f"Transferred {totals['files']} files ({totals['bytes'] / 1e6:.1f} MB) "
+                     f"at {totals['bytes_per_second'] / 1e6:.1f} MB/s; run report written to {args.logs_dir}")
+    except Exception as e:
+        logging.warning(f"Could not write run report: {str(e)}")
+    try:
+        profiler.write_results(args.logs_dir)
+    except Exception as e:
+        logging.warning(f"Could not write profile: {str(e)}")
+
 def main():
     try:
         start_time = time.time()
+        if args.cprofile:
+            profiler.start_cprofile()
         logging.info("\nStarting resource download process...")
         
         # Connect to XNAT
-        session = xnat.connect(args.server_url, user=args.api_token_id, password=args.api_token_secret)
-        project = session.projects[args.project_id]
+        with profiler.span('connect'):
+            session = open_session(args.server_url, args.api_token_id, args.api_token_secret,
+                                   reuse=args.reuse_session, cache_dir=args.cache_dir)
+        metrics.count_file_responses(session)
+        profiler.instrument(session)
+        if args.metadata_cache:
+            install_metadata_cache(session, args.server_url, args.cache_dir, args.cache_ttl, args.refresh,
+                                   pool_maxsize=max(args.jobs, requests.adapters.DEFAULT_POOLSIZE))
+        elif args.jobs > requests.adapters.DEFAULT_POOLSIZE:
+            # Give every parallel file download its own pooled connection to the server
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.jobs)
+            session.interface.mount('https://', adapter)
+            session.interface.mount('http://', adapter)
+        with profiler.span('metadata'):
+            project = session.projects[args.project_id]
         
         # Create base resource directory
         base_dir = Path(args.download_dir) / args.resource_name
         
-        # Files to exclude from download
-        exclude_files = {'README', 'dataset_description.json', 'CHANGES'}
+        # Include/exclude patterns applied to the file list of every resource before anything is fetched
+        file_rules = (args.include, args.exclude)
+        
+        # Resolve subject/session pairs through one label index instead of scanning all experiments each time
+        with profiler.span('metadata'):
+            experiment_index = build_experiment_index(project)
+        missing_sessions = []
         
-        for subject_id in args.subjects:
-            for session_id in args.sessions:
-                # Try both session formats
-                experiment_labels = [
-                    f"{subject_id}_{session_id}",  # Try ses-01
-                    f"{subject_id}_{session_id.replace('-', '_')}"  # Try ses_01
-                ]
-                
-                # Try to find the experiment with either label
-                found = False
-                for experiment_label in experiment_labels:
-                    for exp in project.experiments.values():
-                        if exp.label == experiment_label:
-                            found = True
+        # Optionally share one pool of keep-alive connections between all resource downloads
+        engine = AsyncTransferEngine(session, args.connections, retry_policy, metrics.add_bytes,
+                                     profiler.count_transfer_request, metrics.record_file) if args.async_downloads else None
+        metrics.expect(len(args.subjects) * len(args.sessions))
+        try:
+            with metrics.progress(args.progress_interval):
+                for subject_id in args.subjects:
+                    with metrics.measure('subject', base_dir / subject_id, subject=subject_id):
+                        for session_id in args.sessions:
                             output_dir = base_dir / subject_id / session_id
-                            
-                            # Download session resources
-                            if args.resource_name in exp.resources:
-                                logging.info(f"Downloading resource '{args.resource_name}' from session {exp.label}")
-                                
-                                with tempfile.TemporaryDirectory() as temp_dir:
-                                    # Download to temp directory first
-                                    exp.resources[args.resource_name].download_dir(temp_dir)
-                                    
-                                    source_dir = Path(temp_dir)
-                                    for root, dirs, files in os.walk(source_dir):
-                                        for file in files:
-                                            # Skip excluded files
-                                            if file in exclude_files:
-                                                continue
-                                                
-                                            src_path = Path(root) / file
-                                            parts = src_path.parts
-                                            
-                                            if 'files' in parts:
-                                                # Get everything after 'files'
-                                                rel_parts = parts[parts.index('files')+1:]
-                                                
-                                                # Remove subject/session from path if they exist
-                                                if len(rel_parts) >= 2:
-                                                    if rel_parts[0].startswith('sub-') and (
-                                                        rel_parts[1].startswith('ses-') or 
-                                                        rel_parts[1].startswith('ses_')
-                                                    ):
-                                                        rel_parts = rel_parts[2:]
-                                                
-                                                rel_path = Path(*rel_parts)
-                                                dest_path = output_dir / rel_path
-                                                
-                                                # Create parent directories if they don't exist
-                                                dest_path.parent.mkdir(parents=True, exist_ok=True)
-                                                shutil.copy2(src_path, dest_path)
+                            with metrics.measure('session', output_dir, subject=subject_id, session=session_id) as span:
+                                exp = find_experiment(experiment_index, subject_id, session_id)
+                                if exp is None:
+                                    missing_sessions.append(f"{subject_id}_{session_id}")
+                                    span.status = 'missing'
+                                    continue
                                 
-                                logging.info(f"Successfully downloaded resource '{args.resource_name}'")
-                            else:
-                                logging.warning(f"Resource '{args.resource_name}' not found in session {exp.label}")
-                            break
-                    
-                    if found:
-                        break
-                
-                if not found:
-                    logging.warning(f"Session {subject_id}_{session_id} (or {subject_id}_{session_id.replace('-', '_')}) not found")
+                                retry_policy.run(lambda attempt: download_experiment_resource(
+                                    exp, output_dir, file_rules, engine, resume=attempt > 1))
+        finally:
+            if engine is not None:
+                engine.close()
+        
+        if missing_sessions:
+            logging.warning(f"{len(missing_sessions)} session(s) not found (tried both ses- and ses_ labels): {missing_sessions}")
         
         end_time = time.time()
         logging.info(f"\nDownload process completed successfully! Time taken: {end_time - start_time:.2f} seconds")
+        write_run_reports('complete')
         
         # Create done file to signal completion
         with open(os.path.join(args.logs_dir, 'download_complete'), 'w') as f:
@@ -172,6 +356,7 @@ def main():
         sys.exit(0)
     except Exception as e:
         logging.error(f"\nAn error occurred during download process: {str(e)}")
+        write_run_reports('failed')
         sys.exit(1)
 
 if __name__ == "__main__":
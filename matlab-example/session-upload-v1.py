@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+import time
+import os
+from pathlib import Path
+import argparse
+import logging
+import sys
+from pathlib import PurePosixPath
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from xnat_transfer import list_resource_files
+from xnat_cache import DEFAULT_CACHE_DIR
+from xnat_connection import open_session
+from xnat_retry import RetryPolicy
+from xnat_metrics import TransferMetrics, format_bytes
+from xnat_profile import Profiler
+from xnat_selection import build_experiment_index, find_experiment, matches_any
+from xnat_checksums import CHECKSUM_FILE, ChecksumManifest
+from xnat_upload import (
+    BATCH_BYTES, SMALL_FILE_SIZE, experiment_files_url, pending_uploads, split_batches, upload_file, upload_zip,
+    zip_batch)
+
+# Parse command line arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('--logs-dir', required=True, help='Directory for log files')
+parser.add_argument('--upload-dir', required=True, help='Base directory with one <subject>/<session> folder per session to upload (e.g. a BIDS derivatives folder)')
+parser.add_argument('--server-url', required=True, help='XNAT server URL')
+parser.add_argument('--api-token-id', required=True, help='XNAT API token ID')
+parser.add_argument('--api-token-secret', required=True, help='XNAT API token secret')
+parser.add_argument('--project-id', required=True, help='XNAT project ID')
+parser.add_argument('--subjects', nargs='+', help='List of subject IDs to upload (default: every sub-* folder in the upload directory)')
+parser.add_argument('--sessions', nargs='+', help='List of session labels to upload (default: every ses-* folder of a subject)')
+parser.add_argument('--resource-name', required=True, help='Name of the session resource folder to upload into (created if missing)')
+parser.add_argument('--include', nargs='+', help='Only upload files matching one of these glob patterns (patterns with a / match the path in the session folder, others the file name)')
+parser.add_argument('--exclude', nargs='+', default=[], help='Do not upload files matching one of these glob patterns')
+parser.add_argument('--jobs', type=int, default=4, help='Zip batches and large files sent in parallel')
+parser.add_argument('--small-file-size', type=float, default=SMALL_FILE_SIZE / 1024**2, help='Files smaller than this many MB are sent in zip batches that XNAT extracts')
+parser.add_argument('--batch-size', type=float, default=BATCH_BYTES / 1024**2, help='Largest size in MB of the files in one zip batch')
+parser.add_argument('--reuse-session', action='store_true', help='Keep the XNAT session cookie in the cache directory and reuse it in later runs instead of logging in again')
+parser.add_argument('--cache-dir', default=str(DEFAULT_CACHE_DIR), help='Directory of reused sessions')
+parser.add_argument('--progress-interval', type=float, default=10, help='Seconds between progress lines with throughput and ETA (0 to disable)')
+parser.add_argument('--profile', action='store_true', help='Time each phase, count REST requests per phase and write a trace file to the logs directory')
+parser.add_argument('--cprofile', action='store_true', help='With --profile, also run the main thread under cProfile')
+parser.add_argument('--retries', type=int, default=5, help='Attempts per zip batch or file before giving up')
+parser.add_argument('--retry-delay', type=float, default=2.0, help='Base delay in seconds between attempts, doubled after every failure (with random jitter)')
+
+args = parser.parse_args()
+if args.retries < 1:
+    parser.error('--retries must be at least 1')
+if args.jobs < 1:
+    parser.error('--jobs must be at least 1')
+if args.small_file_size < 0 or args.batch_size <= 0:
+    parser.error('--small-file-size and --batch-size must be positive')
+
+# Retry policy of all uploads: only dropped connections, timeouts and server errors are retried
+retry_policy = RetryPolicy(max_attempts=args.retries, base_delay=args.retry_delay)
+
+# Bytes, files and time of every session resource uploaded
+metrics = TransferMetrics(unit='session', direction='upload')
+
+# Phase spans and request counts, collected only with --profile
+profiler = Profiler(enabled=args.profile)
+
+# Set up logging
+log_file = os.path.join(args.logs_dir, 'upload.log')
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler(log_file),
+        logging.StreamHandler()
+    ]
+)
+
+def session_files(session_dir, file_rules):
+    """List the files of a session folder as (local path, path in the resource) pairs.
+    file_rules is a pair of (include, exclude) glob patterns; checksum lists and unfinished files are left out."""
+    include, exclude = file_rules
+    files = []
+    for root, _, names in os.walk(session_dir):
+        for name in names:
+            if name.startswith(CHECKSUM_FILE) or name.endswith('.part'):
+                continue
+            path = Path(root) / name
+            rel_path = PurePosixPath(path.relative_to(session_dir).as_posix())
+            if (include and not matches_any(rel_path, include)) or matches_any(rel_path, exclude):
+                continue
+            files.append((path, str(rel_path)))
+    return files
+
+def local_sessions(upload_dir):
+    """Return {subject: [sessions]} for the sub-*/ses-* (or ses_*) folders in the upload directory."""
+    sessions = {}
+    for subject_dir in sorted(Path(upload_dir).glob('sub-*')):
+        if subject_dir.is_dir():
+            sessions[subject_dir.name] = [session_dir.name for session_dir in sorted(subject_dir.iterdir())
+                                          if session_dir.is_dir() and session_dir.name.startswith(('ses-', 'ses_'))]
+    return sessions
+
+def send_batch(interface, files_url, batch, name):
+    """Zip a batch of small files and send it, retrying with backoff."""
+    with profiler.span('zip'):
+        data = zip_batch(batch)
+    with profiler.span('transfer'):
+        retry_policy.run(lambda attempt: upload_zip(interface, files_url, name, data, metrics.add_bytes))
+
+def send_file(interface, files_url, path, remote_path):
+    """Send one large file, retrying with backoff."""
+    with profiler.span('transfer'):
+        retry_policy.run(lambda attempt: upload_file(interface, files_url, path, remote_path, metrics.add_bytes))
+
+def upload_session_resource(exp, session_dir, file_rules, span):
+    """Upload the files of session_dir into the requested resource of an experiment.
+    Files already on the server with the same checksum are skipped; the counts are stored in span."""
+    interface = exp.xnat_session.interface
+    files_url = experiment_files_url(args.server_url, exp.id, args.resource_name)
+    
+    # One catalog listing tells which files the server already has
+    with profiler.span('metadata'):
+        if args.resource_name in exp.resources:
+            catalog = list_resource_files(args.server_url, exp.resources[args.resource_name])
+        else:
+            logging.info(f"Creating resource '{args.resource_name}' in session {exp.label}")
+            exp.create_resource(args.resource_name)
+            catalog = []
+    files = session_files(session_dir, file_rules)
+    
+    # Checksums of unchanged local files are kept between runs, so only new or changed files are hashed
+    manifest = ChecksumManifest(session_dir)
+    with profiler.span('checksum'):
+        uploads = pending_uploads(files, catalog, manifest.local_md5)
+    manifest.save()
+    if len(uploads) < len(files):
+        logging.info(f"Skipping {len(files) - len(uploads)}/{len(files)} files already on the server")
+    
+    batches, singles = split_batches(uploads, args.small_file_size * 1024**2, args.batch_size * 1024**2)
+    upload_bytes = sum(size for batch in batches for _, _, size in batch) + sum(size for _, _, size in singles)
+    if uploads:
+        logging.info(f"Uploading {len(uploads)} files ({format_bytes(upload_bytes)}) to resource '{args.resource_name}' "
+                     f"of session {exp.label}: {len(batches)} zip batch(es) and {len(singles)} single file(s)")
+    
+    # Batches and large files share the pool; every batch gets its own name, so parallel extractions do not collide
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(send_batch, interface, files_url, batch, f"upload-{os.getpid()}-{index:04d}.zip")
+                   for index, batch in enumerate(batches)]
+        futures += [pool.submit(send_file, interface, files_url, path, remote_path) for path, remote_path, _ in singles]
+        for future in futures:
+            future.result()
+    
+    span.details.update(bytes=upload_bytes, files=len(uploads), skipped_files=len(files) - len(uploads),
+                        batches=len(batches))
+    if uploads:
+        logging.info(f"Successfully uploaded resource '{args.resource_name}' of session {exp.label}")
+
+def write_run_reports(status):
+    """Write the JSON run report and Prometheus metrics (and the profile with --profile) next to the completion marker."""
+    try:
+        report = metrics.write_reports(args.logs_dir, status, job='xnat_resource_upload',
+                                       project=args.project_id, server=args.server_url, resource=args.resource_name)
+        totals = report['totals']
+        logging.info(f"Uploaded {totals['files']} files ({totals['bytes'] / 1e6:.1f} MB) "
+                     f"at {totals['bytes_per_second'] / 1e6:.1f} MB/s; run report written to {args.logs_dir}")
+    except Exception as e:
+        logging.warning(f"Could not write run report: {str(e)}")
+    try:
+        profiler.write_results(args.logs_dir)
+    except Exception as e:
+        logging.warning(f"Could not write profile: {str(e)}")
+
+def main():
+    try:
+        start_time = time.time()
+        if args.cprofile:
+            profiler.start_cprofile()
+        logging.info("\nStarting resource upload process...")
+        
+        # Sessions to upload: the given subjects and sessions, or every session folder found
+        base_dir = Path(args.upload_dir)
+        found_sessions = local_sessions(base_dir)
+        subjects = args.subjects or list(found_sessions)
+        sessions = {subject_id: args.sessions or found_sessions.get(subject_id, []) for subject_id in subjects}
+        
+        # Connect to XNAT
+        with profiler.span('connect'):
+            session = open_session(args.server_url, args.api_token_id, args.api_token_secret,
+                                   reuse=args.reuse_session, cache_dir=args.cache_dir)
+        profiler.instrument(session)
+        if args.jobs > requests.adapters.DEFAULT_POOLSIZE:
+            # Give every parallel upload its own pooled connection to the server
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.jobs)
+            session.interface.mount('https://', adapter)
+            session.interface.mount('http://', adapter)
+        with profiler.span('metadata'):
+            project = session.projects[args.project_id]
+        
+        # Include/exclude patterns applied to the files of every session folder
+        file_rules = (args.include, args.exclude)
+        
+        # Resolve subject/session pairs through one label index instead of scanning all experiments each time
+        with profiler.span('metadata'):
+            experiment_index = build_experiment_index(project)
+        missing_sessions = []
+        
+        metrics.expect(sum(len(session_ids) for session_ids in sessions.values()))
+        with metrics.progress(args.progress_interval):
+            for subject_id in subjects:
+                with metrics.measure('subject', None, subject=subject_id) as subject_span:
+                    subject_bytes = subject_files = 0
+                    for session_id in sessions[subject_id]:
+                        session_dir = base_dir / subject_id / session_id
+                        with metrics.measure('session', None, subject=subject_id, session=session_id) as span:
+                            exp = find_experiment(experiment_index, subject_id, session_id)
+                            if exp is None or not session_dir.is_dir():
+                                missing_sessions.append(f"{subject_id}_{session_id}")
+                                span.status = 'missing'
+                                continue
+                            
+                            upload_session_resource(exp, session_dir, file_rules, span)
+                            subject_bytes += span.details['bytes']
+                            subject_files += span.details['files']
+                    subject_span.details.update(bytes=subject_bytes, files=subject_files)
+        
+        if missing_sessions:
+            logging.warning(f"{len(missing_sessions)} session(s) not found on the server or in {base_dir} "
+                            f"(tried both ses- and ses_ labels): {missing_sessions}")
+        
+        end_time = time.time()
+        logging.info(f"\nUpload process completed successfully! Time taken: {end_time - start_time:.2f} seconds")
+        write_run_reports('complete')
+        
+        # Create done file to signal completion
+        with open(os.path.join(args.logs_dir, 'upload_complete'), 'w') as f:
+            f.write('done')
+        
+        sys.exit(0)
+    except Exception as e:
+        logging.error(f"\nAn error occurred during upload process: {str(e)}")
+        write_run_reports('failed')
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
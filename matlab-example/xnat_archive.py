@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+"""
+Packed scan archives for file systems that handle many small files badly.
+
+Instead of a `scan-<id>_<type>/` directory with thousands of small DICOM
+files, `--archive` writes each scan as one `scan-<id>_<type>.dcmpack` file.
+Lustre and NFS then see one create and one inode per scan, and checking
+whether a scan is complete means reading the archive's index instead of
+listing a directory.
+
+Layout of an archive:
+
+    header   b'XNATPACK' + format version (uint16) + 6 reserved bytes
+    members  the files back to back, each stored as is or as one zstd frame
+    index    UTF-8 JSON: compression and, per member, name, offset, length,
+             size, MD5 and DICOM instance number
+    trailer  index offset (uint64) + index length (uint64) + b'XNATPACK'
+
+Members are written in name order without timestamps, so the same scan
+always gives the same bytes. ScanArchive reads single members through mmap
+without unpacking anything; stored members are even returned without a copy.
+
+zstd compression needs the zstandard package (pip install zstandard); instance
+numbers are only recorded if pydicom is installed.
+"""
+
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+
+MAGIC = b'XNATPACK'
+VERSION = 1
+SUFFIX = '.dcmpack'
+HEADER = struct.Struct('<8sH6x')
+TRAILER = struct.Struct('<QQ8s')
+COMPRESSIONS = ('none', 'zstd')
+
+def archive_path(scan_dir):
+    """Return the archive that replaces a scan directory: `scan-1_T1w/` -> `scan-1_T1w.dcmpack`."""
+    scan_dir = Path(scan_dir)
+    return scan_dir.with_name(scan_dir.name + SUFFIX)
+
+def instance_number(data):
+    """Read the InstanceNumber of a DICOM file's content, or None if unknown."""
+    if pydicom is None:
+        return None
+    try:
+        dataset = pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True, specific_tags=['InstanceNumber'])
+        return int(dataset.InstanceNumber)
+    except Exception:
+        return None
+
+def read_index(path):
+    """Read the index of an archive with two small reads, without mapping the file.
+    Returns a dict with 'compression' and 'members' (a list of member dicts)."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < HEADER.size + TRAILER.size:
+            raise ValueError(f"{path} is too short to be a scan archive")
+        f.seek(-TRAILER.size, os.SEEK_END)
+        offset, length, magic = TRAILER.unpack(f.read(TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a scan archive")
+        f.seek(offset)
+        return json.loads(f.read(length).decode('utf-8'))
+
+class ArchiveWriter:
+    """Write a scan archive via a `.part` file that is renamed once the index is written.
+    Use it as a context manager; if the block fails, the partial archive is removed."""
+
+    def __init__(self, path, compression='none', level=3):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown archive compression {compression!r}")
+        if compression == 'zstd' and zstandard is None:
+            raise RuntimeError("zstd compressed archives need the zstandard package (pip install zstandard)")
+        self.path = Path(path)
+        self.partial = self.path.with_name(self.path.name + '.part')
+        self.compression = compression
+        self.compressor = zstandard.ZstdCompressor(level=level) if compression == 'zstd' else None
+        self.members = []
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.partial, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+
+    def add(self, name, data, md5=None, instance=None):
+        """Append one member. Call in name order to get reproducible archives."""
+        stored = self.compressor.compress(data) if self.compressor else data
+        self.members.append({
+            'name': name, 'offset': self.file.tell(), 'length': len(stored), 'size': len(data),
+            'md5': md5 or hashlib.md5(data).hexdigest(),
+            'instance': instance if instance is not None else instance_number(data),
+        })
+        self.file.write(stored)
+
+    def close(self):
+        """Write the index and trailer and move the archive into place."""
+        index = json.dumps({'version': VERSION, 'compression': self.compression, 'members': self.members},
+                           separators=(',', ':')).encode('utf-8')
+        offset = self.file.tell()
+        self.file.write(index)
+        self.file.write(TRAILER.pack(offset, len(index), MAGIC))
+        self.file.close()
+        self.partial.replace(self.path)
+
+    def abort(self):
+        self.file.close()
+        self.partial.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class ScanArchive:
+    """Read-only access to the members of a scan archive through mmap.
+
+    Members are looked up by file name or by DICOM instance number:
+
+        with ScanArchive('scan-2_T1w.dcmpack') as archive:
+            data = archive.read(archive.names()[0])
+            dataset = archive.dataset(instance=12)
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        index = read_index(self.path)
+        self.compression = index['compression']
+        self.members = {member['name']: member for member in index['members']}
+        self.instances = {member['instance']: member['name'] for member in index['members']
+                          if member.get('instance') is not None}
+        self._file = open(self.path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def names(self):
+        return list(self.members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def name_of(self, instance):
+        """Return the member name of a DICOM instance number."""
+        if instance not in self.instances:
+            raise KeyError(f"No instance {instance} in {self.path}")
+        return self.instances[instance]
+
+    def view(self, name):
+        """Return a stored member as a memoryview of the mapped file (no copy).
+        Release the view before closing the archive."""
+        if self.compression != 'none':
+            raise ValueError(f"Members of {self.path} are compressed; use read() instead")
+        member = self.members[name]
+        return memoryview(self._map)[member['offset']:member['offset'] + member['length']]
+
+    def read(self, name=None, instance=None):
+        """Return the content of a member, by name or by instance number."""
+        name = name if name is not None else self.name_of(instance)
+        member = self.members[name]
+        data = self._map[member['offset']:member['offset'] + member['length']]
+        if self.compression == 'zstd':
+            if zstandard is None:
+                raise RuntimeError("Reading zstd compressed archives needs the zstandard package (pip install zstandard)")
+            data = zstandard.ZstdDecompressor().decompress(data, max_output_size=member['size'])
+        return data
+
+    def open(self, name=None, instance=None):
+        """Return a member as a binary file object, e.g. for pydicom.dcmread."""
+        return io.BytesIO(self.read(name, instance))
+
+    def dataset(self, name=None, instance=None, **kwargs):
+        """Parse a member with pydicom; keyword arguments are passed to pydicom.dcmread."""
+        if pydicom is None:
+            raise RuntimeError("Reading DICOM datasets needs the pydicom package (pip install pydicom)")
+        return pydicom.dcmread(self.open(name, instance), **kwargs)
+
+    def extract(self, directory):
+        """Unpack all members into directory. Returns the written paths."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        written = []
+        for name in self.members:
+            path = directory / name
+            path.write_bytes(self.read(name))
+            written.append(path)
+        return written
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def pack_directory(directory, path, compression='none', previous=None):
+    """Pack the .dcm files of directory into a new archive at path.
+    Members of the previous archive (usually the one at path) that the directory does
+    not replace are carried over, so a partial download can update an archive.
+    Returns the number of members written."""
+    files = {file.name: file for file in Path(directory).glob('*.dcm')}
+    writer = ArchiveWriter(path, compression)
+    try:
+        carried = ScanArchive(previous) if previous is not None and Path(previous).exists() else None
+        try:
+            names = sorted(set(files) | set(carried.members if carried is not None else ()))
+            for name in names:
+                if name in files:
+                    writer.add(name, files[name].read_bytes())
+                else:
+                    member = carried.members[name]
+                    writer.add(name, carried.read(name), member['md5'], member.get('instance'))
+        finally:
+            # Unmap the previous archive before the new one replaces it
+            if carried is not None:
+                carried.close()
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return len(names)
+
+def find_stale_members(catalog, index, verify_checksums=False):
+    """Return the catalog entries that are missing from an archive index or differ from it.
+    Members are compared by size, and by MD5 as well if verify_checksums is set and the server has a digest."""
+    members = {member['name']: member for member in index['members']}
+    stale = []
+    for entry in catalog:
+        member = members.get(entry['name'])
+        if member is None:
+            stale.append(entry)
+        elif entry['size'] is not None and member['size'] != entry['size']:
+            stale.append(entry)
+        elif verify_checksums and entry['digest'] and member['md5'] != entry['digest'].lower():
+            stale.append(entry)
+    return stale
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""
+Optional asyncio transfer engine for the XNAT download scripts.
+
+The xnat package downloads one resource per blocking request. For sessions
+with many small resources most of that time is spent setting up requests.
+This engine runs an asyncio event loop in a background thread with one
+shared pool of keep-alive connections, limited per host, and fetches many
+files at once while streaming each one to disk. Failed files are retried
+with the shared retry policy and continue where the last attempt stopped.
+
+Requires the aiohttp package: pip install aiohttp
+"""
+
+import asyncio
+import hashlib
+import threading
+import time
+from pathlib import Path
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from xnat_retry import RetryPolicy
+from xnat_transfer import CHUNK_SIZE, file_digest
+
+DEFAULT_CONNECTIONS = 8  # Connections kept open to the XNAT server
+
+class AsyncTransferEngine:
+    """Download files over a shared aiohttp connection pool from any thread.
+
+    The engine reuses the login of an existing xnat session, so it needs no
+    credentials of its own. Use it as a context manager to close the pool.
+    """
+
+    def __init__(self, xnat_session, connections=DEFAULT_CONNECTIONS, retry_policy=None, on_bytes=None,
+                 on_response=None, on_saved=None):
+        if aiohttp is None:
+            raise RuntimeError("The async download engine needs the aiohttp package (pip install aiohttp)")
+
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.on_bytes = on_bytes  # Called with the size of every chunk received, e.g. for progress reports
+        self.on_response = on_response  # Called with (url, status, seconds until the response started)
+        self.on_saved = on_saved  # Called with (path, bytes) of every complete file, e.g. for the run metrics
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='xnat-async-engine', daemon=True)
+        self.thread.start()
+        self.client = self._run(self._open_client(xnat_session.interface, connections))
+
+    def _run(self, coroutine):
+        """Run a coroutine on the engine's loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def _open_client(self, interface, connections):
+        """Create the aiohttp client with the cookies and credentials of the requests session."""
+        connector = aiohttp.TCPConnector(limit_per_host=connections, ssl=None if interface.verify else False)
+        auth = aiohttp.BasicAuth(*interface.auth) if isinstance(interface.auth, tuple) else None
+        cookies = {cookie.name: cookie.value for cookie in interface.cookies}
+        return aiohttp.ClientSession(connector=connector, auth=auth, cookies=cookies,
+                                     timeout=aiohttp.ClientTimeout(total=None, sock_read=300))
+
+    async def _fetch(self, url, destination, on_written=None):
+        """Download one file, retrying failed attempts according to the engine's retry policy."""
+        return await self.retry_policy.run_async(lambda attempt: self._fetch_once(url, destination, on_written))
+
+    async def _fetch_once(self, url, destination, on_written=None):
+        """Stream one file to destination via a `.part` file, hashing it if on_written(path, md5) is given.
+        A `.part` file left by a failed attempt is continued with an HTTP Range request."""
+        destination = Path(destination)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        partial = destination.with_name(destination.name + '.part')
+        offset = partial.stat().st_size if partial.exists() else 0
+        headers = {'Range': f"bytes={offset}-", 'Accept-Encoding': 'identity'} if offset else {}
+
+        start = time.perf_counter()
+        async with self.client.get(url, headers=headers) as response:
+            if self.on_response is not None:
+                self.on_response(url, response.status, time.perf_counter() - start)
+            resumed = offset and response.status == 206 and \
+                response.headers.get('Content-Range', '').startswith(f"bytes {offset}-")
+            if offset and (response.status == 416 or (response.status == 206 and not resumed)):
+                # The partial file does not fit the file on the server any more; start over
+                partial.unlink()
+                return await self._fetch_once(url, destination, on_written)
+            response.raise_for_status()
+            digest = None if on_written is None else file_digest(partial) if resumed else hashlib.md5()
+            nbytes = offset if resumed else 0
+            with open(partial, 'ab' if resumed else 'wb') as f:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    f.write(chunk)
+                    nbytes += len(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+                    if self.on_bytes is not None:
+                        self.on_bytes(len(chunk))
+        partial.replace(destination)
+        if digest is not None:
+            on_written(destination, digest.hexdigest())
+        if self.on_saved is not None:
+            self.on_saved(destination, nbytes)
+        return destination
+
+    async def _fetch_all(self, items, on_written=None):
+        """Fetch all items concurrently; the connector limits how many run at once."""
+        results = await asyncio.gather(*(self._fetch(url, destination, on_written) for url, destination in items),
+                                       return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            raise RuntimeError(f"{len(errors)}/{len(items)} file downloads failed, first error: {errors[0]}")
+        return results
+
+    def download_files(self, items, on_written=None):
+        """Download (url, destination) pairs and block until all are done.
+        Returns the written paths; raises if any download failed."""
+        if not items:
+            return []
+        return self._run(self._fetch_all(list(items), on_written))
+
+    def close(self):
+        """Close the connection pool and stop the event loop."""
+        self._run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""
+Content-addressed blob store shared by the XNAT download scripts.
+
+Labs often download the same sessions into several `--download-dir` trees,
+and resource folders repeat identical files (templates, sidecars) from one
+session to the next. With a blob store, every file is kept once under its
+MD5 digest and the download trees only hold hardlinks to it.
+
+XNAT lists the MD5 digest of every file in a resource's file catalog, so a
+file whose digest is already in the store is linked into place without
+downloading it. Files of servers without checksums are downloaded as usual
+and moved into the store afterwards, which still saves the disk space.
+
+Stored files are made read-only: every tree linking to a blob shares the same
+data, so a file edited in place would change in all of them.
+"""
+
+import errno
+import logging
+import os
+import shutil
+import stat
+import threading
+from pathlib import Path
+
+from xnat_checksums import CHECKSUM_FILE
+from xnat_transfer import file_md5
+
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+class BlobStore:
+    """Directory of files named by their MD5 digest (`<root>/md5/ab/abcdef...`).
+
+    All operations are safe to run from several threads and processes at once:
+    files are linked under a temporary name and renamed into place.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        (self.root / 'md5').mkdir(parents=True, exist_ok=True)
+        # File systems already warned about because files had to be copied there instead of linked
+        self._copy_devices = set()
+        self._lock = threading.Lock()
+
+    def path_for(self, digest):
+        digest = digest.lower()
+        return self.root / 'md5' / digest[:2] / digest
+
+    def has(self, digest):
+        return bool(digest) and self.path_for(digest).is_file()
+
+    def _temporary(self, path):
+        return path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+    def _place(self, source, destination):
+        """Atomically make destination a hardlink of source (or a copy if that is not possible).
+        The fallback applies to this file only, so e.g. a staging directory on another file system
+        does not turn off linking for the download tree."""
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self._temporary(destination)
+        temporary.unlink(missing_ok=True)
+        try:
+            os.link(source, temporary)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            device = os.stat(destination.parent).st_dev
+            with self._lock:
+                warn = device not in self._copy_devices
+                self._copy_devices.add(device)
+            if warn:
+                logging.warning(f"Cannot hardlink between {self.root} and {destination.parent} "
+                                f"({e.strerror}); copying files from the blob store there instead")
+            shutil.copy2(source, temporary)
+        temporary.replace(destination)
+
+    def link(self, digest, destination):
+        """Put the stored blob with this digest at destination. Returns False if it is not stored."""
+        blob = self.path_for(digest)
+        destination = Path(destination)
+        if not blob.is_file():
+            return False
+        if destination.exists() and os.path.samefile(blob, destination):
+            return True
+        self._place(blob, destination)
+        return True
+
+    def add(self, path, digest=None):
+        """Move the file at path into the store and leave a link to the blob in its place.
+        The file is only hashed if its digest is not given. Returns the digest."""
+        path = Path(path)
+        digest = (digest or file_md5(path)).lower()
+        blob = self.path_for(digest)
+        if not blob.is_file():
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            self._place(path, blob)
+            os.chmod(blob, READ_ONLY)
+        if not os.path.samefile(blob, path):
+            self._place(blob, path)
+        return digest
+
+    def link_entries(self, downloads):
+        """Link the files of (catalog entry, destination) pairs that are already stored.
+        Returns the pairs that still have to be downloaded."""
+        remaining = []
+        for entry, destination in downloads:
+            if not (entry.get('digest') and self.link(entry['digest'], destination)):
+                remaining.append((entry, destination))
+        return remaining
+
+    def add_tree(self, directory, known_md5=None):
+        """Move every file below directory that is not linked to a blob yet into the store.
+        known_md5(path) may return a digest already computed for a file (e.g. `ChecksumManifest.trusted_md5`),
+        so the file is not read again; files it returns None for are hashed. Returns the number of files added."""
+        added = 0
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = Path(root) / name
+                # Files linked from the store have more than one link; unfinished downloads are left alone
+                if name.endswith(('.part', '.tmp')) or name == CHECKSUM_FILE or path.stat().st_nlink > 1:
+                    continue
+                self.add(path, known_md5(path) if known_md5 is not None else None)
+                added += 1
+        return added
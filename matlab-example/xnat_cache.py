@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+On-disk cache of XNAT metadata shared by the download scripts.
+
+Walking projects, subjects, experiments and scans through the xnat package
+sends one REST request per listing and per object. This module stores the
+responses to those requests in a SQLite database, so repeated runs can plan
+their work from disk instead of asking the server again.
+
+The cache is installed as a transport adapter on the connection's requests
+session, so the scripts keep using the normal xnat objects. Only metadata is
+cached: file catalogs, file downloads and login requests always go to the server.
+"""
+
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+DEFAULT_CACHE_DIR = Path.home() / '.cache' / 'xnat-templates'
+DEFAULT_TTL = 3600  # seconds
+
+# REST paths whose responses are cached, and parts of paths that are never cached
+CACHED_PATH_PREFIXES = ('/data/', '/REST/')
+UNCACHED_PATH_PARTS = ('/files', '/JSESSION')
+
+class MetadataCache:
+    """SQLite store of REST responses, keyed by URL and expiring after `ttl` seconds."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL, refresh=False):
+        self.path = Path(cache_dir) / 'metadata.sqlite'
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        # With refresh, anything stored before this run counts as expired
+        self.not_before = time.time() if refresh else 0
+        self._local = threading.local()
+        db = self._connection()
+        db.execute('CREATE TABLE IF NOT EXISTS responses '
+                   '(url TEXT PRIMARY KEY, fetched_at REAL, content_type TEXT, body BLOB)')
+        db.commit()
+
+    def _connection(self):
+        """Return this thread's database connection, opening it on first use."""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            self._local.db = db
+        return db
+
+    def get(self, url):
+        """Return (content_type, body) for a fresh entry, or None."""
+        row = self._connection().execute(
+            'SELECT fetched_at, content_type, body FROM responses WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        fetched_at, content_type, body = row
+        if fetched_at < self.not_before or time.time() - fetched_at > self.ttl:
+            return None
+        return content_type, body
+
+    def put(self, url, content_type, body):
+        """Store a response body."""
+        db = self._connection()
+        db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                   (url, time.time(), content_type, body))
+        db.commit()
+
+    def clear(self):
+        """Remove all entries."""
+        db = self._connection()
+        db.execute('DELETE FROM responses')
+        db.commit()
+
+def is_cacheable(request):
+    """Return True for GET requests of XNAT metadata."""
+    if request.method != 'GET':
+        return False
+    path = urlsplit(request.url).path
+    return path.startswith(CACHED_PATH_PREFIXES) and not any(part in path for part in UNCACHED_PATH_PARTS)
+
+class CachingAdapter(HTTPAdapter):
+    """Transport adapter that answers metadata requests from a MetadataCache when it can."""
+
+    def __init__(self, cache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request, stream=False, **kwargs):
+        if stream or not is_cacheable(request):
+            return super().send(request, stream=stream, **kwargs)
+
+        cached = self.cache.get(request.url)
+        if cached is not None:
+            return self._cached_response(request, *cached)
+
+        response = super().send(request, stream=stream, **kwargs)
+        if response.status_code == 200:
+            self.cache.put(request.url, response.headers.get('Content-Type', ''), response.content)
+        return response
+
+    @staticmethod
+    def _cached_response(request, content_type, body):
+        """Build a response object that looks like it came from the server."""
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict({'Content-Type': content_type})
+        response._content = body
+        response.url = request.url
+        response.request = request
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        return response
+
+def install_metadata_cache(session, server_url, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL,
+                           refresh=False, pool_maxsize=requests.adapters.DEFAULT_POOLSIZE):
+    """Serve metadata requests of an xnat session from the on-disk cache."""
+    cache = MetadataCache(cache_dir, ttl, refresh)
+    adapter = CachingAdapter(cache, pool_connections=1, pool_maxsize=pool_maxsize)
+    # requests picks the adapter with the longest matching prefix, so this one wins for our server
+    session.interface.mount(server_url.rstrip('/') + '/', adapter)
+    return cache
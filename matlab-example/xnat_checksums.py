@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+Checksums computed while downloading (`--verify`).
+
+Checking downloaded files with a separate pass means reading every byte a
+second time. Instead, every download path (zip streaming, single files with
+resume, the async engine) feeds the bytes it writes through an MD5 digest,
+and the result is compared with the digest XNAT lists for the file in the
+resource catalog. A file whose digest does not match is fetched again on its
+own; the rest of the scan or resource is kept.
+
+The verified digests are stored next to the data, in one
+`.xnat-checksums.json` per scan (or per session folder of resource
+downloads), together with the size and modification time of each file:
+
+    {"1.3.12.2.1.1.1.00001.dcm": {"md5": "9e107d9d...", "size": 65536,
+                                  "mtime_ns": 1760652000000000000, "source": "server"}}
+
+Later skip checks compare the stored digest with the catalog instead of
+hashing the file again, as long as the file's size and modification time
+are unchanged. `source` is "server" for digests confirmed by XNAT and "local"
+for files of servers that list no checksums.
+"""
+
+import json
+import logging
+import threading
+from pathlib import Path
+
+from xnat_transfer import file_md5
+
+CHECKSUM_FILE = '.xnat-checksums.json'
+MAX_REFETCHES = 2  # Times a file with a wrong checksum is fetched again before the download fails
+
+class ChecksumError(Exception):
+    """Raised when files still do not match the server's checksums after being fetched again."""
+
+class ChecksumManifest:
+    """Digests of the files below one directory, kept in CHECKSUM_FILE in that directory. Thread-safe.
+
+    Use `record` as the `on_written` callback of the transfer functions; it
+    receives the path and MD5 of every file once it is complete.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.path = self.directory / CHECKSUM_FILE
+        try:
+            self.entries = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self.entries = {}
+        self.written = {}  # Digests of the files written since this manifest was opened
+        self._lock = threading.Lock()
+
+    def _key(self, path):
+        return Path(path).relative_to(self.directory).as_posix()
+
+    def record(self, path, md5, source='local'):
+        """Remember the digest of a complete file."""
+        stat = Path(path).stat()
+        key = self._key(path)
+        with self._lock:
+            self.entries[key] = {'md5': md5, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'source': source}
+            self.written[key] = md5
+
+    def trusted_md5(self, path):
+        """Return the stored digest of a file, or None if there is none or the file changed since."""
+        with self._lock:
+            entry = self.entries.get(self._key(path))
+        if entry is None:
+            return None
+        try:
+            stat = Path(path).stat()
+        except OSError:
+            return None
+        if stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime_ns']:
+            return None
+        return entry['md5']
+
+    def local_md5(self, path):
+        """Return the digest of a local file, hashing (and remembering) it only if no stored digest is valid."""
+        md5 = self.trusted_md5(path)
+        if md5 is None:
+            md5 = file_md5(path)
+            self.record(path, md5)
+        return md5
+
+    def mismatches(self, downloads):
+        """Return the (catalog entry, destination) pairs written since the manifest was opened
+        whose digest differs from the one the server lists. Files without a server digest pass;
+        files that match are marked as confirmed by the server."""
+        bad = []
+        with self._lock:
+            for entry, destination in downloads:
+                written = self.written.get(self._key(destination))
+                if entry.get('digest') and written is not None and written != entry['digest'].lower():
+                    bad.append((entry, destination))
+                elif entry.get('digest') and written is not None:
+                    self.entries[self._key(destination)]['source'] = 'server'
+        return bad
+
+    def save(self):
+        """Write the digests of the files that still exist."""
+        with self._lock:
+            entries = {key: entry for key, entry in self.entries.items() if (self.directory / key).is_file()}
+        if not entries:
+            return
+        temporary = self.path.with_name(self.path.name + '.tmp')
+        temporary.write_text(json.dumps(entries, indent=1, sort_keys=True))
+        temporary.replace(self.path)
+
+def refetch_mismatches(manifest, downloads, fetch):
+    """Fetch the files of downloads whose checksum did not match again, one by one with fetch(entry, destination),
+    until all match. Raises ChecksumError if some still differ after MAX_REFETCHES rounds."""
+    for attempt in range(MAX_REFETCHES + 1):
+        bad = manifest.mismatches(downloads)
+        if not bad:
+            return
+        if attempt == MAX_REFETCHES:
+            break
+        logging.warning(f"      Checksum mismatch in {len(bad)} file(s), fetching them again: "
+                        f"{', '.join(destination.name for _, destination in bad[:5])}")
+        for entry, destination in bad:
+            Path(destination).unlink(missing_ok=True)
+            fetch(entry, destination)
+    raise ChecksumError(f"{len(bad)} file(s) still do not match the server's checksums: "
+                        f"{', '.join(destination.name for _, destination in bad[:5])}")
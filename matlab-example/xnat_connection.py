@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+Shared XNAT login for the download scripts, reusing sessions between runs.
+
+Every `xnat.connect` logs in from scratch: a login request, an auth check and
+the server handshake before any data moves. For short cron-driven runs the
+login is a large share of the run time. With `--reuse-session` the JSESSIONID
+cookie XNAT hands out at login is kept in
+`~/.cache/xnat-templates/sessions/` (readable only by the current user)
+together with the time it expires, and the next run connects with that cookie
+instead of logging in again.
+
+XNAT ends a session after a period without requests. The period is announced
+in the SESSION_EXPIRATION_TIME cookie (15 minutes if it is not), and the
+stored expiry is pushed forward whenever a run disconnects. Disconnecting
+then only closes the local connections: the usual logout (DELETE
+/data/JSESSION) would end the session the next run wants to continue.
+Sessions the server no longer accepts, at connect time or in the middle of a run, are
+dropped and the script logs in again with its token.
+
+Cached sessions are stored per server, user and token: a file name is a hash
+of all three, so a changed token never picks up an old session.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+import xnat
+from xnat.exceptions import XNATError
+from xnat.session import BaseXNATSession
+
+from xnat_cache import DEFAULT_CACHE_DIR
+
+DEFAULT_SESSION_TIMEOUT = 900  # XNAT's default, used when the server does not announce its timeout
+EXPIRY_MARGIN = 60  # Seconds before the expiry from which a stored session is no longer used
+
+def session_timeout(session):
+    """Return the idle timeout of an XNAT session in seconds."""
+    try:
+        expiration = session.session_expiration_time
+    except Exception:
+        expiration = None
+    return expiration[1] if expiration else DEFAULT_SESSION_TIMEOUT
+
+class SessionStore:
+    """Session cookies of earlier runs, one file per server, user and token."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.directory = Path(cache_dir) / 'sessions'
+
+    def _path(self, server, user, password):
+        key = hashlib.sha256(f"{server.rstrip('/')}\n{user}\n{password}".encode('utf-8')).hexdigest()
+        return self.directory / f"{key[:32]}.json"
+
+    def load(self, server, user, password):
+        """Return the stored JSESSIONID, or None if there is none or it has (nearly) expired."""
+        try:
+            entry = json.loads(self._path(server, user, password).read_text())
+        except (OSError, ValueError):
+            return None
+        if entry.get('expires', 0) - EXPIRY_MARGIN < time.time():
+            return None
+        return entry.get('jsession')
+
+    def save(self, server, user, password, session):
+        """Remember the cookie of a logged-in session, expiring one timeout from now."""
+        jsession = session.interface.cookies.get('JSESSIONID') if session.interface is not None else None
+        if not jsession:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        os.chmod(self.directory, 0o700)
+        path = self._path(server, user, password)
+        temporary = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'w') as f:
+            json.dump({'server': server, 'jsession': jsession, 'expires': time.time() + session_timeout(session)}, f)
+        temporary.replace(path)
+
+    def forget(self, server, user, password):
+        self._path(server, user, password).unlink(missing_ok=True)
+
+def reauthenticate_on_rejection(session, server, user, password, store=None):
+    """Log in again when the server rejects the session cookie in the middle of a run,
+    and repeat the rejected request once with the new session."""
+    lock = threading.Lock()
+
+    def hook(response, *args, **kwargs):
+        request = response.request
+        if response.status_code != 401 or request.method not in ('GET', 'HEAD') or \
+                getattr(request, 'reauthenticated', False):
+            return response
+        with lock:
+            # Log in only once if several threads were rejected; later ones just repeat their request
+            if f"JSESSIONID={session.interface.cookies.get('JSESSIONID')}" in request.headers.get('Cookie', ''):
+                logging.warning(f"XNAT rejected the session cookie; logging in to {server} again")
+                login = session.interface.post(f"{server.rstrip('/')}/data/JSESSION", auth=(user, password),
+                                               timeout=30)
+                if login.status_code != 200:
+                    return response
+                if store is not None:
+                    store.save(server, user, password, session)
+        response.close()
+        retry = request.copy()
+        retry.headers.pop('Cookie', None)
+        retry.prepare_cookies(session.interface.cookies)
+        retry.reauthenticated = True
+        return session.interface.send(retry, **kwargs)
+
+    session.interface.hooks['response'].append(hook)
+
+def open_session(server, user, password, reuse=False, cache_dir=DEFAULT_CACHE_DIR):
+    """Connect to XNAT; with reuse, continue the session of an earlier run if it is still valid.
+    Use the result like the session returned by xnat.connect."""
+    store = SessionStore(cache_dir) if reuse else None
+    session = None
+    jsession = store.load(server, user, password) if store is not None else None
+    if jsession:
+        try:
+            session = xnat.connect(server, user=user, jsession=jsession)
+            logging.info("Reusing the XNAT session of an earlier run")
+        except XNATError as e:
+            logging.info(f"Stored XNAT session is no longer valid ({str(e)}); logging in again")
+            store.forget(server, user, password)
+    if session is None:
+        session = xnat.connect(server, user=user, password=password)
+    if store is None:
+        return session
+
+    store.save(server, user, password, session)
+    reauthenticate_on_rejection(session, server, user, password, store)
+
+    # Push the stored expiry forward when the run is done with the session, and close the
+    # connections without logging out so the stored session stays valid on the server
+    def remember_and_disconnect():
+        if session.interface is not None:
+            store.save(server, user, password, session)
+        BaseXNATSession.disconnect(session)
+
+    session.disconnect = remember_and_disconnect
+    return session
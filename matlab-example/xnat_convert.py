@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""
+Optional DICOM to NIfTI conversion stage for the XNAT download scripts.
+
+Converting after the whole download has finished means reading every DICOM
+file back from disk in one long serial pass. With `--convert` each scan is
+handed to a pool of worker processes as soon as its files are in place, so
+conversion runs while later scans are still downloading. The NIfTI file is
+written next to the DICOM files as `<scan directory name>.nii.gz`; scans
+packed with `--archive` are read from their archive and get
+`scan-<id>_<type>.nii.gz` next to it.
+
+The converter handles the common case of one image per file, for single
+slices, volumes and time series. Enhanced multi-frame files, Siemens mosaics
+and series without image geometry are reported as skipped.
+
+Requires the pydicom, numpy and nibabel packages: pip install pydicom nibabel
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from xnat_archive import SUFFIX as ARCHIVE_SUFFIX, ScanArchive
+
+try:
+    import nibabel
+    import numpy
+    import pydicom
+except ImportError:
+    nibabel = numpy = pydicom = None
+
+DEFAULT_PROCESSES = max(1, (os.cpu_count() or 2) // 2)
+
+class ConversionSkipped(Exception):
+    """Raised for scans the converter does not handle."""
+
+def nifti_path(scan_path):
+    """Return the path of the NIfTI file of a scan directory or scan archive."""
+    scan_path = Path(scan_path)
+    if scan_path.suffix == ARCHIVE_SUFFIX:
+        return scan_path.with_suffix('.nii.gz')
+    return scan_path / f"{scan_path.name}.nii.gz"
+
+def read_slices(sources):
+    """Read the image files of a scan (paths or file objects), leaving out files without pixel data."""
+    slices = []
+    for source in sources:
+        dataset = pydicom.dcmread(source)
+        if 'PixelData' not in dataset:
+            continue  # Reports, presentation states and the like
+        if int(dataset.get('NumberOfFrames', 1) or 1) > 1:
+            raise ConversionSkipped('enhanced multi-frame images are not supported')
+        if 'MOSAIC' in dataset.get('ImageType', []):
+            raise ConversionSkipped('Siemens mosaic images are not supported')
+        if 'ImagePositionPatient' not in dataset or 'ImageOrientationPatient' not in dataset:
+            raise ConversionSkipped('images without patient position and orientation')
+        slices.append(dataset)
+    if not slices:
+        raise ConversionSkipped('no image data')
+    return slices
+
+def stack_slices(slices):
+    """Sort the slices of a scan into volumes.
+    Returns (data, affine): data has the shape (columns, rows, slices, volumes) and the affine
+    maps voxels to RAS+ millimetres."""
+    first = slices[0]
+    orientation = numpy.array(first.ImageOrientationPatient, dtype=float)
+    row_cosine, column_cosine = orientation[:3], orientation[3:]
+    normal = numpy.cross(row_cosine, column_cosine)
+    shape = (int(first.Rows), int(first.Columns))
+    for dataset in slices:
+        if (int(dataset.Rows), int(dataset.Columns)) != shape or \
+                not numpy.allclose(numpy.array(dataset.ImageOrientationPatient, dtype=float), orientation, atol=1e-4):
+            raise ConversionSkipped('images of different sizes or orientations')
+
+    # Group the images by their distance along the slice normal; repeated positions are time points
+    positions = {}
+    for dataset in slices:
+        distance = round(float(numpy.dot(normal, numpy.array(dataset.ImagePositionPatient, dtype=float))), 3)
+        positions.setdefault(distance, []).append(dataset)
+    if len({len(group) for group in positions.values()}) != 1:
+        raise ConversionSkipped('the number of images differs between slice positions')
+    distances = sorted(positions)
+    for group in positions.values():
+        group.sort(key=lambda dataset: (int(dataset.get('AcquisitionNumber', 0) or 0),
+                                        int(dataset.get('InstanceNumber', 0) or 0)))
+    volumes = len(positions[distances[0]])
+
+    def rescaling(dataset):
+        return float(dataset.get('RescaleSlope', 1) or 1), float(dataset.get('RescaleIntercept', 0) or 0)
+
+    # Stored values are kept as they are unless the scanner asks for rescaling, which needs floats
+    rescaled = any(rescaling(dataset) != (1.0, 0.0) for dataset in slices)
+    data = numpy.zeros((shape[1], shape[0], len(distances), volumes),
+                       dtype=numpy.float32 if rescaled else first.pixel_array.dtype)
+    for k, distance in enumerate(distances):
+        for t, dataset in enumerate(positions[distance]):
+            pixels = dataset.pixel_array
+            if rescaled:
+                slope, intercept = rescaling(dataset)
+                pixels = pixels * slope + intercept
+            # DICOM pixel arrays are indexed (row, column); NIfTI's first axis runs along a row
+            data[:, :, k, t] = pixels.T
+
+    row_spacing, column_spacing = (float(value) for value in first.PixelSpacing)
+    first_position = numpy.array(positions[distances[0]][0].ImagePositionPatient, dtype=float)
+    if len(distances) > 1:
+        last_position = numpy.array(positions[distances[-1]][0].ImagePositionPatient, dtype=float)
+        slice_step = (last_position - first_position) / (len(distances) - 1)
+    else:
+        slice_step = normal * float(first.get('SliceThickness', 1) or 1)
+    affine = numpy.eye(4)
+    affine[:3, 0] = row_cosine * column_spacing
+    affine[:3, 1] = column_cosine * row_spacing
+    affine[:3, 2] = slice_step
+    affine[:3, 3] = first_position
+    # DICOM patient coordinates are LPS+, NIfTI's are RAS+
+    affine = numpy.diag([-1.0, -1.0, 1.0, 1.0]) @ affine
+    return data, affine
+
+def convert_scan(scan_path):
+    """Convert the DICOM files of a scan directory or scan archive into one NIfTI file next to them.
+    Runs in a worker process. Returns a dict with the status ('converted', 'up to date'
+    or 'skipped'), the output path, the shape of the image and the time taken."""
+    start = time.time()
+    scan_path = Path(scan_path)
+    output = nifti_path(scan_path)
+    result = {'scan': str(scan_path), 'output': str(output)}
+    if scan_path.suffix == ARCHIVE_SUFFIX:
+        dicom_files = [scan_path] if scan_path.is_file() else []
+    else:
+        dicom_files = sorted(scan_path.glob('*.dcm'))
+    if not dicom_files:
+        return dict(result, status='skipped', reason='no DICOM files')
+    # Converted by an earlier run and no DICOM file changed since
+    if output.exists() and output.stat().st_mtime >= max(path.stat().st_mtime for path in dicom_files):
+        return dict(result, status='up to date')
+
+    try:
+        if scan_path.suffix == ARCHIVE_SUFFIX:
+            with ScanArchive(scan_path) as archive:
+                slices = read_slices([archive.open(name) for name in archive.names() if name.endswith('.dcm')])
+        else:
+            slices = read_slices([str(path) for path in dicom_files])
+        data, affine = stack_slices(slices)
+    except ConversionSkipped as e:
+        return dict(result, status='skipped', reason=str(e))
+
+    if data.shape[3] == 1:
+        data = data[..., 0]
+    image = nibabel.Nifti1Image(data, affine)
+    image.set_qform(affine, code=1)
+    image.set_sform(affine, code=1)
+    header = image.header
+    header.set_xyzt_units('mm', 'sec')
+    repetition_time = slices[0].get('RepetitionTime')
+    if data.ndim == 4 and repetition_time:
+        header.set_zooms(header.get_zooms()[:3] + (float(repetition_time) / 1000,))
+
+    # Write under a temporary name so an interrupted conversion never looks finished
+    partial = output.with_name(output.name.replace('.nii.gz', '.part.nii.gz'))
+    try:
+        nibabel.save(image, str(partial))
+        partial.replace(output)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    return dict(result, status='converted', shape=list(data.shape), seconds=round(time.time() - start, 2))
+
+class ConversionPool:
+    """Convert scans in worker processes while the caller keeps downloading.
+
+    `submit` returns at once. Leaving the context waits for the remaining
+    conversions and logs a summary. Conversion errors are logged, not raised,
+    so a scan that cannot be converted never fails its download.
+    """
+
+    def __init__(self, processes=DEFAULT_PROCESSES):
+        if nibabel is None:
+            raise RuntimeError("DICOM to NIfTI conversion needs the pydicom, numpy and nibabel packages "
+                               "(pip install pydicom nibabel)")
+        self.pool = ProcessPoolExecutor(max_workers=processes)
+        # Start the worker processes now: forking once download threads are running is not safe
+        self.pool.submit(int).result()
+        self.outcomes = Counter()
+        self._lock = threading.Lock()
+
+    def submit(self, scan_path):
+        """Queue a scan directory or scan archive for conversion."""
+        future = self.pool.submit(convert_scan, str(scan_path))
+        future.add_done_callback(lambda done: self._record(scan_path, done))
+
+    def _record(self, scan_path, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.error(f"      Converting {scan_path} to NIfTI failed: {str(e)}")
+            status = 'failed'
+        else:
+            status = result['status']
+            if status == 'converted':
+                logging.info(f"      Converted {scan_path} to {Path(result['output']).name} "
+                             f"{tuple(result['shape'])} in {result['seconds']:.1f}s")
+            elif status == 'skipped':
+                logging.warning(f"      Not converting {scan_path}: {result['reason']}")
+        with self._lock:
+            self.outcomes[status] += 1
+
+    def close(self):
+        """Wait for the queued conversions and log how they went."""
+        self.pool.shutdown(wait=True)
+        if self.outcomes:
+            summary = ', '.join(f"{count} {status}" for status, count in sorted(self.outcomes.items()))
+            logging.info(f"NIfTI conversion: {summary}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+"""
+DICOM header index of a download directory, and a small query tool for it.
+
+With `--header-index`, session-download-v1.py reads the header of every
+DICOM file once its scan is in place (stopping before the pixel data) and
+stores a selection of tags in `<download dir>/dicom_headers.sqlite`, one row
+per file keyed by subject, session, scan and file name. Cohort questions can
+then be answered from the index without opening any DICOM file again:
+
+    python xnat_headers.py downloads --where "SeriesDescription~bold" TR=2000 field=3
+    python xnat_headers.py downloads --files --where scan=4 --columns InstanceNumber SliceLocation
+    python xnat_headers.py downloads --sql "SELECT Manufacturer, count(*) FROM headers GROUP BY 1"
+
+By default one row per scan is printed. Numeric tags are stored as numbers
+in DICOM units, so the repetition time is in milliseconds.
+
+Requires the pydicom package to build the index (pip install pydicom);
+querying only needs Python.
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+
+from xnat_archive import SUFFIX as ARCHIVE_SUFFIX, ScanArchive
+
+INDEX_NAME = 'dicom_headers.sqlite'
+
+# Tags copied into the index. Patient names and IDs are left out on purpose
+TAGS = [
+    'Modality', 'Manufacturer', 'ManufacturerModelName', 'MagneticFieldStrength',
+    'StudyDate', 'StudyInstanceUID', 'SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription',
+    'ProtocolName', 'SequenceName', 'ScanningSequence', 'ImageType',
+    'SOPInstanceUID', 'InstanceNumber', 'AcquisitionNumber', 'AcquisitionTime',
+    'RepetitionTime', 'EchoTime', 'InversionTime', 'FlipAngle', 'EchoNumbers',
+    'SliceThickness', 'SpacingBetweenSlices', 'SliceLocation', 'PixelSpacing', 'Rows', 'Columns',
+    'NumberOfFrames', 'ImagePositionPatient', 'ImageOrientationPatient', 'PatientSex', 'PatientAge',
+]
+# Tags stored and compared as numbers; all other columns hold text
+NUMERIC_TAGS = {
+    'MagneticFieldStrength', 'SeriesNumber', 'InstanceNumber', 'AcquisitionNumber', 'RepetitionTime', 'EchoTime',
+    'InversionTime', 'FlipAngle', 'EchoNumbers', 'SliceThickness', 'SpacingBetweenSlices', 'SliceLocation',
+    'Rows', 'Columns', 'NumberOfFrames', 'indexed_at',
+}
+KEY_COLUMNS = ['subject', 'session', 'scan', 'scan_type', 'file']
+COLUMNS = KEY_COLUMNS + ['path'] + TAGS + ['indexed_at']
+
+# Short names accepted by the query tool
+ALIASES = {'TR': 'RepetitionTime', 'TE': 'EchoTime', 'TI': 'InversionTime', 'field': 'MagneticFieldStrength',
+           'description': 'SeriesDescription', 'protocol': 'ProtocolName', 'instance': 'InstanceNumber'}
+
+DEFAULT_SCAN_COLUMNS = ['SeriesDescription', 'RepetitionTime', 'EchoTime', 'MagneticFieldStrength', 'Rows', 'Columns']
+
+def tag_value(dataset, tag):
+    """Return a tag as a number, a string (multiple values joined by backslashes) or None."""
+    value = dataset.get(tag)
+    if value is None or value == '':
+        return None
+    if isinstance(value, pydicom.multival.MultiValue):
+        return '\\'.join(str(item) for item in value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, int):
+        return int(value)
+    return str(value)
+
+def read_header(source):
+    """Read the indexed tags of a DICOM file (path or file object) without its pixel data.
+    Returns None for files that are not DICOM."""
+    try:
+        dataset = pydicom.dcmread(source, stop_before_pixels=True)
+    except Exception:
+        return None
+    return {tag: tag_value(dataset, tag) for tag in TAGS}
+
+class HeaderIndex:
+    """SQLite index of DICOM headers below a download directory, safe to use from several threads and processes."""
+
+    def __init__(self, download_dir):
+        if pydicom is None:
+            raise RuntimeError("The DICOM header index needs the pydicom package (pip install pydicom)")
+        self.download_dir = Path(download_dir)
+        self.path = self.download_dir / INDEX_NAME
+        self._local = threading.local()
+        db = self._connection()
+        columns = ', '.join(f"{column} {'NUMERIC' if column in NUMERIC_TAGS else 'TEXT'}" for column in COLUMNS)
+        db.execute(f"CREATE TABLE IF NOT EXISTS headers ({columns}, "
+                   f"PRIMARY KEY (subject, session, scan, file))")
+        db.execute('CREATE INDEX IF NOT EXISTS headers_series ON headers (SeriesDescription, RepetitionTime)')
+        db.commit()
+
+    def _connection(self):
+        """Return this thread's database connection, opening it on first use."""
+        db = getattr(self._local, 'db', None)
+        # A process forked from this one must not share its connection
+        if db is None or self._local.pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=60)
+            # Let worker processes write while others read
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def is_current(self, subject, session, scan, files, modified):
+        """Check if a scan is indexed with `files` files, all indexed after `modified`."""
+        count, oldest = self._connection().execute(
+            'SELECT count(*), min(indexed_at) FROM headers WHERE subject = ? AND session = ? AND scan = ?',
+            (subject, session, scan)).fetchone()
+        return count == files and oldest is not None and oldest >= modified
+
+    def index_scan(self, scan_path, subject, session, scan, scan_type):
+        """Index the DICOM files of a scan directory or scan archive.
+        Returns the number of files read, or 0 if the index was already up to date."""
+        scan_path = Path(scan_path)
+        if scan_path.suffix == ARCHIVE_SUFFIX:
+            if not scan_path.is_file():
+                return 0
+            with ScanArchive(scan_path) as archive:
+                names = [name for name in archive.names() if name.endswith('.dcm')]
+                if self.is_current(subject, session, scan, len(names), scan_path.stat().st_mtime):
+                    return 0
+                headers = [(name, read_header(archive.open(name))) for name in names]
+        else:
+            files = sorted(scan_path.glob('*.dcm'))
+            modified = max((file.stat().st_mtime for file in files), default=0)
+            if self.is_current(subject, session, scan, len(files), modified):
+                return 0
+            headers = [(file.name, read_header(str(file))) for file in files]
+
+        relative = os.path.relpath(scan_path, self.download_dir)
+        now = time.time()
+        rows = [(subject, session, scan, scan_type, name, relative,
+                 *((header or {}).get(tag) for tag in TAGS), now) for name, header in headers]
+        db = self._connection()
+        with db:
+            # Replace the whole scan so files removed from it disappear from the index too
+            db.execute('DELETE FROM headers WHERE subject = ? AND session = ? AND scan = ?', (subject, session, scan))
+            db.executemany(f"INSERT INTO headers VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+        return len(rows)
+
+# --- Query tool ---
+
+CONDITION = re.compile(r'^(\w+)\s*(!=|>=|<=|=|>|<|~)\s*(.*)$')
+
+def column_name(name):
+    """Resolve a column name or alias, refusing anything that is not a known column."""
+    name = ALIASES.get(name, name)
+    if name not in COLUMNS:
+        raise ValueError(f"Unknown column {name!r}; known columns: {', '.join(COLUMNS)}")
+    return name
+
+def parse_condition(text):
+    """Turn `Tag=value`, `Tag>value`, `Tag~text` (contains, ignoring case) etc. into SQL and parameters."""
+    match = CONDITION.match(text)
+    if not match:
+        raise ValueError(f"Cannot parse condition {text!r}; use e.g. TR=2000, EchoTime<40 or SeriesDescription~bold")
+    name, operator, value = match.groups()
+    name = column_name(name)
+    if operator == '~':
+        return f"{name} LIKE ?", [f"%{value}%"]
+    if name in NUMERIC_TAGS:
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValueError(f"{name} is numeric, but {value!r} is not a number")
+    return f"{name} {operator} ?", [value]
+
+def build_query(conditions, columns=None, files=False):
+    """Build the SQL for a query: one row per file, or by default one row per scan."""
+    clauses, parameters = [], []
+    for condition in conditions:
+        clause, values = parse_condition(condition)
+        clauses.append(clause)
+        parameters += values
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+
+    if files:
+        selected = KEY_COLUMNS + [column_name(column) for column in columns or ['InstanceNumber']]
+        return f"SELECT {', '.join(selected)} FROM headers{where} ORDER BY subject, session, scan, file", parameters
+
+    selected = [column_name(column) for column in columns or DEFAULT_SCAN_COLUMNS]
+    return (f"SELECT subject, session, scan, scan_type, count(*) AS files, "
+            f"{', '.join(f'min({column}) AS {column}' for column in selected)} "
+            f"FROM headers{where} GROUP BY subject, session, scan ORDER BY subject, session, scan"), parameters
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return '' if value is None else str(value)
+
+def print_rows(names, rows, output_format='table', out=sys.stdout):
+    if output_format == 'json':
+        json.dump([dict(zip(names, row)) for row in rows], out, indent=2)
+        out.write('\n')
+    elif output_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(names)
+        writer.writerows(rows)
+    else:
+        text = [[format_value(value) for value in row] for row in rows]
+        widths = [max([len(name)] + [len(row[i]) for row in text]) for i, name in enumerate(names)]
+        out.write('  '.join(name.ljust(width) for name, width in zip(names, widths)).rstrip() + '\n')
+        for row in text:
+            out.write('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() + '\n')
+        out.write(f"({len(rows)} row{'s' if len(rows) != 1 else ''})\n")
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the DICOM header index of a download directory')
+    parser.add_argument('download_dir', help='Download directory holding dicom_headers.sqlite')
+    parser.add_argument('--where', nargs='+', default=[], metavar='CONDITION',
+                        help='Conditions such as TR=2000, EchoTime<40 or SeriesDescription~bold (all must hold)')
+    parser.add_argument('--columns', nargs='+', help='Tags to show (default: a few series tags, or InstanceNumber with --files)')
+    parser.add_argument('--files', action='store_true', help='List matching files instead of scans')
+    parser.add_argument('--sql', help='Run this SQL query against the headers table instead')
+    parser.add_argument('--format', choices=['table', 'csv', 'json'], default='table', help='Output format')
+    args = parser.parse_args()
+
+    path = Path(args.download_dir) / INDEX_NAME
+    if not path.exists():
+        parser.error(f"No header index at {path}; download with --header-index first")
+    try:
+        query, parameters = (args.sql, []) if args.sql else build_query(args.where, args.columns, args.files)
+    except ValueError as e:
+        parser.error(str(e))
+
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    cursor = db.execute(query, parameters)
+    print_rows([description[0] for description in cursor.description], cursor.fetchall(), args.format)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+"""
+Transfer metrics for the XNAT download and upload scripts.
+
+Records bytes, files and elapsed time for every scan, session and subject,
+prints a live progress line with the current throughput and an ETA, and at
+the end of a run writes a JSON report and a Prometheus textfile (for the
+node_exporter textfile collector) next to the `download_complete` marker.
+
+Bytes and files are counted where each file is finished: the download paths
+(xnat, zip streaming, per-file and the async engine) report every complete
+file to `record_file`, which adds it to the open scan, session and subject
+spans whose directory contains it. Nothing walks the download tree, and a
+file fetched again counts again. The progress line additionally counts bytes
+as they arrive from the server. Uploads write nothing locally: their spans
+have no directory and report the bytes and files sent in `details` instead.
+"""
+
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+REPORT_NAME = 'run_report.json'
+PROMETHEUS_NAME = 'download_metrics.prom'
+# Upload runs write their own reports, so they can share a logs directory with downloads
+UPLOAD_REPORT_NAME = 'upload_report.json'
+UPLOAD_PROMETHEUS_NAME = 'upload_metrics.prom'
+
+def format_bytes(nbytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(nbytes) < 1000:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1000
+    return f"{nbytes:.1f} TB"
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+class Span:
+    """Measurement of one scan, session or subject; set `status` to override the default.
+    Values put in `details` are stored with the measurement (and replace measured ones)."""
+
+    def __init__(self, level, labels):
+        self.level = level
+        self.labels = labels
+        self.status = 'complete'
+        self.details = {}
+        self.files = 0
+        self.bytes = 0
+
+class TransferMetrics:
+    """Thread-safe collection of transfer measurements for one run.
+
+    `unit` is the level at which the run downloads data ('scan' for DICOM
+    downloads, 'session' for resource downloads); totals and the ETA are
+    computed from the spans of that level. `direction` is 'upload' for runs
+    that send data to the server.
+    """
+
+    def __init__(self, unit='scan', direction='download'):
+        self.unit = unit
+        self.direction = direction
+        self.started = time.time()
+        self.bytes_received = 0
+        self.expected = 0
+        self.records = []
+        self._open = {}  # Directory (or archive file) -> spans measuring what is written below it
+        self._lock = threading.Lock()
+
+    def add_bytes(self, nbytes):
+        """Count bytes received from (or, for uploads, sent to) the server (used for the live throughput)."""
+        with self._lock:
+            self.bytes_received += nbytes
+
+    def expect(self, count):
+        """Announce units (scans or sessions) that will be processed, for the ETA."""
+        with self._lock:
+            self.expected += count
+
+    def record_file(self, path, nbytes=None):
+        """Count a file written completely (nbytes defaults to its size on disk)
+        in every open span whose directory contains it."""
+        path = Path(os.path.abspath(path))
+        with self._lock:
+            spans = [span for directory in (path, *path.parents) for span in self._open.get(directory, ())]
+        if not spans:
+            return
+        if nbytes is None:
+            try:
+                nbytes = path.stat().st_size
+            except OSError:
+                return  # Moved or removed while we were looking
+        with self._lock:
+            for span in spans:
+                span.files += 1
+                span.bytes += nbytes
+
+    @contextmanager
+    def measure(self, level, directory, **labels):
+        """Measure the files recorded below directory (None to measure nothing) while the block runs.
+        The span is recorded as failed if the block raises."""
+        span = Span(level, labels)
+        key = Path(os.path.abspath(directory)) if directory is not None else None
+        if key is not None:
+            with self._lock:
+                self._open.setdefault(key, []).append(span)
+        start = time.time()
+        try:
+            yield span
+        except BaseException:
+            span.status = 'failed'
+            raise
+        finally:
+            record = dict(labels, level=level, status=span.status, seconds=round(time.time() - start, 3),
+                          bytes=span.bytes, files=span.files)
+            record.update(span.details)
+            with self._lock:
+                if key is not None:
+                    self._open[key].remove(span)
+                    if not self._open[key]:
+                        del self._open[key]
+                self.records.append(record)
+
+    def units_done(self):
+        with self._lock:
+            return sum(1 for record in self.records if record['level'] == self.unit)
+
+    def export(self):
+        """Return the measurements in a picklable form, e.g. to send them from a worker process."""
+        with self._lock:
+            return {'records': list(self.records), 'bytes_received': self.bytes_received}
+
+    def merge(self, exported):
+        """Add the measurements exported by another process."""
+        with self._lock:
+            self.records.extend(exported['records'])
+            self.bytes_received += exported['bytes_received']
+
+    # --- Live progress ---
+
+    def count_file_responses(self, xnat_session):
+        """Count the bytes of file downloads made through the xnat session's requests session."""
+        def hook(response, *args, **kwargs):
+            raw = response.raw
+            if raw is None or '/files' not in response.url:
+                return response
+            read = raw.read
+            read_chunked = getattr(raw, 'read_chunked', None)
+
+            def counting_read(*read_args, **read_kwargs):
+                data = read(*read_args, **read_kwargs)
+                self.add_bytes(len(data))
+                return data
+
+            def counting_read_chunked(*read_args, **read_kwargs):
+                # iter_content reads chunked responses through this instead of read
+                for data in read_chunked(*read_args, **read_kwargs):
+                    self.add_bytes(len(data))
+                    yield data
+
+            raw.read = counting_read
+            if read_chunked is not None:
+                raw.read_chunked = counting_read_chunked
+            return response
+
+        xnat_session.interface.hooks['response'].append(hook)
+
+    def progress_line(self, window_start, window_bytes):
+        """Build the progress text from the bytes received since window_start."""
+        now = time.time()
+        with self._lock:
+            received = self.bytes_received
+            expected = self.expected
+        done = self.units_done()
+        current_rate = (received - window_bytes) / max(now - window_start, 1e-6)
+        line = f"{format_bytes(received)} {'sent' if self.direction == 'upload' else 'received'} | {format_bytes(current_rate)}/s | {self.unit}s {done}/{expected}"
+        if 0 < done < expected:
+            line += f" | ETA {format_duration((now - self.started) / done * (expected - done))}"
+        return line, received
+
+    @contextmanager
+    def progress(self, interval=10.0, label=''):
+        """Show a progress line every `interval` seconds while the block runs.
+        On a terminal the line is redrawn in place; otherwise it is logged."""
+        if not interval or interval <= 0:
+            yield
+            return
+
+        interactive = sys.stderr.isatty()
+        stop = threading.Event()
+        prefix = f"[{label}] " if label else ''
+
+        def report():
+            window_start, window_bytes = time.time(), 0
+            while not stop.wait(interval):
+                line, window_bytes_now = self.progress_line(window_start, window_bytes)
+                window_start, window_bytes = time.time(), window_bytes_now
+                if interactive:
+                    sys.stderr.write(f"\r{prefix}{line}\033[K")
+                    sys.stderr.flush()
+                else:
+                    logging.info(f"{prefix}Progress: {line}")
+            if interactive:
+                sys.stderr.write('\n')
+
+        thread = threading.Thread(target=report, name='xnat-progress', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    # --- Reports ---
+
+    def report(self, status, **details):
+        """Build the run report: totals plus subjects > sessions > scans."""
+        finished = time.time()
+        seconds = finished - self.started
+        with self._lock:
+            records = list(self.records)
+            bytes_received = self.bytes_received
+
+        units = [record for record in records if record['level'] == self.unit]
+        total_bytes = sum(record['bytes'] for record in units)
+        total_files = sum(record['files'] for record in units)
+        unit_status = {}
+        for record in units:
+            unit_status[record['status']] = unit_status.get(record['status'], 0) + 1
+
+        def strip(record, *keys):
+            return {key: value for key, value in record.items() if key not in ('level',) + keys}
+
+        subjects = []
+        for subject in (r for r in records if r['level'] == 'subject'):
+            sessions = []
+            for session in (r for r in records if r['level'] == 'session' and r['subject'] == subject['subject']):
+                session_scans = [strip(r, 'subject', 'session') for r in records if r['level'] == 'scan'
+                                 and r['subject'] == subject['subject'] and r['session'] == session['session']]
+                sessions.append(dict(strip(session, 'subject'), scans=session_scans) if session_scans
+                                else strip(session, 'subject'))
+            subjects.append(dict(strip(subject), sessions=sessions))
+
+        return {
+            'status': status,
+            'host': socket.gethostname(),
+            'started': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+            'finished': datetime.fromtimestamp(finished, timezone.utc).isoformat(),
+            'seconds': round(seconds, 3),
+            **details,
+            'totals': {
+                'bytes': total_bytes, 'files': total_files,
+                'bytes_sent' if self.direction == 'upload' else 'bytes_received': bytes_received,
+                f"{self.unit}s": unit_status,
+                'bytes_per_second': round(total_bytes / seconds, 1) if seconds else 0,
+                'files_per_second': round(total_files / seconds, 2) if seconds else 0,
+            },
+            'subjects': subjects,
+        }
+
+    def write_reports(self, directory, status, job='xnat_download', **details):
+        """Write the JSON report and the Prometheus textfile into directory. Returns the report."""
+        report = self.report(status, **details)
+        directory = Path(directory)
+        upload = self.direction == 'upload'
+        write_atomically(directory / (UPLOAD_REPORT_NAME if upload else REPORT_NAME), json.dumps(report, indent=2))
+        write_atomically(directory / (UPLOAD_PROMETHEUS_NAME if upload else PROMETHEUS_NAME),
+                         prometheus_text(report, job, self.direction))
+        return report
+
+def prometheus_text(report, job, direction='download'):
+    """Render the totals of a run report in the Prometheus text exposition format.
+    Upload runs get metrics named xnat_upload_* instead of xnat_download_*."""
+    labels = f'job="{job}",host="{report["host"]}"'
+    if report.get('project'):
+        labels += f',project="{report["project"]}"'
+    totals = report['totals']
+    moved, kind = ('uploaded', 'upload') if direction == 'upload' else ('written to disk', 'write')
+    metrics = [
+        ('bytes', f'Bytes {moved} by the last run', totals['bytes']),
+        ('files', f'Files {moved} by the last run', totals['files']),
+        ('duration_seconds', 'Wall time of the last run', report['seconds']),
+        ('throughput_bytes_per_second', f'Average {kind} throughput of the last run', totals['bytes_per_second']),
+        ('success', '1 if the last run completed, 0 if it failed', int(report['status'] == 'complete')),
+        ('last_run_timestamp_seconds', 'Unix time at which the last run finished',
+         round(datetime.fromisoformat(report['finished']).timestamp())),
+    ]
+    prefix = f"xnat_{direction}"
+    lines = []
+    for name, help_text, value in metrics:
+        lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} gauge",
+                  f"{prefix}_{name}{{{labels}}} {value}"]
+    for unit in ('scans', 'sessions'):
+        if unit not in totals:
+            continue
+        lines += [f"# HELP {prefix}_{unit} {unit.capitalize()} of the last run by outcome",
+                  f"# TYPE {prefix}_{unit} gauge"]
+        for status, count in sorted(totals[unit].items()):
+            lines.append(f'{prefix}_{unit}{{{labels},status="{status}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+def write_atomically(path, text):
+    """Write text via a temporary file so readers never see a half-written file."""
+    temporary = path.with_name(path.name + '.tmp')
+    temporary.write_text(text)
+    temporary.replace(path)
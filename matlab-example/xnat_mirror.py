@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""
+Incremental project mirrors driven by modification watermarks (`--mirror`).
+
+A nightly pull of an active study walks every subject, session and scan over
+REST just to find out that most of them are already on disk, so the run
+takes time proportional to the size of the project. In mirror mode the run
+starts with one listing of all the project's sessions together with the
+time XNAT last changed each of them (`insert_date` and `last_modified`; a
+session changes when scans or files are added to it). Only sessions changed
+since the previous run are opened, so the run costs one request plus work
+proportional to the new data.
+
+The high-water mark, the latest modification time seen by the last complete
+run, is kept in `.xnat-mirror.json` in the download directory together with
+the selection it applies to:
+
+    {"server": ..., "project": ..., "selection": {...},
+     "watermark": "2024-05-02 03:14:15.926", "at_watermark": ["XNAT_E01234"], "updated": ...}
+
+The watermark is a server timestamp, so the clocks of the server and the
+machine running the mirror need not agree. It only moves forward after a
+run in which every session was downloaded; after a failed run the next one
+looks at the same sessions again. Several sessions can share a timestamp,
+so the IDs of the sessions changed at exactly the watermark are kept too: a
+session listed later with the same timestamp still counts as changed. A different
+server, project or selection starts over with every session. Data deleted
+on the server is not deleted from the mirror.
+"""
+
+import json
+import logging
+from datetime import datetime, timezone
+from pathlib import Path
+
+MIRROR_FILE = '.xnat-mirror.json'
+LISTING_COLUMNS = 'ID,label,subject_label,insert_date,last_modified'
+
+def modification_time(row):
+    """Return the time XNAT last changed a session listing row (its insert date if it was never modified)."""
+    return max(row.get('last_modified') or '', row.get('insert_date') or '')
+
+def list_project_sessions(interface, server_url, project_id):
+    """List every session of a project with its modification time, in one request.
+    Returns dicts with the session ID, label, subject label and modified time."""
+    response = interface.get(f"{server_url.rstrip('/')}/data/projects/{project_id}/experiments",
+                             params={'format': 'json', 'columns': LISTING_COLUMNS})
+    response.raise_for_status()
+    return [{'id': row['ID'], 'label': row['label'], 'subject': row.get('subject_label'),
+             'modified': modification_time(row)}
+            for row in response.json()['ResultSet']['Result']]
+
+def changed_sessions(rows, watermark, at_watermark=()):
+    """Return the listed sessions changed after the watermark, or at it if their ID is not in
+    at_watermark (all of them without a watermark). Sessions without a modification time always count as changed."""
+    if watermark is None:
+        return list(rows)
+    return [row for row in rows if not row['modified'] or row['modified'] > watermark
+            or (row['modified'] == watermark and row['id'] not in at_watermark)]
+
+def new_watermark(rows, watermark, at_watermark=()):
+    """Return the watermark and the IDs of the sessions at it after all listed sessions were downloaded.
+    The watermark never moves back, e.g. when the newest sessions were deleted."""
+    latest = max([row['modified'] for row in rows if row['modified']] + ([watermark] if watermark else []), default=None)
+    at_latest = {row['id'] for row in rows if row['modified'] == latest}
+    if latest == watermark:
+        at_latest |= set(at_watermark)
+    return latest, sorted(at_latest)
+
+class MirrorState:
+    """The watermark of a download directory, stored in MIRROR_FILE."""
+
+    def __init__(self, download_dir, server_url, project_id, selection):
+        self.path = Path(download_dir) / MIRROR_FILE
+        self.server = server_url.rstrip('/')
+        self.project = project_id
+        self.selection = selection
+
+    def watermark(self):
+        """Return the watermark of the last complete run with the same server, project and selection
+        and the IDs of the sessions at it, or (None, [])."""
+        try:
+            state = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return None, []
+        if (state.get('server'), state.get('project')) != (self.server, self.project):
+            logging.warning(f"{self.path} belongs to project {state.get('project')} on {state.get('server')}, "
+                            f"checking every session")
+            return None, []
+        if state.get('selection') != self.selection:
+            logging.info("The selection changed since the last mirror run, checking every session")
+            return None, []
+        return state.get('watermark'), state.get('at_watermark', [])
+
+    def save(self, watermark, at_watermark):
+        """Store the watermark of a complete run."""
+        state = {'server': self.server, 'project': self.project, 'selection': self.selection,
+                 'watermark': watermark, 'at_watermark': at_watermark,
+                 'updated': datetime.now(timezone.utc).isoformat()}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_name(self.path.name + '.tmp')
+        temporary.write_text(json.dumps(state, indent=2))
+        temporary.replace(self.path)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"""
+Download plans: size a pull before any data moves (`--plan`, `--execute-plan`).
+
+`--plan plan.json` resolves the selected subjects, sessions and scan types,
+reads the file count and size of every scan's DICOM resource, compares them
+with what is already in the download directory and writes the result to a
+plan file instead of downloading. It costs one listing request per subject
+and session and one resource listing per scan. The plan holds the totals, the
+scans still to download and an estimate of the wall time, based on the scans
+downloaded by the last run in the same logs directory (its run report).
+
+The plan is plain JSON, so it can be checked, filtered or split by hand
+before it is run with `--execute-plan plan.json`, which downloads exactly the
+scans marked `download` in it and nothing else:
+
+    {"version": 1, "server": ..., "project": ..., "totals": {...}, "estimate": {...},
+     "scans": [{"subject": ..., "session": ..., "experiment": ..., "scan": ..., "type": ...,
+                "files": 176, "bytes": 92274688, "local": "partial", "missing_files": 40,
+                "missing_bytes": 20971520, "download": true}, ...]}
+"""
+
+import json
+import logging
+from datetime import datetime, timezone
+from pathlib import Path
+
+from xnat_metrics import REPORT_NAME, format_bytes, format_duration
+from xnat_schedule import ThroughputModel, largest_first, lpt_shares, predict_makespan
+
+PLAN_VERSION = 1
+
+class RequestCounter:
+    """Count the requests an xnat session sends to the server (responses from the metadata cache excluded)."""
+
+    def __init__(self, xnat_session):
+        self.count = 0
+        xnat_session.interface.hooks['response'].append(self._hook)
+
+    def _hook(self, response, *args, **kwargs):
+        if response.raw is not None:
+            self.count += 1
+        return response
+
+def local_state(local_files, server_files):
+    """Classify the local copy of a scan: 'present', 'partial' or 'missing'."""
+    if local_files == 0:
+        return 'missing'
+    return 'present' if local_files >= server_files else 'partial'
+
+def recent_throughput(logs_dir):
+    """Return a throughput model fitted to the last run written to logs_dir and a description of its source."""
+    path = Path(logs_dir) / REPORT_NAME
+    try:
+        report = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return ThroughputModel(), 'defaults (no earlier run report)'
+    model = ThroughputModel.from_report(report)
+    if not model.observations:
+        return model, f"defaults (the run of {report.get('finished', '?')} downloaded no scans)"
+    return model, f"{len(model.observations)} scans downloaded by the run of {report.get('finished', '?')}"
+
+def estimate_seconds(scans, model, jobs, workers):
+    """Estimate the wall time of downloading scans (plan entries) with --jobs and --workers:
+    subjects are shared over the workers by size, each session's scans are downloaded largest first."""
+    subjects = {}
+    for entry in scans:
+        subjects.setdefault(entry['subject'], []).append(entry)
+    shares = lpt_shares(list(subjects), [sum(e['bytes'] for e in subjects[s]) for s in subjects], workers)
+    worker_seconds = [0.0]
+    for share in shares:
+        seconds = 0.0
+        for subject in share:
+            sessions = {}
+            for entry in subjects[subject]:
+                sessions.setdefault(entry['experiment'], []).append(entry)
+            for entries in sessions.values():
+                durations = [model.predict(entry['bytes']) for entry in entries]
+                seconds += predict_makespan(largest_first(durations, durations), jobs)
+        worker_seconds.append(seconds)
+    return max(worker_seconds)
+
+def build_plan(scans, selection, server, project, jobs, workers, logs_dir, requests=None, missing_subjects=()):
+    """Put the sized scans (plan entries) together with their totals and a wall time estimate."""
+    to_download = [entry for entry in scans if entry['download']]
+    model, source = recent_throughput(logs_dir)
+    # Partially present scans only fetch their missing files
+    pending = [dict(entry, bytes=entry['missing_bytes']) for entry in to_download]
+    return {
+        'version': PLAN_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'server': server,
+        'project': project,
+        'selection': selection,
+        'totals': {
+            'subjects': len({entry['subject'] for entry in scans}),
+            'sessions': len({entry['experiment'] for entry in scans}),
+            'scans': len(scans),
+            'files': sum(entry['files'] for entry in scans),
+            'bytes': sum(entry['bytes'] for entry in scans),
+            'present_scans': sum(1 for entry in scans if entry['local'] == 'present'),
+            'download_scans': len(to_download),
+            'download_files': sum(entry['missing_files'] for entry in to_download),
+            'download_bytes': sum(entry['missing_bytes'] for entry in to_download),
+        },
+        'estimate': {
+            'seconds': round(estimate_seconds(pending, model, jobs, workers), 1),
+            'jobs': jobs,
+            'workers': workers,
+            'model': model.describe(),
+            'based_on': source,
+        },
+        'requests': requests,
+        'missing_subjects': list(missing_subjects),
+        'scans': scans,
+    }
+
+def write_plan(path, plan):
+    path = Path(path)
+    temporary = path.with_name(path.name + '.tmp')
+    temporary.write_text(json.dumps(plan, indent=2))
+    temporary.replace(path)
+
+def read_plan(path):
+    """Read a plan file. Raises ValueError if it is not a plan this version can run."""
+    try:
+        plan = json.loads(Path(path).read_text())
+    except OSError as e:
+        raise ValueError(f"Cannot read plan {path}: {e}")
+    if not isinstance(plan, dict) or plan.get('version') != PLAN_VERSION or 'scans' not in plan:
+        raise ValueError(f"{path} is not a download plan of version {PLAN_VERSION}")
+    return plan
+
+def planned_scans(plan):
+    """Return the scans a plan marks for download as {subject: {experiment ID: {scan ID: bytes to fetch}}}."""
+    planned = {}
+    for entry in plan['scans']:
+        if entry.get('download', True):
+            planned.setdefault(entry['subject'], {}).setdefault(entry['experiment'], {})[entry['scan']] = \
+                entry.get('missing_bytes', entry.get('bytes', 0))
+    return planned
+
+def log_plan(plan):
+    totals = plan['totals']
+    estimate = plan['estimate']
+    logging.info("\n=== Download Plan ===")
+    logging.info(f"Selected: {totals['subjects']} subjects, {totals['sessions']} sessions, {totals['scans']} scans, "
+                 f"{totals['files']} files, {format_bytes(totals['bytes'])}")
+    logging.info(f"Already present: {totals['present_scans']} scans")
+    logging.info(f"To download: {totals['download_scans']} scans, {totals['download_files']} files, "
+                 f"{format_bytes(totals['download_bytes'])}")
+    logging.info(f"Estimated time: {format_duration(estimate['seconds'])} with {estimate['jobs']} jobs and "
+                 f"{estimate['workers']} workers at {estimate['model']}, from {estimate['based_on']}")
+    if plan['missing_subjects']:
+        logging.warning(f"Subjects not found in project: {plan['missing_subjects']}")
+    if plan['requests'] is not None:
+        logging.info(f"Planning took {plan['requests']} requests to the server")
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+"""
+Opt-in phase profiling for the XNAT download scripts (`--profile`).
+
+The scripts wrap their phases (connecting, metadata lookups, skip checks,
+transfer, extraction, moving files into place) in timed spans. Every HTTP
+request made through the xnat session is counted against the phase that was
+running in its thread, so N+1 request patterns show up as one phase with
+many requests. For file downloads the time until the server starts sending
+(for zips, mostly XNAT building the archive) is split off as `server-wait`.
+
+At the end a summary table is logged and a trace file in Chrome trace event
+format is written, which can be opened in https://ui.perfetto.dev or
+chrome://tracing. Optionally the main thread also runs under cProfile.
+"""
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlsplit
+
+TRACE_NAME = 'profile_trace.json'
+CPROFILE_NAME = 'profile.pstats'
+
+# Phase used for requests made outside any span
+NO_PHASE = 'other'
+
+def endpoint_pattern(url):
+    """Reduce a REST URL to its endpoint by replacing IDs and file names with placeholders."""
+    path = urlsplit(url).path
+    path = re.sub(r'/files/.+$', '/files/*', path)
+    return re.sub(r'/(projects|subjects|experiments|scans|resources|assessors|reconstructions)/[^/]+',
+                  r'/\1/*', path)
+
+class Profiler:
+    """Collects timed spans and request counts per phase. Does nothing unless enabled."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.events = []
+        self.phases = defaultdict(lambda: {'spans': 0, 'seconds': 0.0, 'requests': 0, 'cached': 0})
+        self.endpoints = Counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cprofile = None
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _event(self, name, category, start, seconds, **details):
+        return {'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                'ts': round((start - self.started) * 1e6), 'dur': round(seconds * 1e6), 'args': details}
+
+    @contextmanager
+    def span(self, phase, **details):
+        """Time the enclosed block as `phase`. Time spent in nested spans counts for those spans only."""
+        if not self.enabled:
+            yield
+            return
+
+        stack = self._stack()
+        frame = {'phase': phase, 'children': 0.0}
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                stack[-1]['children'] += seconds
+            with self._lock:
+                totals = self.phases[phase]
+                totals['spans'] += 1
+                totals['seconds'] += seconds - frame['children']
+                self.events.append(self._event(phase, 'phase', start, seconds, **details))
+
+    def current_phase(self):
+        stack = self._stack()
+        return stack[-1]['phase'] if stack else NO_PHASE
+
+    def count_request(self, url, status, seconds, cached=False, phase=None):
+        """Count one HTTP request against the running phase (or `phase`)."""
+        if not self.enabled:
+            return
+        phase = phase or self.current_phase()
+        end = time.perf_counter()
+        with self._lock:
+            totals = self.phases[phase]
+            totals['requests'] += 1
+            totals['cached'] += int(cached)
+            self.endpoints[endpoint_pattern(url)] += 1
+            self.events.append(self._event(endpoint_pattern(url), 'http', end - seconds, seconds,
+                                           url=url, status=status, phase=phase, cached=cached))
+
+    def count_transfer_request(self, url, status, seconds):
+        """Count a file request made outside the xnat session, such as by the async engine."""
+        self.count_request(url, status, seconds, phase='transfer')
+
+    def add_server_wait(self, seconds):
+        """Book the time until a file response started as `server-wait` inside the running span."""
+        stack = self._stack()
+        if stack:
+            stack[-1]['children'] += seconds
+        with self._lock:
+            totals = self.phases['server-wait']
+            totals['spans'] += 1
+            totals['seconds'] += seconds
+            self.events.append(self._event('server-wait', 'phase', time.perf_counter() - seconds, seconds))
+
+    def instrument(self, xnat_session):
+        """Count the requests of an xnat session and split xnat's zip downloads into their own span."""
+        if not self.enabled:
+            return
+
+        def hook(response, *args, **kwargs):
+            # Responses served from the metadata cache have no raw connection and no elapsed time
+            cached = response.raw is None
+            seconds = response.elapsed.total_seconds() if not cached else 0.0
+            self.count_request(response.url, response.status_code, seconds, cached)
+            if kwargs.get('stream') and '/files' in response.url and not cached:
+                self.add_server_wait(seconds)
+            return response
+
+        xnat_session.interface.hooks['response'].append(hook)
+
+        # resource.download_dir downloads the zip and then unpacks it; time the download on its own
+        download_stream = xnat_session.download_stream
+
+        def timed_download_stream(*args, **kwargs):
+            with self.span('transfer'):
+                return download_stream(*args, **kwargs)
+
+        xnat_session.download_stream = timed_download_stream
+
+    # --- cProfile ---
+
+    def start_cprofile(self):
+        """Run cProfile on the calling thread until the results are written."""
+        if self.enabled:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    # --- Results ---
+
+    def export(self):
+        """Return the collected data in a picklable form, e.g. to send it from a worker process."""
+        with self._lock:
+            return {'events': list(self.events), 'phases': {k: dict(v) for k, v in self.phases.items()},
+                    'endpoints': dict(self.endpoints), 'started': self.started}
+
+    def merge(self, exported):
+        """Add the data collected by another process."""
+        if not self.enabled:
+            return
+        # perf_counter values of other processes share the same clock on one machine
+        shift = round((exported['started'] - self.started) * 1e6)
+        with self._lock:
+            for event in exported['events']:
+                self.events.append(dict(event, ts=event['ts'] + shift))
+            for phase, values in exported['phases'].items():
+                for key, value in values.items():
+                    self.phases[phase][key] += value
+            self.endpoints.update(exported['endpoints'])
+
+    def summary(self, top_endpoints=10):
+        """Return the per-phase summary table and the most requested endpoints as text."""
+        total = time.perf_counter() - self.started
+        lines = [f"{'Phase':<14}{'Spans':>8}{'Time (s)':>11}{'% of run':>10}{'Requests':>10}{'Cached':>8}{'ms/req':>9}",
+                 '-' * 70]
+        for phase, values in sorted(self.phases.items(), key=lambda item: -item[1]['seconds']):
+            network = values['requests'] - values['cached']
+            per_request = f"{values['seconds'] / network * 1000:.1f}" if network and phase != 'server-wait' else '-'
+            lines.append(f"{phase:<14}{values['spans']:>8}{values['seconds']:>11.2f}"
+                         f"{values['seconds'] / total * 100:>9.1f}%{values['requests']:>10}{values['cached']:>8}{per_request:>9}")
+        lines.append(f"Wall time {total:.2f} s; phase times of parallel threads and workers add up and can exceed it")
+        lines.append('')
+        lines.append('Most requested endpoints:')
+        for endpoint, count in self.endpoints.most_common(top_endpoints):
+            lines.append(f"{count:>8}  {endpoint}")
+        return '\n'.join(lines)
+
+    def write_results(self, directory):
+        """Log the summary and write the trace (and cProfile statistics) into directory."""
+        if not self.enabled:
+            return
+        directory = Path(directory)
+        with self._lock:
+            trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+        with open(directory / TRACE_NAME, 'w') as f:
+            json.dump(trace, f)
+        logging.info("\n=== Profile ===\n" + self.summary())
+        logging.info(f"Trace written to {directory / TRACE_NAME} (open it in https://ui.perfetto.dev)")
+
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(directory / CPROFILE_NAME)
+            text = io.StringIO()
+            pstats.Stats(self._cprofile, stream=text).sort_stats('cumulative').print_stats(25)
+            logging.info(f"cProfile of the main thread ({directory / CPROFILE_NAME}):\n{text.getvalue()}")
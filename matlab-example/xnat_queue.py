@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+"""
+Work queue on a shared file system, for spreading one download over many nodes.
+
+Splitting `--subjects` lists by hand over array jobs leaves nodes idle when
+session sizes are skewed. With `--queue <dir>` every job runs the same
+command: the first one to take the queue's lock lists one work item per scan
+and writes it to `<dir>/pending/`, and all of them (the first one included)
+claim items until none are left. Fast nodes simply claim more items.
+
+Nothing but the file system is needed:
+
+    pending/   items waiting to be claimed
+    claimed/   items being downloaded, named `<item>@<host>.<pid>.json`
+    done/      finished items
+    failed/    items that failed, with the error
+    ready      written once every item has been listed
+
+A claim is a rename from pending/ into claimed/, which only one process can
+win. While an item is being downloaded its worker touches the claimed file
+every few seconds (its lease). Items whose lease ran out, because their node
+died or lost the shared storage, are moved back to pending/ by the other
+workers; an item claimed MAX_CLAIMS times without finishing is failed
+instead. Lease times are compared against file times written by the file
+server, so the nodes' clocks do not need to agree.
+"""
+
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+
+DEFAULT_LEASE = 300  # Seconds a claim stays valid without being renewed
+MAX_CLAIMS = 3  # Claims of one item before it is given up as failed
+
+class Claim:
+    """An item claimed by this process."""
+
+    def __init__(self, name, path, item):
+        self.name = name
+        self.path = path
+        self.item = item
+
+class WorkQueue:
+    """Queue directory shared by any number of worker processes on any number of nodes."""
+
+    def __init__(self, directory, lease=DEFAULT_LEASE):
+        self.directory = Path(directory)
+        self.lease = lease
+        self.poll_interval = min(10.0, lease / 10)
+        self.worker = f"{socket.gethostname()}.{os.getpid()}"
+        for name in ('pending', 'claimed', 'done', 'failed', 'clock'):
+            (self.directory / name).mkdir(parents=True, exist_ok=True)
+        self.lock_path = self.directory / 'fill.lock'
+        self.ready_path = self.directory / 'ready'
+        self._claims = {}
+        self._holding_lock = False
+        self._lock = threading.Lock()
+        self._last_requeue = 0.0
+        self._heartbeat = None
+
+    @staticmethod
+    def item_name(item):
+        """File name of a work item: subject, session and scan, safe for any file system."""
+        return re.sub(r'[^\w.-]', '_', f"{item['subject']}__{item['session']}__scan-{item['scan']}")
+
+    def server_time(self):
+        """Current time according to the file server that stamps the queue's files."""
+        clock = self.directory / 'clock' / self.worker
+        clock.touch()
+        return clock.stat().st_mtime
+
+    def _write(self, path, data):
+        temporary = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        temporary.write_text(json.dumps(data))
+        temporary.replace(path)
+
+    # --- Filling the queue ---
+
+    def is_ready(self):
+        return self.ready_path.exists()
+
+    def _take_lock(self):
+        """Try to become the process that fills the queue."""
+        try:
+            os.close(os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        self._holding_lock = True
+        self._start_heartbeat()
+        return True
+
+    def stalled(self):
+        """Check if the process filling the queue died before it finished: its lock is no longer renewed."""
+        if self.is_ready():
+            return False
+        try:
+            return self.server_time() - self.lock_path.stat().st_mtime > self.lease
+        except FileNotFoundError:
+            return True
+
+    def _known(self, name):
+        if any((self.directory / state / f"{name}.json").exists() for state in ('pending', 'done', 'failed')):
+            return True
+        return any((self.directory / 'claimed').glob(f"{name}@*.json"))
+
+    def fill(self, list_items):
+        """List the work items into the queue unless another process does so (or did).
+        list_items is called only by the process that won the lock; it may be a generator,
+        so workers can start on the first items while the rest are still being listed.
+        Returns the number of items added by this process."""
+        if self.is_ready():
+            return 0
+        if not self._take_lock():
+            if not self.stalled():
+                return 0
+            # Take over from a process that died while filling: move its lock out of the way first,
+            # which only one of the waiting processes can do
+            stale = self.directory / 'clock' / f"stale-lock.{self.worker}"
+            try:
+                self.lock_path.replace(stale)
+            except FileNotFoundError:
+                return 0
+            if self.server_time() - stale.stat().st_mtime <= self.lease:
+                # Another waiting process took over in the meantime and this was its new lock
+                os.rename(stale, self.lock_path)
+                return 0
+            stale.unlink()
+            if not self._take_lock():
+                return 0
+            logging.warning(f"Taking over filling the work queue {self.directory} from a process that stopped")
+
+        added = 0
+        try:
+            for item in list_items():
+                name = self.item_name(item)
+                if self._known(name):
+                    continue  # Listed before a takeover
+                self._write(self.directory / 'pending' / f"{name}.json", dict(item, claims=0))
+                added += 1
+            self._write(self.ready_path, {'filled_by': self.worker, 'time': time.time()})
+        finally:
+            self._holding_lock = False
+        return added
+
+    # --- Claiming items ---
+
+    def claim(self):
+        """Claim the next pending item. Returns a Claim, or None if nothing is pending right now."""
+        now = time.monotonic()
+        if now - self._last_requeue > self.lease / 4:
+            self._last_requeue = now
+            self.requeue_expired()
+        pending = self.directory / 'pending'
+        for entry in sorted(os.listdir(pending)):
+            if not entry.endswith('.json') or entry.startswith('.'):
+                continue
+            name = entry[:-len('.json')]
+            path = self.directory / 'claimed' / f"{name}@{self.worker}.json"
+            try:
+                os.rename(pending / entry, path)
+            except FileNotFoundError:
+                continue  # Another worker was faster
+            os.utime(path)
+            item = json.loads(path.read_text())
+            claim = Claim(name, path, item)
+            with self._lock:
+                self._claims[path] = claim
+            self._start_heartbeat()
+            return claim
+        return None
+
+    def _release(self, claim, state, **fields):
+        with self._lock:
+            self._claims.pop(claim.path, None)
+        taken = self.directory / 'clock' / f"release.{uuid.uuid4().hex}.json"
+        try:
+            os.rename(claim.path, taken)
+        except FileNotFoundError:
+            # The lease ran out and another worker put the item back; it will be done again
+            logging.warning(f"Lease of work item {claim.name} was lost before it finished")
+            return
+        self._write(taken, dict(claim.item, worker=self.worker, finished=time.time(), **fields))
+        os.rename(taken, self.directory / state / f"{claim.name}.json")
+
+    def complete(self, claim, **fields):
+        """Mark a claimed item as done; fields (e.g. the seconds taken) are stored with it."""
+        self._release(claim, 'done', **fields)
+
+    def fail(self, claim, error):
+        self._release(claim, 'failed', error=error)
+
+    def requeue_expired(self):
+        """Move claimed items whose lease ran out back to pending/, or to failed/ after MAX_CLAIMS claims.
+        Returns the number of items moved."""
+        claimed = self.directory / 'claimed'
+        now = self.server_time()
+        moved = 0
+        for entry in os.listdir(claimed):
+            path = claimed / entry
+            try:
+                if entry.startswith('.') or now - path.stat().st_mtime <= self.lease:
+                    continue
+                # Take the item out of claimed/ first; only one worker wins the rename
+                taken = self.directory / 'clock' / f"requeue.{uuid.uuid4().hex}.json"
+                os.rename(path, taken)
+            except FileNotFoundError:
+                continue
+            name, _, owner = entry[:-len('.json')].partition('@')
+            item = json.loads(taken.read_text())
+            item['claims'] = item.get('claims', 0) + 1
+            if item['claims'] >= MAX_CLAIMS:
+                logging.warning(f"Work item {name} was claimed {item['claims']} times without finishing; giving up")
+                self._write(taken, dict(item, error=f"lease expired {item['claims']} times"))
+                os.rename(taken, self.directory / 'failed' / f"{name}.json")
+            else:
+                logging.warning(f"Lease of work item {name} held by {owner} expired; putting it back in the queue")
+                self._write(taken, item)
+                os.rename(taken, self.directory / 'pending' / f"{name}.json")
+            moved += 1
+        return moved
+
+    def wait(self):
+        """Pause before looking for pending items again; only briefly while the queue is still being filled."""
+        time.sleep(self.poll_interval if self.is_ready() else min(1.0, self.poll_interval))
+
+    def finished(self):
+        """Check if every item has been listed and is done or failed."""
+        return self.is_ready() and not any(
+            entry.endswith('.json') and not entry.startswith('.')
+            for state in ('pending', 'claimed') for entry in os.listdir(self.directory / state))
+
+    def counts(self):
+        """Return the number of items per state."""
+        return {state: sum(1 for entry in os.listdir(self.directory / state)
+                           if entry.endswith('.json') and not entry.startswith('.'))
+                for state in ('pending', 'claimed', 'done', 'failed')}
+
+    # --- Leases ---
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._renew_leases, name='queue-heartbeat', daemon=True)
+                self._heartbeat.start()
+
+    def _renew_leases(self):
+        """Touch the files of this process's claims (and the fill lock) well before their lease runs out."""
+        while True:
+            time.sleep(self.lease / 4)
+            with self._lock:
+                paths = list(self._claims)
+            if self._holding_lock:
+                paths.append(self.lock_path)
+            for path in paths:
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
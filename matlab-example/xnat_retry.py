@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""
+Retry policy shared by the XNAT download paths.
+
+Errors are split into retryable ones (dropped connections, timeouts, truncated
+streams, 429 and 5xx responses) and fatal ones (missing objects, bad
+credentials, full disks), so a download only waits when another attempt can
+help. Waits grow exponentially with random jitter, so parallel downloads that
+fail together do not all come back at the same moment.
+"""
+
+import asyncio
+import http.client
+import logging
+import random
+import time
+import zipfile
+import zlib
+
+import requests
+import urllib3
+
+from xnat_transfer import CorruptZipStream
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# HTTP status codes worth trying again: timeouts, rate limiting and server-side failures
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+# Errors raised when a connection drops or a response is cut short, including the
+# damaged zips a cut-off transfer leaves (xnat's download_dir and the zip stream reader)
+RETRYABLE_ERRORS = (
+    requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+    urllib3.exceptions.ProtocolError, urllib3.exceptions.ReadTimeoutError,
+    http.client.IncompleteRead, ConnectionError, TimeoutError, asyncio.TimeoutError,
+    EOFError, zlib.error, zipfile.BadZipFile, CorruptZipStream,
+)
+if aiohttp is not None:
+    RETRYABLE_ERRORS += (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+
+def error_status(error):
+    """Return the HTTP status code carried by an error, or None."""
+    response = getattr(error, 'response', None)
+    if response is not None and getattr(response, 'status_code', None) is not None:
+        return response.status_code
+    # xnat.exceptions.XNATResponseError and aiohttp.ClientResponseError carry the status themselves
+    return getattr(error, 'status_code', None) or getattr(error, 'status', None)
+
+def is_retryable(error):
+    """Return True if another attempt may succeed after this error."""
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return isinstance(error, RETRYABLE_ERRORS)
+
+def retry_after(error):
+    """Return the delay in seconds requested by a Retry-After header, or None."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(error, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+class RetryPolicy:
+    """Run an operation again after retryable errors, waiting longer each time.
+
+    The wait before attempt n+1 is a random time between zero and
+    min(max_delay, base_delay * 2**(n-1)) seconds ("full jitter"), or the
+    server's Retry-After if that is longer.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=2.0, max_delay=60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, error=None):
+        """Return the seconds to wait after failed attempt number `attempt` (counting from 1)."""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        requested = retry_after(error) if error is not None else None
+        if requested is not None:
+            delay = max(delay, min(requested, self.max_delay))
+        return delay
+
+    def should_retry(self, attempt, error):
+        return attempt < self.max_attempts and is_retryable(error)
+
+    def run(self, operation, on_retry=None):
+        """Call operation(attempt) until it succeeds, a fatal error occurs or attempts run out.
+        on_retry(attempt, error, delay) is called before each wait; by default it logs a warning."""
+        attempt = 1
+        while True:
+            try:
+                return operation(attempt)
+            except Exception as e:
+                if not self.should_retry(attempt, e):
+                    raise
+                delay = self.delay(attempt, e)
+                (on_retry or log_retry)(attempt, e, delay)
+                time.sleep(delay)
+                attempt += 1
+
+    async def run_async(self, operation, on_retry=None):
+        """Like run, for an operation that returns a coroutine."""
+        attempt = 1
+        while True:
+            try:
+                return await operation(attempt)
+            except Exception as e:
+                if not self.should_retry(attempt, e):
+                    raise
+                delay = self.delay(attempt, e)
+                (on_retry or log_retry)(attempt, e, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+def log_retry(attempt, error, delay):
+    logging.warning(f"      Attempt {attempt} failed: {error}. Retrying in {delay:.1f} seconds...")
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+Size-aware ordering of parallel scan downloads (`--largest-first`).
+
+With `--jobs N` the scans of a session are started in the order XNAT lists
+them. When one scan is much larger than the rest (a long multiband run) and
+it happens to be listed last, it starts when the others are nearly done and
+then downloads alone while the other connections sit idle. Starting the
+largest scans first (longest processing time first, LPT) keeps the end of the
+session short: the small scans fill the gaps around the large ones.
+
+Before a session is downloaded the size of every scan's DICOM resource is
+read from the server's resource listing (the `file_size` column), a few scans
+at a time. The scans are then handed to the download pool largest first, and
+the time the session should take is predicted by replaying that order over
+the N download slots with a per-scan time of
+
+    overhead + bytes / rate
+
+where overhead and rate are fitted to the scans downloaded so far in this
+run (with defaults until a few have been measured). The prediction and the
+actual time are logged per session and written to the run report, so the
+heuristic can be checked against real runs.
+"""
+
+import heapq
+import logging
+import threading
+
+DEFAULT_STREAM_RATE = 10e6  # Bytes per second of one download stream, until scans of this run were measured
+DEFAULT_SCAN_OVERHEAD = 1.0  # Seconds per scan besides the transfer (requests, zip building, extraction)
+MIN_OBSERVATIONS = 3  # Downloaded scans needed before the rate and overhead are fitted
+
+def scan_resources(scan):
+    """Return {label: (files, bytes)} for the resources of a scan, read from one resource listing request."""
+    rows = scan.xnat_session.get_json(f"{scan.uri}/resources")['ResultSet']['Result']
+    resources = {}
+    for row in rows:
+        try:
+            resources[row['label']] = (int(row.get('file_count') or 0), int(row.get('file_size') or 0))
+        except (TypeError, ValueError):
+            resources[row['label']] = (0, 0)
+    return resources
+
+def resource_size(scan, label='DICOM'):
+    """Return the size in bytes of one resource of a scan as listed by the server, or 0 if it has none."""
+    return scan_resources(scan).get(label, (0, 0))[1]
+
+def largest_first(items, sizes):
+    """Return items sorted by their size, largest first; equal sizes keep their listed order."""
+    return [item for _, item in sorted(zip(sizes, items), key=lambda pair: -pair[0])]
+
+def lpt_shares(items, sizes, count):
+    """Split items into count shares of similar total size: largest first, each to the share with the least so far."""
+    shares = [[] for _ in range(count)]
+    loads = [(0, index) for index in range(count)]
+    for size, item in sorted(zip(sizes, items), key=lambda pair: -pair[0]):
+        load, index = heapq.heappop(loads)
+        shares[index].append(item)
+        heapq.heappush(loads, (load + size, index))
+    return [share for share in shares if share]
+
+def predict_makespan(durations, slots):
+    """Predict the time until the last of the durations finishes when they are started in the given order,
+    each as soon as one of the slots is free."""
+    finish_times = [0.0] * max(1, min(slots, len(durations)))
+    for duration in durations:
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + duration)
+    return max(finish_times) if durations else 0.0
+
+class ThroughputModel:
+    """Time per scan as a function of its size, fitted to the scans downloaded so far. Thread-safe."""
+
+    def __init__(self, rate=DEFAULT_STREAM_RATE, overhead=DEFAULT_SCAN_OVERHEAD):
+        self.rate = rate
+        self.overhead = overhead
+        self.observations = []
+        self._lock = threading.Lock()
+
+    def observe(self, nbytes, seconds):
+        """Record a scan that was downloaded (not skipped) and refit the model."""
+        with self._lock:
+            self.observations.append((nbytes, seconds))
+            if len(self.observations) >= MIN_OBSERVATIONS:
+                self._fit()
+
+    def _fit(self):
+        # Least squares line seconds = overhead + bytes / rate
+        count = len(self.observations)
+        mean_bytes = sum(b for b, _ in self.observations) / count
+        mean_seconds = sum(s for _, s in self.observations) / count
+        variance = sum((b - mean_bytes) ** 2 for b, _ in self.observations)
+        slope = sum((b - mean_bytes) * (s - mean_seconds) for b, s in self.observations) / variance if variance else 0
+        if slope > 0:
+            self.overhead = max(0.0, mean_seconds - slope * mean_bytes)
+            self.rate = 1 / slope
+        elif mean_bytes > 0 and mean_seconds > 0:
+            # All scans about the same size: no line to fit, use the average rate
+            self.overhead = 0.0
+            self.rate = mean_bytes / mean_seconds
+
+    def predict(self, nbytes):
+        """Predicted seconds to download a scan of nbytes."""
+        with self._lock:
+            return self.overhead + nbytes / self.rate
+
+    @classmethod
+    def from_report(cls, report):
+        """Fit a model to the scans downloaded in an earlier run, given its run report."""
+        model = cls()
+        for subject in report.get('subjects', []):
+            for session in subject.get('sessions', []):
+                for scan in session.get('scans', []):
+                    if scan.get('status') == 'downloaded' and scan.get('seconds'):
+                        model.observe(scan.get('bytes', 0), scan['seconds'])
+        return model
+
+    def describe(self):
+        with self._lock:
+            source = 'measured' if len(self.observations) >= MIN_OBSERVATIONS else 'default'
+            return f"{self.rate / 1e6:.1f} MB/s per stream + {self.overhead:.1f}s per scan ({source})"
+
+def summarize(records):
+    """Add up the predicted and actual times of the sessions in a run's metrics records.
+    Returns None if no session was scheduled by size."""
+    sessions = [record for record in records if record['level'] == 'session' and 'predicted_seconds' in record]
+    if not sessions:
+        return None
+    predicted = sum(record['predicted_seconds'] for record in sessions)
+    actual = sum(record['scan_seconds'] for record in sessions)
+    return {'sessions': len(sessions), 'predicted_seconds': round(predicted, 3), 'actual_seconds': round(actual, 3),
+            'error': round((actual - predicted) / predicted, 3) if predicted else None}
+
+def log_summary(summary):
+    if summary is None:
+        return
+    line = (f"Largest-first schedule: {summary['sessions']} session(s) predicted to take "
+            f"{summary['predicted_seconds']:.1f}s, took {summary['actual_seconds']:.1f}s")
+    if summary['error'] is not None:
+        line += f" ({summary['error'] * 100:+.0f}%)"
+    logging.info(line)
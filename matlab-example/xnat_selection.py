@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+"""
+Session and file selection shared by the resource download and upload scripts.
+
+Both scripts take subject and session IDs such as `sub-01 ses-01` and look up
+the XNAT experiment labelled `sub-01_ses-01` (or `sub-01_ses_01`) in an index
+built from one listing of the project's experiments, instead of searching the
+project for every pair. Files are picked with `--include`/`--exclude` glob
+patterns, matched against the file name, or against the whole path for
+patterns containing a `/`.
+"""
+
+import fnmatch
+import logging
+
+def matches_any(rel_path, patterns):
+    """Check a file's path (a PurePosixPath relative to the session folder) against glob patterns.
+    Patterns containing a / are matched against the whole path, the others against the file name."""
+    return any(fnmatch.fnmatchcase(str(rel_path) if '/' in pattern else rel_path.name, pattern)
+               for pattern in patterns)
+
+def build_experiment_index(project):
+    """Index all experiments of a project by label, using a single listing request."""
+    experiment_index = {}
+    for exp in project.experiments.values():
+        experiment_index[exp.label] = exp
+    logging.info(f"Indexed {len(experiment_index)} experiments in project {project.id}")
+    return experiment_index
+
+def find_experiment(experiment_index, subject_id, session_id):
+    """Look up the experiment of a subject/session, trying both the ses-01 and ses_01 label formats."""
+    experiment_labels = [
+        f"{subject_id}_{session_id}",  # Try ses-01
+        f"{subject_id}_{session_id.replace('-', '_')}"  # Try ses_01
+    ]
+    for experiment_label in experiment_labels:
+        if experiment_label in experiment_index:
+            return experiment_index[experiment_label]
+    return None
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+"""
+Shared transfer helpers for the XNAT download scripts.
+
+XNAT serves a whole resource as one zip file (`<resource>/files?format=zip`).
+Instead of saving that zip, unpacking it into a temporary directory and then
+moving the files into place, the helpers here read the zip directly from the
+HTTP response and write every member straight to its final location.
+
+The functions that write files take an optional `on_written(path, md5)`
+callback. When it is given, the bytes are hashed as they are written and the
+callback receives the MD5 of every complete file (see xnat_checksums.py).
+An optional `on_saved(path, nbytes)` callback receives the size of every
+complete file without hashing it, e.g. for the run metrics.
+"""
+
+import hashlib
+import re
+import struct
+import zlib
+from pathlib import Path, PurePosixPath
+
+# Size of the pieces read from the network and written to disk
+CHUNK_SIZE = 1024 * 1024
+
+# Zip record signatures and the fixed part of a local file header
+LOCAL_FILE_HEADER = b'PK\x03\x04'
+CENTRAL_DIRECTORY = b'PK\x01\x02'
+END_OF_CENTRAL_DIRECTORY = b'PK\x05\x06'
+DATA_DESCRIPTOR = b'PK\x07\x08'
+LOCAL_HEADER_FORMAT = struct.Struct('<HHHHHIIIHH')
+
+class CorruptZipStream(ValueError):
+    """Raised when the data of a zip stream is damaged, as by a transfer cut off or garbled on the way.
+    Another attempt may succeed, so the retry policy treats it as retryable."""
+
+class ZipStreamReader:
+    """Read a zip archive member by member from a non-seekable stream."""
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = b''
+
+    def read(self, size):
+        """Read up to `size` bytes, using bytes pushed back by `unread` first."""
+        if self.buffer:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+        return self.stream.read(size)
+
+    def read_exact(self, size):
+        """Read exactly `size` bytes or fail if the stream ends early."""
+        data = b''
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise EOFError("Zip stream ended unexpectedly")
+            data += chunk
+        return data
+
+    def unread(self, data):
+        """Push bytes back so the next read returns them again."""
+        self.buffer = data + self.buffer
+
+    def members(self):
+        """Yield (name, chunks) for each member. `chunks` must be consumed before moving on."""
+        while True:
+            signature = self.read_exact(4)
+            if signature in (CENTRAL_DIRECTORY, END_OF_CENTRAL_DIRECTORY):
+                return
+            if signature != LOCAL_FILE_HEADER:
+                raise CorruptZipStream(f"Unexpected zip record signature {signature!r}")
+
+            (_, flags, method, _, _, crc, compressed_size, _,
+             name_length, extra_length) = LOCAL_HEADER_FORMAT.unpack(self.read_exact(LOCAL_HEADER_FORMAT.size))
+            name = self.read_exact(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+            extra = self.read_exact(extra_length)
+            zip64 = compressed_size == 0xFFFFFFFF
+            if zip64:
+                compressed_size = self._zip64_compressed_size(extra)
+
+            yield name, self._member_chunks(flags, method, crc, compressed_size, zip64)
+
+    def _member_chunks(self, flags, method, crc, compressed_size, zip64):
+        """Yield the decompressed data of the current member and check its CRC."""
+        has_descriptor = bool(flags & 0x08)
+        actual_crc = 0
+
+        if method == 0:
+            if has_descriptor and compressed_size == 0:
+                raise ValueError("Stored zip members without a known size cannot be streamed")
+            remaining = compressed_size
+            while remaining:
+                chunk = self.read_exact(min(self.chunk_size, remaining))
+                remaining -= len(chunk)
+                actual_crc = zlib.crc32(chunk, actual_crc)
+                yield chunk
+        elif method == 8:
+            # Raw deflate data knows where it ends, so sizes are not needed
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            while not decompressor.eof:
+                chunk = self.read(self.chunk_size)
+                if not chunk:
+                    raise EOFError("Zip stream ended inside a compressed member")
+                data = decompressor.decompress(chunk)
+                if data:
+                    actual_crc = zlib.crc32(data, actual_crc)
+                    yield data
+            self.unread(decompressor.unused_data)
+        else:
+            raise ValueError(f"Unsupported zip compression method {method}")
+
+        if has_descriptor:
+            # The CRC and sizes follow the data, optionally preceded by a signature
+            field = self.read_exact(4)
+            if field == DATA_DESCRIPTOR:
+                field = self.read_exact(4)
+            crc = struct.unpack('<I', field)[0]
+            self.read_exact(8)
+            # Zip64 descriptors carry 8-byte sizes; detect them by what follows
+            following = self.read_exact(4)
+            self.unread(following)
+            if zip64 or following not in (LOCAL_FILE_HEADER, CENTRAL_DIRECTORY, END_OF_CENTRAL_DIRECTORY):
+                self.read_exact(8)
+
+        if actual_crc != crc:
+            raise CorruptZipStream("CRC mismatch in zip stream")
+
+    @staticmethod
+    def _zip64_compressed_size(extra):
+        """Get the compressed size from the zip64 extra field of a local header."""
+        offset = 0
+        while offset + 4 <= len(extra):
+            header_id, size = struct.unpack_from('<HH', extra, offset)
+            if header_id == 0x0001:
+                # Local zip64 records hold the uncompressed size, then the compressed size
+                return struct.unpack_from('<Q', extra, offset + 12)[0]
+            offset += 4 + size
+        raise ValueError("Zip64 member without a zip64 extra field")
+
+def extract_zip_stream(stream, destination_for, on_written=None, on_saved=None):
+    """Write the members of a zip stream to the paths returned by `destination_for(name)`.
+
+    Members for which `destination_for` returns None are read past and discarded.
+    Each file is written next to its destination as `<name>.part` and renamed once complete,
+    so an interrupted download never leaves truncated files behind.
+    Returns the list of written paths.
+    """
+    written = []
+    for name, chunks in ZipStreamReader(stream).members():
+        destination = None if name.endswith('/') else destination_for(name)
+        if destination is None:
+            for _ in chunks:
+                pass
+            continue
+
+        written.append(write_chunks(destination, chunks, on_written, on_saved))
+    return written
+
+def write_chunks(destination, chunks, on_written=None, on_saved=None):
+    """Write data chunks to destination via a `.part` file that is renamed once complete."""
+    destination = Path(destination)
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    partial = destination.with_name(destination.name + '.part')
+    digest = hashlib.md5() if on_written is not None else None
+    nbytes = 0
+    try:
+        with open(partial, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                nbytes += len(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+        partial.replace(destination)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    if digest is not None:
+        on_written(destination, digest.hexdigest())
+    if on_saved is not None:
+        on_saved(destination, nbytes)
+    return destination
+
+def resource_url(server_url, resource):
+    """Return the URL that serves all files of a resource as one zip."""
+    return f"{server_url.rstrip('/')}{resource.uri}/files"
+
+def download_resource_zip(server_url, resource, destination_for, on_written=None, on_saved=None):
+    """Stream a resource zip from XNAT and extract it straight into place.
+    Returns the list of written paths."""
+    interface = resource.xnat_session.interface
+    with interface.get(resource_url(server_url, resource), params={'format': 'zip'}, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return extract_zip_stream(response.raw, destination_for, on_written, on_saved)
+
+def flat_dicom_destination(target_dir):
+    """Destination mapping that puts every .dcm member directly into `target_dir`."""
+    target_dir = Path(target_dir)
+
+    def destination_for(name):
+        if not name.endswith('.dcm'):
+            return None
+        return target_dir / PurePosixPath(name).name
+
+    return destination_for
+
+def list_resource_files(server_url, resource):
+    """Return the server-side file catalog of a resource.
+    Each entry is a dict with the file name, its path within the resource, size,
+    digest (None if the server has none) and url."""
+    interface = resource.xnat_session.interface
+    response = interface.get(resource_url(server_url, resource), params={'format': 'json'})
+    response.raise_for_status()
+
+    catalog = []
+    for row in response.json()['ResultSet']['Result']:
+        catalog.append({
+            'name': PurePosixPath(row['Name']).name,
+            'path': re.sub(r'^.*/resources/[^/]+/files/', '', row['URI'], count=1),
+            'size': int(row['Size']) if row.get('Size') not in (None, '') else None,
+            'digest': row.get('digest') or None,
+            'url': f"{server_url.rstrip('/')}{row['URI']}",
+        })
+    return catalog
+
+def file_digest(path):
+    """Return an MD5 digest object fed with the bytes of a local file."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+def file_md5(path):
+    """Compute the MD5 digest of a local file."""
+    return file_digest(path).hexdigest()
+
+def find_stale_files(catalog, target_dir, verify_checksums=False, manifest=None):
+    """Return the catalog entries whose local copy in target_dir is missing or differs.
+    Files are compared by size, and by MD5 as well if verify_checksums is set and the server has a digest.
+    With a checksum manifest, stored digests of unchanged files are used instead of hashing them again."""
+    local_md5 = manifest.local_md5 if manifest is not None else file_md5
+    stale = []
+    for entry in catalog:
+        local_path = Path(target_dir) / entry['name']
+        if not local_path.is_file():
+            stale.append(entry)
+        elif entry['size'] is not None and local_path.stat().st_size != entry['size']:
+            stale.append(entry)
+        elif verify_checksums and entry['digest'] and local_md5(local_path) != entry['digest'].lower():
+            stale.append(entry)
+    return stale
+
+def range_start(response):
+    """Return the first byte offset of a 206 response, or None if the server sent the whole file."""
+    match = re.match(r'bytes (\d+)-', response.headers.get('Content-Range', ''))
+    return int(match.group(1)) if response.status_code == 206 and match else None
+
+def download_file(interface, url, destination, on_written=None, on_saved=None):
+    """Stream a single file from XNAT to destination via a `.part` file.
+
+    If a `.part` file is left from an interrupted attempt, only the rest of the
+    file is requested with an HTTP Range header. Servers that ignore the range
+    send the whole file, which then replaces the partial one. The `.part` file is
+    kept when the transfer fails so the next attempt can continue from there.
+    """
+    destination = Path(destination)
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    partial = destination.with_name(destination.name + '.part')
+    offset = partial.stat().st_size if partial.exists() else 0
+    headers = {'Range': f"bytes={offset}-", 'Accept-Encoding': 'identity'} if offset else {}
+
+    with interface.get(url, stream=True, headers=headers) as response:
+        if offset and (response.status_code == 416 or range_start(response) not in (None, offset)):
+            # The partial file does not fit the file on the server any more; start over
+            partial.unlink()
+            return download_file(interface, url, destination, on_written, on_saved)
+        response.raise_for_status()
+        resumed = range_start(response) is not None
+        response.raw.decode_content = True
+        # A continued file is hashed from its first byte: the part written before, then the rest as it arrives
+        digest = None if on_written is None else file_digest(partial) if resumed else hashlib.md5()
+        nbytes = offset if resumed else 0
+        with open(partial, 'ab' if resumed else 'wb') as f:
+            for chunk in iter(lambda: response.raw.read(CHUNK_SIZE), b''):
+                f.write(chunk)
+                nbytes += len(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+    partial.replace(destination)
+    if digest is not None:
+        on_written(destination, digest.hexdigest())
+    if on_saved is not None:
+        on_saved(destination, nbytes)
+    return destination
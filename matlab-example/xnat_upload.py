@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Batched, parallel uploads into XNAT resources (session-upload-v1.py).
+
+Sending pipeline outputs one file per request spends most of the time on
+round trips and on XNAT updating the resource catalog after every file, which
+dominates for thousands of small files (reports, figures, JSON sidecars).
+Small files are therefore packed into zip batches that XNAT unpacks into the
+resource (`PUT .../files/batch.zip?extract=true`), a few dozen MB per request,
+while large files are sent on their own, several at a time. Both kinds run on
+the same pool of connections.
+
+Before anything is sent the resource catalog is read once, and files whose
+MD5 matches the digest XNAT lists for the same path are left out, so running
+an upload again only sends what changed.
+"""
+
+import io
+import os
+import zipfile
+from pathlib import PurePosixPath
+from urllib.parse import quote
+
+SMALL_FILE_SIZE = 4 * 1024 * 1024  # Files below this many bytes are sent in zip batches
+BATCH_BYTES = 64 * 1024 * 1024  # Largest total size of the files in one zip batch
+BATCH_FILES = 1000  # Most files in one zip batch
+
+# Files that are already compressed are stored in the zip batches as they are
+STORED_SUFFIXES = ('.gz', '.zip', '.bz2', '.xz', '.zst', '.png', '.jpg', '.jpeg', '.gif', '.mp4')
+
+class CountingReader:
+    """Read-only file-like object that reports the bytes read from it, so uploads show up in the progress line.
+    Its length lets requests send a Content-Length instead of a chunked body."""
+
+    def __init__(self, fileobj, size, on_read=None):
+        self.fileobj = fileobj
+        self.size = size
+        self.on_read = on_read
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if data and self.on_read is not None:
+            self.on_read(len(data))
+        return data
+
+def experiment_files_url(server_url, experiment_id, label):
+    """Return the URL of the files of an experiment resource, addressed by its label."""
+    return f"{server_url.rstrip('/')}/data/experiments/{experiment_id}/resources/{quote(label)}/files"
+
+def pending_uploads(files, catalog, local_md5):
+    """Return the (local path, remote path) pairs that are not on the server yet: files missing
+    from the resource catalog, listed without a digest or with another size, or with a digest that
+    differs from local_md5(path). Only files the server may already have are hashed."""
+    entries = {entry['path']: entry for entry in catalog}
+    pending = []
+    for path, remote_path in files:
+        entry = entries.get(remote_path)
+        if entry is None or not entry['digest']:
+            pending.append((path, remote_path))
+        elif entry['size'] is not None and entry['size'] != os.path.getsize(path):
+            pending.append((path, remote_path))
+        elif entry['digest'].lower() != local_md5(path):
+            pending.append((path, remote_path))
+    return pending
+
+def split_batches(uploads, small_file_size=SMALL_FILE_SIZE, batch_bytes=BATCH_BYTES, batch_files=BATCH_FILES):
+    """Split (local path, remote path) pairs into zip batches of small files and single large files.
+    Returns (batches, singles) of (local path, remote path, size) triples."""
+    batches = []
+    singles = []
+    batch = []
+    batch_size = 0
+    for path, remote_path in sorted(uploads, key=lambda upload: upload[1]):
+        size = os.path.getsize(path)
+        if size >= small_file_size:
+            singles.append((path, remote_path, size))
+            continue
+        if batch and (batch_size + size > batch_bytes or len(batch) >= batch_files):
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append((path, remote_path, size))
+        batch_size += size
+    if batch:
+        batches.append(batch)
+    # The largest files start first, so none is left sending alone at the end
+    singles.sort(key=lambda single: -single[2])
+    return batches, singles
+
+def zip_batch(batch):
+    """Pack a batch into an in-memory zip whose member names are the remote paths."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for path, remote_path, _ in batch:
+            stored = PurePosixPath(remote_path).suffix.lower() in STORED_SUFFIXES
+            archive.write(path, remote_path, compress_type=zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED,
+                          compresslevel=None if stored else 1)
+    return buffer.getvalue()
+
+def upload_file(interface, files_url, path, remote_path, on_sent=None):
+    """Send one file to remote_path in a resource, replacing a file already stored there."""
+    with open(path, 'rb') as f:
+        response = interface.put(f"{files_url}/{quote(remote_path)}", params={'inbody': 'true', 'overwrite': 'true'},
+                                 data=CountingReader(f, os.path.getsize(path), on_sent),
+                                 headers={'Content-Type': 'application/octet-stream'})
+    response.raise_for_status()
+
+def upload_zip(interface, files_url, name, data, on_sent=None):
+    """Send a zip batch that XNAT extracts into the resource, replacing files already stored there."""
+    response = interface.put(f"{files_url}/{name}", params={'inbody': 'true', 'overwrite': 'true', 'extract': 'true'},
+                             data=CountingReader(io.BytesIO(data), len(data), on_sent),
+                             headers={'Content-Type': 'application/zip'})
+    response.raise_for_status()
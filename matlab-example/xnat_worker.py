@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+"""
+Persistent download worker for downloadXNAT.m and other repeated callers.
+
+Every call of downloadXNAT.m normally looks for conda, starts `conda run`,
+imports the xnat package and logs in to XNAT before anything is downloaded.
+In a MATLAB loop over subjects that costs several seconds per call. The
+worker does all of that once: it keeps running, keeps one authenticated xnat
+session per server and user (with its metadata listings), and runs
+session-download-v1.py or session-resources-v1.py in-process for every job.
+
+Jobs are JSON lines sent over a TCP socket bound to 127.0.0.1. On start the
+worker writes its port and a random token to an info file only the current
+user can read, and every request must carry that token:
+
+    {"token": "...", "id": 1, "action": "download", "script": "session-download-v1.py",
+     "arguments": "--logs-dir logs --download-dir downloads ... --subjects sub-0201"}
+
+While the job runs the worker answers with {"id": 1, "event": "log", "message": ...}
+lines (what the script would print), and finally with
+{"id": 1, "event": "done", "status": "complete", "exit_code": 0, "seconds": ..., "totals": {...}}.
+The other actions are "ping" and "shutdown". Jobs run one at a time; further
+connections wait until the current job is finished.
+
+    python xnat_worker.py --info-file logs/worker.json
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import re
+import runpy
+import secrets
+import shlex
+import socket
+import sys
+import time
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from pathlib import Path
+
+import xnat_connection
+from xnat_metrics import REPORT_NAME
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+SCRIPTS = ('session-download-v1.py', 'session-resources-v1.py')
+
+DEFAULT_IDLE_TIMEOUT = 2 * 3600  # Seconds without jobs before the worker exits
+DEFAULT_METADATA_AGE = 300  # Seconds before the listings cached in a session are fetched again
+LIVENESS_CHECK_AFTER = 60  # Seconds of idleness after which a session is checked before it is reused
+
+log = logging.getLogger('xnat_worker')
+
+class SharedSession:
+    """Stand-in for an xnat session that stays logged in between jobs.
+
+    Attributes are read from and set on the real session, but leaving a `with`
+    block or calling disconnect does not log out.
+    """
+
+    def __init__(self, session):
+        object.__setattr__(self, '_session', session)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._session, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def disconnect(self):
+        pass
+
+class SessionPool:
+    """Logged-in xnat sessions kept between jobs, one per server and user."""
+
+    def __init__(self, metadata_age=DEFAULT_METADATA_AGE):
+        self.metadata_age = metadata_age
+        self.real_connect = xnat_connection.open_session
+        self.owner = os.getpid()
+        self.sessions = {}
+
+    def connect(self, server, user, password, **kwargs):
+        """Replacement for xnat_connection.open_session while the worker runs."""
+        if os.getpid() != self.owner:
+            # Processes started by a job (--workers) get a session of their own
+            return self.real_connect(server, user, password, **kwargs)
+
+        key = (server, user, password)
+        entry = self.sessions.get(key)
+        if entry is not None and not self._usable(entry, server):
+            self.close(key)
+            entry = None
+        if entry is None:
+            log.info(f"Logging in to {server}")
+            session = self.real_connect(server, user, password, **kwargs)
+            entry = self.sessions[key] = {'session': session, 'refreshed': time.time(),
+                                          'baseline': (list(session.interface.hooks['response']),
+                                                       dict(session.interface.adapters))}
+        elif time.time() - entry['refreshed'] > self.metadata_age:
+            # Pick up subjects and sessions added on the server since the listings were read
+            entry['session'].clearcache()
+            entry['refreshed'] = time.time()
+        entry['used'] = time.time()
+        return SharedSession(entry['session'])
+
+    def _usable(self, entry, server):
+        """Check a session that was idle for a while with one cheap request."""
+        if time.time() - entry.get('used', 0) < LIVENESS_CHECK_AFTER:
+            return True
+        try:
+            response = entry['session'].interface.get(f"{server.rstrip('/')}/data/JSESSION", timeout=30)
+            return response.status_code == 200
+        except Exception:
+            return False
+
+    def close(self, key=None):
+        """Log out of one session, or of all of them."""
+        for session_key in [key] if key is not None else list(self.sessions):
+            entry = self.sessions.pop(session_key, None)
+            if entry is not None:
+                try:
+                    entry['session'].disconnect()
+                except Exception:
+                    pass
+
+    def reset(self):
+        """Undo what the last job installed on the sessions (hooks, adapters, wrapped methods),
+        so nothing piles up from job to job."""
+        for entry in self.sessions.values():
+            session = entry['session']
+            hooks, adapters = entry['baseline']
+            session.interface.hooks['response'][:] = hooks
+            session.interface.adapters.clear()
+            session.interface.adapters.update(adapters)
+            session.__dict__.pop('download_stream', None)
+
+class LineForwarder(io.TextIOBase):
+    """Text stream that sends every line written to it to the client as a log event."""
+
+    def __init__(self, send, job_id):
+        self.send = send
+        self.job_id = job_id
+        self.pending = ''
+
+    def write(self, text):
+        self.pending += text
+        # Progress lines redraw themselves with \r; send each version as its own line
+        *lines, self.pending = re.split(r'\r\n|\r|\n', self.pending)
+        for line in lines:
+            if line.strip():
+                self.send({'id': self.job_id, 'event': 'log', 'message': line})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+def reset_logging():
+    """Remove the root logging handlers, so the next script's logging.basicConfig takes effect."""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+
+def option_value(argv, option):
+    """Return the value following option in an argument list, or None."""
+    return argv[argv.index(option) + 1] if option in argv[:-1] else None
+
+def run_script(script, argv):
+    """Run a download script in this process as if started from the command line. Returns its exit code."""
+    path = str(SCRIPT_DIR / script)
+    saved_argv = sys.argv
+    sys.argv = [path] + argv
+    try:
+        runpy.run_path(path, run_name='__main__')
+        return 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.argv = saved_argv
+
+def run_job(request, pool, send):
+    """Run one download request and send its log lines and result."""
+    job_id = request.get('id')
+    script = request.get('script')
+    if script not in SCRIPTS:
+        send({'id': job_id, 'event': 'error', 'message': f"Unknown script {script!r}; expected one of {SCRIPTS}"})
+        return
+    argv = request['arguments'] if isinstance(request.get('arguments'), list) else shlex.split(request.get('arguments', ''))
+
+    log.info(f"Job {job_id}: {script}")
+    start = time.time()
+    forwarder = LineForwarder(send, job_id)
+    reset_logging()
+    try:
+        with redirect_stderr(forwarder), redirect_stdout(forwarder):
+            exit_code = run_script(script, argv)
+            forwarder.write('\n')
+    finally:
+        reset_logging()
+        pool.reset()
+
+    result = {'id': job_id, 'event': 'done', 'status': 'complete' if exit_code == 0 else 'failed',
+              'exit_code': exit_code, 'seconds': round(time.time() - start, 3)}
+    logs_dir = option_value(argv, '--logs-dir')
+    report = Path(logs_dir) / REPORT_NAME if logs_dir else None
+    if report is not None and report.exists() and report.stat().st_mtime >= start:
+        result['totals'] = json.loads(report.read_text()).get('totals')
+    log.info(f"Job {job_id}: {result['status']} in {result['seconds']:.1f}s")
+    send(result)
+
+def handle_connection(connection, token, pool):
+    """Serve the requests of one client. Returns False once a shutdown was requested."""
+    def send(message):
+        try:
+            connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        except OSError:
+            pass  # The client went away; let the job finish anyway
+
+    for line in connection.makefile('r', encoding='utf-8'):
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError:
+            send({'event': 'error', 'message': 'Requests must be JSON objects, one per line'})
+            continue
+        if not secrets.compare_digest(str(request.get('token', '')), token):
+            send({'id': request.get('id'), 'event': 'error', 'message': 'Invalid token'})
+            return True
+
+        action = request.get('action', 'download')
+        if action == 'ping':
+            send({'id': request.get('id'), 'event': 'pong', 'pid': os.getpid(), 'sessions': len(pool.sessions)})
+        elif action == 'shutdown':
+            send({'id': request.get('id'), 'event': 'bye'})
+            return False
+        elif action == 'download':
+            run_job(request, pool, send)
+        else:
+            send({'id': request.get('id'), 'event': 'error', 'message': f"Unknown action {action!r}"})
+    return True
+
+def write_info_file(path, info):
+    """Write the port and token so that only the current user can read them."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(path.name + '.tmp')
+    descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'w') as f:
+        json.dump(info, f)
+    temporary.replace(path)
+
+def serve(info_file, port=0, idle_timeout=DEFAULT_IDLE_TIMEOUT, metadata_age=DEFAULT_METADATA_AGE):
+    pool = SessionPool(metadata_age)
+    # The scripts log in through open_session; hand them the pooled sessions instead
+    xnat_connection.open_session = pool.connect
+    token = secrets.token_hex(16)
+    server = socket.create_server(('127.0.0.1', port))
+    server.settimeout(idle_timeout)
+    port = server.getsockname()[1]
+    write_info_file(info_file, {'port': port, 'token': token, 'pid': os.getpid()})
+    log.info(f"XNAT worker {os.getpid()} listening on 127.0.0.1:{port}")
+
+    try:
+        running = True
+        while running:
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                log.info(f"No jobs for {idle_timeout} seconds, exiting")
+                break
+            with connection:
+                connection.settimeout(None)
+                running = handle_connection(connection, token, pool)
+    finally:
+        server.close()
+        pool.close()
+        try:
+            if json.loads(Path(info_file).read_text()).get('pid') == os.getpid():
+                Path(info_file).unlink()
+        except (OSError, ValueError):
+            pass
+    log.info('XNAT worker stopped')
+
+def main():
+    parser = argparse.ArgumentParser(description='Persistent XNAT download worker')
+    parser.add_argument('--info-file', required=True, help='File to write the port and access token to')
+    parser.add_argument('--port', type=int, default=0, help='Port on 127.0.0.1 (default: any free port)')
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT, help='Seconds without jobs before the worker exits')
+    parser.add_argument('--metadata-age', type=float, default=DEFAULT_METADATA_AGE, help='Seconds before cached subject and session listings are fetched again')
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler(sys.__stderr__)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    serve(args.info_file, args.port, args.idle_timeout, args.metadata_age)
+
+if __name__ == '__main__':
+    main()